@@ -1,15 +1,22 @@
 import os
-import numpy as np
+import io
+import base64
 import torch
 import warnings
 import threading
 import traceback
 import uvicorn
-from fastapi import FastAPI, Body
+from collections import OrderedDict
+from fastapi import FastAPI, Body, File, Form, UploadFile
+from fastapi.responses import JSONResponse, StreamingResponse
+from PIL import Image
 from pathlib import Path
 from datetime import datetime
-import torch.distributed as dist
 from hymm_gradio.pipeline_utils import *
+from hymm_gradio.job_queue import JobQueue, QueueFull, StepProgressCallback, DONE, RUNNING
+from hymm_gradio.request_channel import RequestChannel
+from hymm_gradio.staged_executor import Finished, Stage, StagedExecutor
+from hymm_gradio.video_stream import VideoStream
 from hymm_sp.config import parse_args
 from hymm_sp.audio_video_inference import HunyuanVideoSampler
 
@@ -21,207 +28,302 @@ from hymm_sp.modules.parallel_states import (
 from transformers import WhisperModel
 from transformers import AutoFeatureExtractor
 from hymm_sp.data_kits.face_align import AlignImage
+from hymm_sp.data_kits.video_writer import iter_video_bytes, video_frames, video_writer_kwargs
+from hymm_sp.vae.preview import LatentPreviewer, LatentPreviewCallback, frames_to_grid
 
 
 warnings.filterwarnings("ignore")
 MODEL_OUTPUT_PATH = os.environ.get('MODEL_BASE')
 app = FastAPI()
-rlock = threading.RLock()
+job_queue = None
+stage_executor = None
+request_channel = None
 
+# Fragmented MP4 of the last jobs, encoded once by the output stage and streamed as it is encoded. See
+# `--job-video-history`.
+videos_lock = threading.Lock()
+job_videos = OrderedDict()
+
+# Latest progress preview of the running request, see `--preview-steps`.
+preview_lock = threading.Lock()
+latest_preview = {}
+abort_event = threading.Event()
+
+
+def update_preview(step, frames):
+    image = Image.fromarray(frames_to_grid(frames))
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=80)
+    with preview_lock:
+        latest_preview["step"] = step
+        latest_preview["buffer"] = base64.b64encode(buffer.getvalue()).decode("utf-8")
+
+
+@app.get('/preview')
+def preview():
+    with preview_lock:
+        if not latest_preview:
+            return {"errCode": -1, "info": "no preview available"}
+        return {"errCode": 0, "step": latest_preview["step"], "content": [{"buffer": latest_preview["buffer"]}]}
+
+
+@app.post('/abort')
+def abort():
+    if nccl_info.sp_size > 1:
+        # A single rank must not leave the denoising loop early under sequence parallelism.
+        return {"errCode": -1, "info": "abort is not supported with sequence parallelism"}
+    abort_event.set()
+    return {"errCode": 0, "info": "abort requested"}
+
+
+
+def submit_job(data):
+    try:
+        job = job_queue.submit(data, priority=int(data.get("priority", 0)))
+    except QueueFull as e:
+        return JSONResponse({"errCode": -4, "info": f"job queue is full: {e}"}, status_code=429)
+    return {"errCode": 0, "id": job.id, "position": job_queue.position(job)}
+
+
+@app.post('/jobs')
+def create_job(data=Body(...)):
+    return submit_job(data)
+
+
+@app.post('/jobs/upload')
+def create_job_upload(image: UploadFile = File(...), audio: UploadFile = File(...), text: str = Form(None),
+                      negative_text: str = Form(None), save_fps: int = Form(25), priority: int = Form(0)):
+    # multipart upload: the files stay in memory, without the base64 inflation of the JSON body
+    return submit_job({
+        "image_bytes": image.file.read(),
+        "audio_bytes": audio.file.read(),
+        "text": text,
+        "negative_text": negative_text,
+        "save_fps": save_fps,
+        "priority": priority,
+    })
+
+
+@app.get('/jobs/{job_id}')
+def get_job(job_id: str):
+    job = job_queue.get(job_id)
+    if job is None:
+        return JSONResponse({"errCode": -1, "info": "unknown job"}, status_code=404)
+    return {"errCode": 0, **job.to_dict(job_queue.position(job))}
+
+
+@app.get('/jobs/{job_id}/video')
+def get_job_video(job_id: str):
+    job = job_queue.get(job_id)
+    if job is None:
+        return JSONResponse({"errCode": -1, "info": "unknown job"}, status_code=404)
+    with videos_lock:
+        stream = job_videos.get(job_id)
+    if stream is None:
+        if job.status == DONE:
+            return JSONResponse({"errCode": -1, "info": "no video for this job, or no longer kept"}, status_code=410)
+        return JSONResponse({"errCode": -1, "info": f"job is {job.status}, the video is not encoded yet"},
+                            status_code=409)
+    # chunked transfer, the fragments go out as the output stage encodes them
+    return StreamingResponse(stream.iter_bytes(), media_type="video/mp4")
+
+
+@app.delete('/jobs/{job_id}')
+def cancel_job(job_id: str):
+    job = job_queue.get(job_id)
+    if job is None:
+        return JSONResponse({"errCode": -1, "info": "unknown job"}, status_code=404)
+    if job_queue.cancel(job_id):
+        return {"errCode": 0, "info": "job cancelled"}
+    if job.status == RUNNING and job.stage in ("preprocess", "generate"):
+        # only this job stops: it is checked before generating and at every denoising step of its own
+        job.cancel_requested.set()
+        if nccl_info.sp_size > 1 and job.stage == "generate":
+            return {"errCode": 0, "info": "cancel requested, a job already denoising cannot stop under sequence "
+                                          "parallelism"}
+        return {"errCode": 0, "info": "cancel requested"}
+    if job.status == RUNNING:
+        return {"errCode": -1, "info": f"job is in the {job.stage} stage"}
+    return {"errCode": -1, "info": f"job already {job.status}"}
+
+
+@app.get('/metrics')
+def metrics():
+    return {"errCode": 0, "jobs": job_queue.stats(), "stages": stage_executor.metrics()}
 
 
 @app.api_route('/predict2', methods=['GET', 'POST'])
 def predict(data=Body(...)):
-    is_acquire = False
-    error_info = ""
+    # compatibility shim: queue the job and wait for it, instead of rejecting requests while busy
     try:
-        is_acquire = rlock.acquire(blocking=False)
-        if is_acquire:
-            res = predict_wrap(data)
-            return res
-    except Exception as e:
-        error_info = traceback.format_exc()
-        print(error_info)
-    finally:
-        if is_acquire:
-            rlock.release()
-    return {"errCode": -1, "info": "broken"}
-
-def predict_wrap(input_dict={}):
-    if nccl_info.sp_size > 1:
-        device = torch.device(f"cuda:{torch.distributed.get_rank()}")
-        rank = local_rank = torch.distributed.get_rank()
-        print(f"sp_size={nccl_info.sp_size}, rank {rank} local_rank {local_rank}")
+        job = job_queue.submit(data, priority=int(data.get("priority", 0)))
+    except QueueFull as e:
+        return {"errCode": -4, "info": f"job queue is full: {e}"}
+    job_queue.wait(job)
+    if job.result is None:
+        print(job.error)
+        return {"errCode": -1, "info": "broken"}
+    with videos_lock:
+        stream = job_videos.get(job.id)
+    if stream is not None:
+        return {"errCode": 0, "content": [{"buffer": base64.b64encode(stream.getvalue()).decode("utf-8")}],
+                "info": job.result["info"]}
+    return job.result
+
+
+def run_job(job):
+    def on_stage(name):
+        job.stage = name
+    return stage_executor.submit(job, on_stage=on_stage).result()
+
+
+def error_result(err_code, info):
+    return Finished({"errCode": err_code, "content": [{"buffer": None}], "info": info})
+
+
+def preprocess_job(job):
+    # runs while the previous job is on the GPU, Whisper aside this is CPU work
     try:
-        print(f"----- rank = {rank}")
-        if rank == 0:
-            input_dict = process_input_dict(input_dict)
-
-            print('------- start to predict -------')
-            # Parse input arguments
-            image_path = input_dict["image_path"]
-            driving_audio_path = input_dict["audio_path"]
-
-            prompt = input_dict["prompt"]
-
-            save_fps = input_dict.get("save_fps", 25)
-
-
-            ret_dict = None
-            if image_path is None or driving_audio_path is None:
-                ret_dict = {
-                    "errCode": -3, 
-                    "content": [
-                        {
-                            "buffer": None
-                        },
-                    ], 
-                    "info": "input content is not valid", 
-                }
-
-                print(f"errCode: -3, input content is not valid!")
-                return ret_dict
-
-            # Preprocess input batch
-            torch.cuda.synchronize()
-
-            a = datetime.now()
-            
-            try:
-                model_kwargs_tmp = data_preprocess_server(
-                                        args, image_path, driving_audio_path, prompt, feature_extractor
-                                        )
-            except:
-                ret_dict = {
-                    "errCode": -2,         
-                    "content": [
-                            {
-                                "buffer": None
-                            },
-                        ],
-                    "info": "failed to preprocess input data"
-                }
-                print(f"errCode: -2, preprocess failed!")
-                return ret_dict
-
-            text_prompt = model_kwargs_tmp["text_prompt"]
-            audio_path = model_kwargs_tmp["audio_path"]
-            image_path = model_kwargs_tmp["image_path"]
-            fps = model_kwargs_tmp["fps"]
-            audio_prompts = model_kwargs_tmp["audio_prompts"]
-            audio_len = model_kwargs_tmp["audio_len"]
-            motion_bucket_id_exps = model_kwargs_tmp["motion_bucket_id_exps"]
-            motion_bucket_id_heads = model_kwargs_tmp["motion_bucket_id_heads"]
-            pixel_value_ref = model_kwargs_tmp["pixel_value_ref"]
-            pixel_value_ref_llava = model_kwargs_tmp["pixel_value_ref_llava"]
-            
-
-
-            torch.cuda.synchronize()
-            b = datetime.now()
-            preprocess_time = (b - a).total_seconds()
-            print("="*100)
-            print("preprocess time :", preprocess_time)
-            print("="*100)
-            
-        else:
-            text_prompt = None
-            audio_path = None
-            image_path = None
-            fps = None
-            audio_prompts = None
-            audio_len = None
-            motion_bucket_id_exps = None
-            motion_bucket_id_heads = None
-            pixel_value_ref = None
-            pixel_value_ref_llava = None
+        input_dict = process_input_dict(job.payload)
+
+        print('------- start to predict -------')
+        # Parse input arguments
+        image_path = input_dict["image_path"]
+        driving_audio_path = input_dict["audio_path"]
+
+        prompt = input_dict["prompt"]
+        negative_prompt = input_dict["negative_prompt"]
+
+        save_fps = input_dict.get("save_fps", 25)
+
+        if image_path is None or driving_audio_path is None:
+            print(f"errCode: -3, input content is not valid!")
+            return error_result(-3, "input content is not valid")
+
+        a = datetime.now()
+
+        try:
+            model_kwargs_tmp = data_preprocess_server(
+                                    args, image_path, driving_audio_path, prompt, feature_extractor
+                                    )
+            # encoded here and not in the single generate worker, so concurrent jobs share Whisper batches
+            model_kwargs_tmp["audio_hidden_states"] = hunyuan_sampler.encode_audio_hidden_states(
+                wav2vec, model_kwargs_tmp["audio_prompts"][0])
+        except:
+            print(f"errCode: -2, preprocess failed!")
+            return error_result(-2, "failed to preprocess input data")
+
+        broadcast_params = [
+            model_kwargs_tmp["text_prompt"],
+            model_kwargs_tmp["audio_path"],
+            model_kwargs_tmp["image_path"],
+            model_kwargs_tmp["fps"],
+            model_kwargs_tmp["audio_prompts"],
+            model_kwargs_tmp["audio_hidden_states"],
+            model_kwargs_tmp["audio_len"],
+            model_kwargs_tmp["motion_bucket_id_exps"],
+            model_kwargs_tmp["motion_bucket_id_heads"],
+            model_kwargs_tmp["pixel_value_ref"],
+            model_kwargs_tmp["pixel_value_ref_llava"],
+            negative_prompt,
+        ]
+
+        b = datetime.now()
+        preprocess_time = (b - a).total_seconds()
+        print("="*100)
+        print("preprocess time :", preprocess_time)
+        print("="*100)
 
     except:
         traceback.print_exc()
-        if rank == 0:
-            ret_dict = {
-                "errCode": -1,         # Failed to generate video
-                "content":[
-                    {
-                        "buffer": None
-                    }
-                ],
-                "info": "failed to preprocess",
-            }
-            return ret_dict
+        return error_result(-1, "failed to preprocess")
+
+    return {
+        "job": job,
+        "broadcast_params": broadcast_params,
+        "audio_len": model_kwargs_tmp["audio_len"],
+        "audio": input_dict.get("audio_path", None),
+        "save_fps": save_fps,
+    }
+
 
+def generate_job(request):
+    if nccl_info.sp_size > 1:
+        print(f"sp_size={nccl_info.sp_size}, rank {rank} local_rank {local_rank}")
+    job = request["job"]
+    if job.cancel_requested.is_set():
+        return error_result(-5, "generation aborted")
     try:
-        broadcast_params = [
-            text_prompt,
-            audio_path,
-            image_path,
-            fps,
-            audio_prompts,
-            audio_len,
-            motion_bucket_id_exps,
-            motion_bucket_id_heads,
-            pixel_value_ref,
-            pixel_value_ref_llava,
-        ]
-        dist.broadcast_object_list(broadcast_params, src=0)
-        outputs = generate_image_parallel(*broadcast_params)
-
-        if rank == 0:
-            samples = outputs["samples"]
-            sample = samples[0].unsqueeze(0)
-
-            sample = sample[:, :, :audio_len[0]]
-            
-            video = sample[0].permute(1, 2, 3, 0).clamp(0, 1).numpy()
-            video = (video * 255.).astype(np.uint8)
-
-            output_dict = {
-                "err_code": 0, 
-                "err_msg": "succeed", 
-                "video": video, 
-                "audio": input_dict.get("audio_path", None), 
-                "save_fps": save_fps, 
-            }
-
-            ret_dict = process_output_dict(output_dict)
-            return ret_dict
-    
+        if request_channel is not None:
+            # the other ranks wait in `worker_loop` for the preprocessed request
+            request_channel.send(request["broadcast_params"])
+        outputs = generate_image_parallel(*request["broadcast_params"], on_progress=job.set_progress,
+                                          cancel_requested=job.cancel_requested.is_set)
     except:
         traceback.print_exc()
-        if rank == 0:
-            ret_dict = {
-                "errCode": -1,         # Failed to generate video
-                "content":[
-                    {
-                        "buffer": None
-                    }
-                ],
-                "info": "failed to generate video",
-            }
-            return ret_dict
-        
-    return None
-    
+        return error_result(-1, "failed to generate video")
+
+    if outputs is None:
+        return error_result(-5, "generation aborted")
+    request["outputs"] = outputs
+    return request
+
+
+def output_job(request):
+    # with `--async-vae-decode` or `--stream-vae-decode` the decode finishes here while the next job denoises
+    job = request["job"]
+    stream = VideoStream()
+    # published before encoding, `GET /jobs/{id}/video` streams the fragments as they are written
+    with videos_lock:
+        job_videos[job.id] = stream
+        while len(job_videos) > args.job_video_history:
+            job_videos.popitem(last=False)
+    try:
+        outputs = request["outputs"]
+        if "samples_stream" in outputs:
+            # each chunk is encoded as soon as it is decoded
+            chunks = outputs["samples_stream"]
+        elif "samples_future" in outputs:
+            chunks = [outputs["samples_future"].result()]
+        else:
+            chunks = [outputs["samples"]]
+        # encoded once here, downloads and `/predict2` send the stored fragments
+        for data in iter_video_bytes(video_frames(chunks, num_frames=request["audio_len"][0]), request["save_fps"],
+                                     audio=request["audio"], **video_writer_kwargs(args)):
+            stream.append(data)
+        stream.finish()
+    except Exception as e:
+        traceback.print_exc()
+        stream.finish(error=f"{type(e).__name__}: {e}")
+        with videos_lock:
+            if job_videos.get(job.id) is stream:
+                del job_videos[job.id]
+        return error_result(-1, "failed to generate video")
+
+    return {"errCode": 0, "info": "succeed", "video": f"/jobs/{job.id}/video"}
+
 def generate_image_parallel(text_prompt,
                     audio_path,
                     image_path,
                     fps,
                     audio_prompts,
+                    audio_hidden_states,
                     audio_len,
                     motion_bucket_id_exps,
                     motion_bucket_id_heads,
                     pixel_value_ref,
-                    pixel_value_ref_llava
+                    pixel_value_ref_llava,
+                    negative_prompt=None,
+                    on_progress=None,
+                    cancel_requested=None,
                     ):
-    if nccl_info.sp_size > 1:
-        device = torch.device(f"cuda:{torch.distributed.get_rank()}")
-
     batch = {
         "text_prompt": text_prompt,
         "audio_path": audio_path,
         "image_path": image_path,
         "fps": fps,
         "audio_prompts": audio_prompts,
+        "audio_hidden_states": audio_hidden_states,
         "audio_len": audio_len,
         "motion_bucket_id_exps": motion_bucket_id_exps,
         "motion_bucket_id_heads": motion_bucket_id_heads,
@@ -229,13 +331,33 @@ def generate_image_parallel(text_prompt,
         "pixel_value_ref_llava": pixel_value_ref_llava
     }
 
-    samples = hunyuan_sampler.predict(args, batch, wav2vec, feature_extractor, align_instance)
+    kwargs = {"negative_prompt": negative_prompt}
+    callback = preview_callback
+    if on_progress is not None:
+        # a single rank must not leave the denoising loop early under sequence parallelism
+        should_abort = None
+        if nccl_info.sp_size == 1:
+            should_abort = lambda: abort_event.is_set() or (cancel_requested is not None and cancel_requested())
+        callback = StepProgressCallback(on_progress, inner=preview_callback, should_abort=should_abort)
+    if callback is not None and rank == 0:
+        with preview_lock:
+            latest_preview.clear()
+        abort_event.clear()
+        kwargs["callback_on_step_end"] = callback
+    samples = hunyuan_sampler.predict(args, batch, wav2vec, feature_extractor, align_instance, **kwargs)
     return samples
 
 def worker_loop():
+    # the other ranks block on rank 0's requests and run their share of each
     while True:
-        predict_wrap()
-        
+        broadcast_params = request_channel.recv()
+        if broadcast_params is None:
+            break
+        try:
+            generate_image_parallel(*broadcast_params)
+        except:
+            traceback.print_exc()
+
 
 if __name__ == "__main__":
     audio_args = parse_args()
@@ -249,20 +371,44 @@ if __name__ == "__main__":
     if nccl_info.sp_size > 1:
         device = torch.device(f"cuda:{torch.distributed.get_rank()}")
         rank = local_rank = torch.distributed.get_rank()
+        request_channel = RequestChannel(device)
 
     feature_extractor = AutoFeatureExtractor.from_pretrained(f"{MODEL_OUTPUT_PATH}/ckpts/whisper-tiny/")
     wav2vec = WhisperModel.from_pretrained(f"{MODEL_OUTPUT_PATH}/ckpts/whisper-tiny/").to(device=device, dtype=torch.float32)
     wav2vec.requires_grad_(False)
+    if args.whisper_batch_windows > 0:
+        hunyuan_sampler.enable_audio_batcher(wav2vec, max_windows=args.whisper_batch_windows)
 
 
     BASE_DIR = f'{MODEL_OUTPUT_PATH}/ckpts/det_align/'
     det_path = os.path.join(BASE_DIR, 'detface.pt')    
-    align_instance = AlignImage("cuda", det_path=det_path)
+    align_instance = AlignImage(args.det_device, det_path=det_path, backend=args.det_backend,
+                                num_threads=args.det_threads)
 
+    preview_callback = None
+    if args.preview_steps > 0:
+        previewer = (LatentPreviewer.from_pretrained(args.preview_decoder) if args.preview_decoder
+                     else LatentPreviewer.default())
+        preview_callback = LatentPreviewCallback(previewer, update_preview, every_n_steps=args.preview_steps,
+                                                 should_abort=abort_event.is_set)
 
 
     if rank == 0:
+        # one generate worker: the sampler runs one job at a time, and the other ranks follow rank 0's jobs in order
+        stage_executor = StagedExecutor([
+            Stage("preprocess", preprocess_job, num_workers=args.preprocess_workers),
+            Stage("generate", generate_job),
+            Stage("output", output_job),
+        ], max_queued=args.stage_queue_size)
+        # enough job workers to keep every stage and stage queue busy
+        pipeline_depth = args.preprocess_workers + args.stage_queue_size + 2
+        job_queue = JobQueue(run_job, max_queued=args.job_queue_size, num_workers=pipeline_depth,
+                             keep_finished=args.job_history)
         uvicorn.run(app, host="0.0.0.0", port=80)
+        job_queue.close()
+        stage_executor.close()
+        if request_channel is not None:
+            request_channel.close()
     else:
         worker_loop()
     
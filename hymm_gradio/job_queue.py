@@ -0,0 +1,221 @@
+"""
+Bounded job queue in front of the generation workers of the FastAPI server.
+
+Clients `POST /jobs` and poll `GET /jobs/{id}` for the status, the denoising progress and finally the result, instead
+of retrying `/predict2` until the GPU is free. Jobs run by priority (higher first), then in submission order.
+"""
+import heapq
+import itertools
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from loguru import logger
+
+QUEUED, RUNNING, DONE, FAILED, CANCELLED = "queued", "running", "done", "failed", "cancelled"
+
+
+class QueueFull(Exception):
+    pass
+
+
+class Job:
+    def __init__(self, payload, priority=0):
+        self.id = uuid.uuid4().hex
+        self.payload = payload
+        self.priority = priority
+        self.sort_key = None
+        self.status = QUEUED
+        self.stage = None
+        self.step = 0
+        self.total_steps = None
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        # set by `DELETE /jobs/{id}` once the job left the queue, the stages stop this job and no other
+        self.cancel_requested = threading.Event()
+
+    @property
+    def progress(self):
+        if self.status == DONE:
+            return 1.0
+        if not self.total_steps:
+            return 0.0
+        return min(self.step / self.total_steps, 1.0)
+
+    def set_progress(self, step, total_steps):
+        self.step, self.total_steps = step, total_steps
+
+    def to_dict(self, position=None):
+        info = {
+            "id": self.id,
+            "status": self.status,
+            "stage": self.stage,
+            "progress": self.progress,
+            "step": self.step,
+            "total_steps": self.total_steps,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+        }
+        if position is not None:
+            info["position"] = position
+        if self.status == DONE:
+            info["result"] = self.result
+        if self.status == FAILED:
+            info["error"] = self.error
+            if self.result is not None:
+                info["result"] = self.result
+        return info
+
+
+class JobQueue:
+    """
+    Runs `run_fn(job)` for the submitted jobs on `num_workers` threads and keeps the outcome of the last
+    `keep_finished` jobs.
+
+    At most `max_queued` jobs wait at a time, `submit` raises `QueueFull` beyond that. The server runs a worker per
+    job its `StagedExecutor` can hold, the jobs still reach the GPU one at a time.
+
+    A job fails when `run_fn` raises, or when it returns a server error result (a dict with a non-zero `errCode`),
+    which is kept as the job's result with its `info` as the error. An error result after `job.cancel_requested` was
+    set cancels the job instead.
+    """
+    def __init__(self, run_fn, max_queued=16, num_workers=1, keep_finished=256):
+        self.run_fn = run_fn
+        self.max_queued = max_queued
+        self.keep_finished = keep_finished
+        self.jobs = OrderedDict()
+        self.heap = []
+        self.num_queued = 0
+        self.counter = itertools.count()
+        self.cond = threading.Condition()
+        self.closed = False
+        self.threads = [threading.Thread(target=self._run, name=f"job-worker-{i}", daemon=True)
+                        for i in range(num_workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, payload, priority=0):
+        with self.cond:
+            if self.closed:
+                raise RuntimeError("The job queue is closed.")
+            if self.num_queued >= self.max_queued:
+                raise QueueFull(f"{self.num_queued} jobs are already waiting.")
+            job = Job(payload, priority)
+            job.sort_key = (-priority, next(self.counter))
+            self.jobs[job.id] = job
+            heapq.heappush(self.heap, (*job.sort_key, job))
+            self.num_queued += 1
+            self.cond.notify_all()
+        return job
+
+    def get(self, job_id):
+        with self.cond:
+            return self.jobs.get(job_id)
+
+    def position(self, job):
+        """Jobs that run before `job`, None once it left the queue."""
+        with self.cond:
+            if job.status != QUEUED:
+                return None
+            return sum(1 for key, count, queued in self.heap
+                       if queued.status == QUEUED and (key, count) < job.sort_key)
+
+    def cancel(self, job_id):
+        """Cancel a job that has not started yet."""
+        with self.cond:
+            job = self.jobs.get(job_id)
+            if job is None or job.status != QUEUED:
+                return False
+            job.status = CANCELLED
+            job.finished = time.time()
+            self.num_queued -= 1
+            self._evict()
+            self.cond.notify_all()
+            return True
+
+    def stats(self):
+        """Waiting and running jobs."""
+        with self.cond:
+            running = sum(1 for job in self.jobs.values() if job.status == RUNNING)
+            return {"queued": self.num_queued, "running": running}
+
+    def wait(self, job, timeout=None):
+        """Block until `job` finished, return whether it did."""
+        with self.cond:
+            return self.cond.wait_for(lambda: job.status in (DONE, FAILED, CANCELLED), timeout)
+
+    def _next_job(self):
+        with self.cond:
+            while True:
+                while self.heap and self.heap[0][2].status != QUEUED:
+                    # cancelled while waiting
+                    heapq.heappop(self.heap)
+                if self.heap:
+                    job = heapq.heappop(self.heap)[2]
+                    self.num_queued -= 1
+                    job.status = RUNNING
+                    job.started = time.time()
+                    return job
+                if self.closed:
+                    return None
+                self.cond.wait()
+
+    def _run(self):
+        while True:
+            job = self._next_job()
+            if job is None:
+                break
+            try:
+                result = self.run_fn(job)
+            except Exception as e:
+                logger.exception(f"Job {job.id} failed")
+                status, result, error = FAILED, None, f"{type(e).__name__}: {e}"
+            else:
+                status, error = DONE, None
+                if isinstance(result, dict) and result.get("errCode", 0) != 0:
+                    status = CANCELLED if job.cancel_requested.is_set() else FAILED
+                    error = f"errCode {result['errCode']}: {result.get('info')}"
+            with self.cond:
+                job.status, job.result, job.error = status, result, error
+                job.finished = time.time()
+                self._evict()
+                self.cond.notify_all()
+
+    def _evict(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job.finished is not None]
+        for job_id in finished[:max(len(finished) - self.keep_finished, 0)]:
+            del self.jobs[job_id]
+
+    def close(self, wait=True):
+        """Run the queued jobs and stop the workers."""
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        if wait:
+            for thread in self.threads:
+                thread.join()
+
+
+class StepProgressCallback:
+    """
+    `callback_on_step_end` hook reporting `on_progress(step, total_steps)` to a job, then running `inner` (e.g. a
+    `LatentPreviewCallback`). If `should_abort()` returns True the pipeline is interrupted.
+    """
+    def __init__(self, on_progress, inner=None, should_abort=None):
+        self.on_progress = on_progress
+        self.inner = inner
+        self.should_abort = should_abort
+        self.tensor_inputs = list(inner.tensor_inputs) if inner is not None else []
+
+    def __call__(self, pipeline, step, timestep, callback_kwargs):
+        self.on_progress(step + 1, pipeline.num_timesteps)
+        if self.should_abort is not None and self.should_abort():
+            pipeline._interrupt = True
+        if self.inner is not None:
+            return self.inner(pipeline, step, timestep, callback_kwargs)
+        return {}
@@ -1,34 +1,17 @@
 import os
 import io
-import math
-import uuid
 import base64
 import imageio
 import torch
 import torchvision
 from PIL import Image
 import numpy as np
-from copy import deepcopy
 from einops import rearrange
-import torchvision.transforms as transforms
-from torchvision.transforms import ToPILImage
-from hymm_sp.data_kits.audio_dataset import get_audio_feature
-
-TEMP_DIR = "./temp"
-if not os.path.exists(TEMP_DIR):
-    os.makedirs(TEMP_DIR, exist_ok=True)
+from hymm_sp.data_kits.audio_dataset import get_audio_feature, preprocess_ref_image
 
 
 def data_preprocess_server(args, image_path, audio_path, prompts, feature_extractor):
-    llava_transform = transforms.Compose(
-            [
-                transforms.Resize((336, 336), interpolation=transforms.InterpolationMode.BILINEAR), 
-                transforms.ToTensor(), 
-                transforms.Normalize((0.48145466, 0.4578275, 0.4082107), (0.26862954, 0.26130258, 0.27577711)),
-            ]
-        )
-    
-    """ 生成prompt """
+    """ 生成prompt. `image_path` and `audio_path` are paths, or the uploaded files as bytes. """
     if prompts is None:
         prompts = "Authentic, Realistic, Natural, High-quality, Lens-Fixed." 
     else:
@@ -36,26 +19,7 @@ def data_preprocess_server(args, image_path, audio_path, prompts, feature_extrac
 
     fps = 25
     
-    img_size = args.image_size
-    ref_image = Image.open(image_path).convert('RGB')
-    
-    # Resize reference image
-    w, h = ref_image.size
-    scale = img_size / min(w, h)
-    new_w = round(w * scale / 64) * 64
-    new_h = round(h * scale / 64) * 64
-
-    if img_size == 704:
-        img_size_long = 1216
-    if new_w * new_h > img_size * img_size_long:
-        scale = math.sqrt(img_size * img_size_long / w / h)
-        new_w = round(w * scale / 64) * 64
-        new_h = round(h * scale / 64) * 64
-
-    ref_image = ref_image.resize((new_w, new_h), Image.LANCZOS)
-    
-    ref_image = np.array(ref_image)
-    ref_image = torch.from_numpy(ref_image)
+    pixel_value_ref, pixel_value_ref_llava = preprocess_ref_image(image_path, args.image_size)
         
     audio_input, audio_len = get_audio_feature(feature_extractor, audio_path)
     audio_prompts = audio_input[0]
@@ -66,16 +30,11 @@ def data_preprocess_server(args, image_path, audio_path, prompts, feature_extrac
     motion_bucket_id_exps = torch.from_numpy(motion_bucket_id_exps)
     fps = torch.from_numpy(np.array(fps))
     
-    to_pil = ToPILImage()
-    pixel_value_ref = rearrange(ref_image.clone().unsqueeze(0), "b h w c -> b c h w")   # (b c h w)
-    
-    pixel_value_ref_llava = [llava_transform(to_pil(image)) for image in pixel_value_ref]
-    pixel_value_ref_llava = torch.stack(pixel_value_ref_llava, dim=0)
-
     batch = {
         "text_prompt": [prompts],
-        "audio_path": [audio_path],
-        "image_path": [image_path],
+        # uploads are passed as bytes, only their paths are worth logging and broadcasting
+        "audio_path": [audio_path if isinstance(audio_path, str) else "<upload>"],
+        "image_path": [image_path if isinstance(image_path, str) else "<upload>"],
         "fps": fps.unsqueeze(0).to(dtype=torch.float16),
         "audio_prompts": audio_prompts.unsqueeze(0).to(dtype=torch.float16),
         "audio_len": [audio_len],
@@ -176,149 +135,22 @@ def decode_base64_to_video(base64_buffer_str):
         return None
 
     
-def save_video_base64_to_local(video_path=None, base64_buffer=None, output_video_path=None):
-    if video_path is not None and base64_buffer is None:
-        video_buffer_base64 = encode_video_to_base64(video_path)
-    elif video_path is None and base64_buffer is not None:
-        video_buffer_base64 = deepcopy(base64_buffer)
-    else:
-        print("Please pass either 'video_path' or 'base64_buffer'")
-        return None
-    
-    if video_buffer_base64 is not None:
-        video_data = base64.b64decode(video_buffer_base64)
-        if output_video_path is None:
-            uuid_string = str(uuid.uuid4())
-            temp_video_path = f'{TEMP_DIR}/{uuid_string}.mp4'
-        else:
-            temp_video_path = output_video_path
-        with open(temp_video_path, 'wb') as video_file:
-            video_file.write(video_data)
-        return temp_video_path
-    else:
-        return None
-    
-def save_audio_base64_to_local(audio_path=None, base64_buffer=None):
-    if audio_path is not None and base64_buffer is None:
-        audio_buffer_base64 = encode_wav_to_base64(audio_path)
-    elif audio_path is None and base64_buffer is not None:
-        audio_buffer_base64 = deepcopy(base64_buffer)
-    else:
-        print("Please pass either 'audio_path' or 'base64_buffer'")
-        return None
-    
-    if audio_buffer_base64 is not None:
-        audio_data = base64.b64decode(audio_buffer_base64)
-        uuid_string = str(uuid.uuid4())
-        temp_audio_path = f'{TEMP_DIR}/{uuid_string}.wav'
-        with open(temp_audio_path, 'wb') as audio_file:
-            audio_file.write(audio_data)
-        return temp_audio_path
-    else:
-        return None
-    
-def save_pkl_base64_to_local(pkl_path=None, base64_buffer=None):
-    if pkl_path is not None and base64_buffer is None:
-        pkl_buffer_base64 = encode_pkl_to_base64(pkl_path)
-    elif pkl_path is None and base64_buffer is not None:
-        pkl_buffer_base64 = deepcopy(base64_buffer)
-    else:
-        print("Please pass either 'pkl_path' or 'base64_buffer'")
-        return None
-    
-    if pkl_buffer_base64 is not None:
-        pkl_data = base64.b64decode(pkl_buffer_base64)
-        uuid_string = str(uuid.uuid4())
-        temp_pkl_path = f'{TEMP_DIR}/{uuid_string}.pkl'
-        with open(temp_pkl_path, 'wb') as pkl_file:
-            pkl_file.write(pkl_data)
-        return temp_pkl_path
-    else:
-        return None
-    
-def remove_temp_fles(input_dict):
-    for key, val in input_dict.items():
-        if "_path" in key and val is not None and os.path.exists(val):
-            os.remove(val)
-            print(f"Remove temporary {key} from {val}")
-
-def process_output_dict(output_dict):
-
-    uuid_string = str(uuid.uuid4())
-    temp_video_path = f'{TEMP_DIR}/{uuid_string}.mp4'
-    imageio.mimsave(temp_video_path, output_dict["video"], fps=output_dict.get("save_fps", 25))
-
-    # Add audio
-    if output_dict["audio"] is not None and os.path.exists(output_dict["audio"]):
-        output_path = temp_video_path
-        audio_path = output_dict["audio"]
-        save_path = temp_video_path.replace(".mp4", "_audio.mp4")
-        print('='*100)
-        print(f"output_path = {output_path}\n audio_path = {audio_path}\n save_path = {save_path}")
-        os.system(f"ffmpeg -i '{output_path}' -i '{audio_path}' -shortest '{save_path}' -y -loglevel quiet; rm '{output_path}'")
-    else:
-        save_path = temp_video_path
-
-    video_base64_buffer = encode_video_to_base64(save_path)
-
-    encoded_output_dict = {
-        "errCode": output_dict["err_code"], 
-        "content": [
-                    {
-                        "buffer": video_base64_buffer
-                    },
-                ],
-        "info":output_dict["err_msg"],
-    }
-    
-    
-
-    return encoded_output_dict
-
-
-def save_image_base64_to_local(image_path=None, base64_buffer=None):
-    # Encode image to base64 buffer
-    if image_path is not None and base64_buffer is None:
-        image_buffer_base64 = encode_image_to_base64(image_path)
-    elif image_path is None and base64_buffer is not None:
-        image_buffer_base64 = deepcopy(base64_buffer)
-    else:
-        print("Please pass either 'image_path' or 'base64_buffer'")
-        return None
-    
-    # Decode base64 buffer and save to local disk
-    if image_buffer_base64 is not None:
-        image_data = base64.b64decode(image_buffer_base64)
-        uuid_string = str(uuid.uuid4())
-        temp_image_path = f'{TEMP_DIR}/{uuid_string}.png'
-        with open(temp_image_path, 'wb') as image_file:
-            image_file.write(image_data)
-        return temp_image_path
-    else:
-        return None
-    
 def process_input_dict(input_dict):
-    
+    """
+    Request fields to the generation inputs. The image and audio stay in memory as bytes: raw from a multipart
+    upload (`image_bytes`, `audio_bytes`) or decoded from the base64 JSON fields (`image_buffer`, `audio_buffer`).
+    """
     decoded_input_dict = {}
    
     decoded_input_dict["save_fps"] = input_dict.get("save_fps", 25)
 
-    image_base64_buffer = input_dict.get("image_buffer", None)
-    if image_base64_buffer is not None:
-        decoded_input_dict["image_path"] = save_image_base64_to_local(
-            image_path=None, 
-            base64_buffer=image_base64_buffer)
-    else:
-        decoded_input_dict["image_path"] = None
-    
-    audio_base64_buffer = input_dict.get("audio_buffer", None)
-    if audio_base64_buffer is not None:
-        decoded_input_dict["audio_path"] = save_audio_base64_to_local(
-            audio_path=None, 
-            base64_buffer=audio_base64_buffer)
-    else:
-        decoded_input_dict["audio_path"] = None
+    for name in ("image", "audio"):
+        data = input_dict.get(f"{name}_bytes", None)
+        if data is None and input_dict.get(f"{name}_buffer", None) is not None:
+            data = base64.b64decode(input_dict[f"{name}_buffer"])
+        decoded_input_dict[f"{name}_path"] = data
     
     decoded_input_dict["prompt"] = input_dict.get("text", None)
+    decoded_input_dict["negative_prompt"] = input_dict.get("negative_text", None)
         
-    return decoded_input_dict
\ No newline at end of file
+    return decoded_input_dict
@@ -0,0 +1,107 @@
+"""
+Request fan-out from rank 0 to the other ranks of the sequence-parallel server.
+
+`dist.broadcast_object_list` pickles the whole preprocessed batch on rank 0, reference images and audio features
+included, and every rank unpickles it again. `RequestChannel.send` instead broadcasts a small header, the request
+with each tensor replaced by its shape and dtype, and then the tensors themselves with `dist.broadcast` on the device,
+into buffers the receivers allocate from the header.
+
+The header goes over a gloo group, so between requests the other ranks block in `recv` on the CPU rather than in an
+NCCL collective.
+
+    channel = RequestChannel(device)       # on every rank, after init_process_group
+    if rank == 0:
+        channel.send(params)
+    else:
+        params = channel.recv()            # None once rank 0 called channel.close()
+"""
+import datetime
+
+import torch
+import torch.distributed as dist
+
+
+class _TensorRef:
+    """Placeholder of the `index`-th tensor of a request in its header."""
+    __slots__ = ("index",)
+
+    def __init__(self, index):
+        self.index = index
+
+
+def pack_request(request):
+    """
+    Split `request` (nested lists, tuples and dicts) into a picklable header and its tensors.
+
+    Returns:
+        header (tuple): The request with `_TensorRef` placeholders, and the (shape, dtype, device type) of each tensor.
+        tensors (list[torch.Tensor]): The tensors, in placeholder order.
+    """
+    tensors = []
+
+    def pack(value):
+        if isinstance(value, torch.Tensor):
+            tensors.append(value)
+            return _TensorRef(len(tensors) - 1)
+        if type(value) in (list, tuple):
+            return type(value)(pack(v) for v in value)
+        if type(value) is dict:
+            return {k: pack(v) for k, v in value.items()}
+        return value
+
+    structure = pack(request)
+    specs = [(tuple(t.shape), t.dtype, t.device.type) for t in tensors]
+    return (structure, specs), tensors
+
+
+def unpack_request(structure, tensors):
+    """Put `tensors` back in place of the placeholders of `structure`."""
+    if isinstance(structure, _TensorRef):
+        return tensors[structure.index]
+    if type(structure) in (list, tuple):
+        return type(structure)(unpack_request(v, tensors) for v in structure)
+    if type(structure) is dict:
+        return {k: unpack_request(v, tensors) for k, v in structure.items()}
+    return structure
+
+
+class RequestChannel:
+    """
+    Broadcasts requests from `src` to all the other ranks. Collective: every rank has to create it, in the same order
+    relative to the other process groups.
+
+    Args:
+        device (torch.device): Device the tensors are broadcast on, the rank's GPU under NCCL.
+        src (int): Sending rank.
+        timeout (datetime.timedelta): Timeout of the control group, the other ranks wait that long for a request.
+    """
+    def __init__(self, device, src=0, timeout=datetime.timedelta(seconds=2**31-1)):
+        self.device = torch.device(device)
+        self.src = src
+        self.control_group = dist.new_group(backend="gloo", timeout=timeout)
+
+    def send(self, request):
+        """Broadcast `request`, on rank `src`."""
+        header, tensors = pack_request(request)
+        dist.broadcast_object_list([header], src=self.src, group=self.control_group)
+        for tensor in tensors:
+            dist.broadcast(tensor.to(self.device).contiguous(), src=self.src)
+
+    def recv(self):
+        """Block until the next request of rank `src` and return it, None once the channel is closed."""
+        message = [None]
+        dist.broadcast_object_list(message, src=self.src, group=self.control_group)
+        if message[0] is None:
+            return None
+        structure, specs = message[0]
+        tensors = []
+        for shape, dtype, device_type in specs:
+            tensor = torch.empty(shape, dtype=dtype, device=self.device)
+            dist.broadcast(tensor, src=self.src)
+            # same placement as on rank `src`, so every rank runs the request alike
+            tensors.append(tensor.cpu() if device_type == "cpu" else tensor)
+        return unpack_request(structure, tensors)
+
+    def close(self):
+        """Make `recv` return None on the other ranks, on rank `src`."""
+        dist.broadcast_object_list([None], src=self.src, group=self.control_group)
@@ -0,0 +1,176 @@
+"""
+Stage-pipelined execution of the server jobs.
+
+Each stage runs on its own worker threads and hands its result to the next one through a bounded queue, so the CPU
+preprocessing of the next jobs and the output of the previous one overlap with the job on the GPU:
+
+    executor = StagedExecutor([
+        Stage("preprocess", preprocess, num_workers=2),
+        Stage("generate", generate),            # one job at a time on the GPU
+        Stage("output", output),
+    ], max_queued=2)
+    result = executor.submit(job).result()
+
+A stage returns the input of the next one, or `Finished(result)` to skip the remaining stages. `metrics()` reports the
+queue depth, the busy workers and the latencies of every stage.
+"""
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from loguru import logger
+
+
+class Finished:
+    """Returned by a stage to skip the remaining ones, with `result` as the result of the item."""
+    def __init__(self, result):
+        self.result = result
+
+
+class Stage:
+    """
+    A step of the pipeline.
+
+    Args:
+        name (str): Name in the metrics and passed to `on_stage`.
+        fn (callable): `fn(value)` returns the value of the next stage, the first stage gets the submitted item.
+        num_workers (int): Threads running `fn`.
+    """
+    def __init__(self, name, fn, num_workers=1):
+        self.name = name
+        self.fn = fn
+        self.num_workers = num_workers
+
+
+class StageMetrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.busy = 0
+        self.processed = 0
+        self.failed = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.last_time = None
+        self.total_wait = 0.0
+
+    def start(self, wait):
+        with self.lock:
+            self.busy += 1
+            self.total_wait += wait
+
+    def finish(self, elapsed, failed=False):
+        with self.lock:
+            self.busy -= 1
+            self.processed += 1
+            self.failed += failed
+            self.total_time += elapsed
+            self.max_time = max(self.max_time, elapsed)
+            self.last_time = elapsed
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                "busy": self.busy,
+                "processed": self.processed,
+                "failed": self.failed,
+                "latency_avg": self.total_time / self.processed if self.processed else None,
+                "latency_max": self.max_time if self.processed else None,
+                "latency_last": self.last_time,
+                "wait_avg": self.total_wait / self.processed if self.processed else None,
+            }
+
+
+class _Task:
+    __slots__ = ("value", "future", "on_stage", "enqueued")
+
+    def __init__(self, value, future, on_stage):
+        self.value = value
+        self.future = future
+        self.on_stage = on_stage
+        self.enqueued = time.monotonic()
+
+
+class StagedExecutor:
+    """
+    Runs the submitted items through `stages` in order. At most `max_queued` items wait in front of each stage,
+    further hand-offs block, which bounds the preprocessed inputs and outputs kept alive.
+
+    A stage with a single worker takes its items in the order they reach it.
+    """
+    def __init__(self, stages, max_queued=2):
+        self.stages = stages
+        self.queues = [queue.Queue(maxsize=max_queued) for _ in stages]
+        self.stage_metrics = [StageMetrics() for _ in stages]
+        self.threads = [[threading.Thread(target=self._run, args=(index,), name=f"stage-{stage.name}-{i}",
+                                          daemon=True) for i in range(stage.num_workers)]
+                        for index, stage in enumerate(stages)]
+        self.closed = False
+        for threads in self.threads:
+            for thread in threads:
+                thread.start()
+
+    def submit(self, item, on_stage=None):
+        """
+        Queue `item` for the first stage, blocking while its queue is full.
+
+        Returns:
+            concurrent.futures.Future: Holds what the last stage returns, or the `Finished` result, or the exception
+                of the failing stage. `on_stage(name)` is called as the item is handed to each stage, before it waits
+                in the stage's queue, so the name is the stage the item is in or waiting for.
+        """
+        if self.closed:
+            raise RuntimeError("The staged executor is closed.")
+        future = Future()
+        future.set_running_or_notify_cancel()
+        task = _Task(item, future, on_stage)
+        self._hand_off(0, task)
+        return future
+
+    def _hand_off(self, index, task):
+        if task.on_stage is not None:
+            task.on_stage(self.stages[index].name)
+        task.enqueued = time.monotonic()
+        self.queues[index].put(task)
+
+    def _run(self, index):
+        stage, metrics = self.stages[index], self.stage_metrics[index]
+        while True:
+            task = self.queues[index].get()
+            if task is None:
+                break
+            start = time.monotonic()
+            metrics.start(start - task.enqueued)
+            try:
+                value = stage.fn(task.value)
+            except BaseException as e:
+                logger.exception(f"Stage {stage.name} failed")
+                metrics.finish(time.monotonic() - start, failed=True)
+                task.future.set_exception(e)
+                continue
+            metrics.finish(time.monotonic() - start)
+            if isinstance(value, Finished):
+                task.future.set_result(value.result)
+            elif index + 1 == len(self.stages):
+                task.future.set_result(value)
+            else:
+                task.value = value
+                self._hand_off(index + 1, task)
+
+    def metrics(self):
+        """Queue depth, busy workers, processed and failed items and latencies in seconds of every stage."""
+        return {
+            stage.name: {"queued": q.qsize(), "workers": stage.num_workers, **metrics.to_dict()}
+            for stage, q, metrics in zip(self.stages, self.queues, self.stage_metrics)
+        }
+
+    def close(self, wait=True):
+        """Finish the submitted items and stop the workers, stage by stage."""
+        self.closed = True
+        for q, stage, threads in zip(self.queues, self.stages, self.threads):
+            for _ in range(stage.num_workers):
+                q.put(None)
+            if not wait:
+                continue
+            for thread in threads:
+                thread.join()
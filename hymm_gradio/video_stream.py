@@ -0,0 +1,47 @@
+"""
+Fragmented MP4 of a job, readable while the output stage is still encoding it.
+
+The output stage appends the fragments of `iter_video_bytes` as the decoded chunks are encoded. `GET
+/jobs/{id}/video` streams them with chunked transfer from the first fragment, and the finished file stays available
+for later downloads and `/predict2`.
+"""
+import threading
+
+
+class VideoStream:
+    def __init__(self):
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self.cond = threading.Condition()
+
+    def append(self, data):
+        with self.cond:
+            self.chunks.append(data)
+            self.cond.notify_all()
+
+    def finish(self, error=None):
+        """Mark the video complete, or failed with `error`: readers stop after the fragments they got."""
+        with self.cond:
+            self.done, self.error = True, error
+            self.cond.notify_all()
+
+    def iter_bytes(self, timeout=None):
+        """Yield the fragments from the first one, waiting for the next ones until the video is finished."""
+        index = 0
+        while True:
+            with self.cond:
+                if not self.cond.wait_for(lambda: index < len(self.chunks) or self.done, timeout):
+                    raise TimeoutError("No video fragment within the timeout.")
+                chunks = self.chunks[index:]
+                done, error = self.done, self.error
+            index += len(chunks)
+            yield from chunks
+            if done:
+                if error is not None:
+                    raise RuntimeError(f"Video encoding failed: {error}")
+                return
+
+    def getvalue(self, timeout=None):
+        """The whole MP4, once finished."""
+        return b"".join(self.iter_bytes(timeout))
@@ -281,14 +281,14 @@ def generate_avatar_video(image, audio, prompt, progress=gr.Progress()):
         
         # Check audio length
         try:
-            import librosa
-            audio_data, sr = librosa.load(audio_path, sr=16000)
-            audio_duration = len(audio_data) / sr
+            from hymm_sp.data_kits.audio_io import get_audio_duration
+            # header only, the audio is decoded once by the pipeline
+            audio_duration = get_audio_duration(audio_path)
             
             if audio_duration > settings['max_audio_length']:
                 return None, f"❌ Audio too long ({audio_duration:.1f}s). Max length for {current_vram_mode} mode: {settings['max_audio_length']}s"
         except:
-            pass  # Skip validation if librosa not available
+            pass  # Skip validation if the audio libraries are not available
         
         progress(0.4, "Starting generation...")
         
@@ -349,7 +349,7 @@ def generate_avatar_video(image, audio, prompt, progress=gr.Progress()):
 def create_demo_video(output_path, image_path, audio_path, settings):
     """Create a demo video for testing purposes."""
     # This is a placeholder - in reality this would be the actual video generation
-    import imageio
+    from hymm_sp.data_kits.video_writer import write_video
     
     # Load the image
     image = cv2.imread(image_path)
@@ -359,26 +359,20 @@ def create_demo_video(output_path, image_path, audio_path, settings):
     # Resize image to match settings
     image = cv2.resize(image, (settings['image_size'], settings['image_size']))
     
-    # Create frames (simple animation)
-    frames = []
-    for i in range(settings['video_length']):
-        frame = image.copy()
-        # Add simple animation (fade effect)
-        alpha = 0.8 + 0.2 * np.sin(i * 0.5)
-        frame = (frame * alpha).astype(np.uint8)
-        frames.append(frame)
+    image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
     
-    # Save video
-    imageio.mimsave(output_path, frames, fps=25)
+    # Create frames (simple animation), generated as the writer takes them
+    def frames():
+        for i in range(settings['video_length']):
+            # Add simple animation (fade effect)
+            alpha = 0.8 + 0.2 * np.sin(i * 0.5)
+            yield (image * alpha).astype(np.uint8)
     
-    # Add audio using ffmpeg if available
+    # Save video with its audio in one pass
     try:
-        temp_video = output_path + "_temp.mp4"
-        os.rename(output_path, temp_video)
-        os.system(f"ffmpeg -i '{temp_video}' -i '{audio_path}' -shortest '{output_path}' -y -loglevel quiet")
-        os.remove(temp_video)
-    except:
-        pass  # If ffmpeg fails, keep video without audio
+        write_video(output_path, frames(), 25, audio=audio_path)
+    except Exception:
+        write_video(output_path, frames(), 25)  # If the audio cannot be read, keep video without audio
 
 def refresh_system_info():
     """Refresh system information display."""
@@ -1,5 +1,7 @@
 import math
 import time
+import contextlib
+import threading
 import torch
 import random
 from loguru import logger
@@ -7,8 +9,14 @@ from einops import rearrange
 from hymm_sp.diffusion import load_diffusion_pipeline
 from hymm_sp.helpers import get_nd_rotary_pos_embed_new
 from hymm_sp.inference import Inference
+from hymm_sp.constants import NEGATIVE_PROMPT
+from hymm_sp.decode_worker import DecodeWorker
+from hymm_sp.whisper_batcher import WhisperBatcher
+from hymm_sp.cache import configure_caches_from_args, get_cache, hash_tensor, make_key
+from hymm_sp.vae.vae import DiagonalGaussianDistribution
 from hymm_sp.diffusion.schedulers import FlowMatchDiscreteScheduler
-from hymm_sp.data_kits.audio_preprocessor import encode_audio, get_facemask
+from hymm_sp.data_kits.audio_preprocessor import AudioWindows, get_audio_hidden_states, get_facemask
+from hymm_sp.modules.parallel_states import nccl_info
 
 def align_to(value, alignment):
     return int(math.ceil(value / alignment) * alignment)
@@ -23,8 +31,181 @@ class HunyuanVideoSampler(Inference):
         self.pipeline = load_diffusion_pipeline(
             args, 0, self.vae, self.text_encoder, self.text_encoder_2, self.model,
             device=self.device)
+        if args.vae_parallel_decode and nccl_info.sp_size > 1:
+            self.vae.enable_dist_decode(group=nccl_info.group)
+        if args.vae_tile_budget is not None:
+            self.vae.enable_auto_tiling(int(args.vae_tile_budget * 1024 ** 3), calibrate=args.vae_tile_calibrate)
+        configure_caches_from_args(args)
+        if args.cache_image_features:
+            self.text_encoder.enable_image_feature_cache(get_cache("llava_image_features"))
+        if args.cache_prompt_embeds:
+            for text_encoder in (self.text_encoder, self.text_encoder_2):
+                if text_encoder is not None:
+                    text_encoder.enable_prompt_cache(get_cache("prompt_embeds"))
+        self.negative_prompt_embeds_2 = self.negative_attention_mask_2 = None
+        if self.text_encoder_2 is not None:
+            self.negative_prompt_embeds_2, self.negative_attention_mask_2 = self.encode_negative_prompt_2(NEGATIVE_PROMPT)
+        self.vae_lock = threading.Lock()
+        self.decode_worker = None
+        self.stream_decode = False
+        self.whisper_lock = threading.Lock()
+        self.audio_batcher = None
+        if args.async_vae_decode:
+            self.enable_decode_worker()
+        if args.stream_vae_decode:
+            self.enable_stream_decode()
         print('load hunyuan model successful... ')
 
+    def enable_decode_worker(self, max_pending=2):
+        """
+        Decode on a background thread: `predict` then returns `samples_future` instead of `samples`, and the next
+        call can start denoising while the previous video decodes.
+
+        Not enabled with `--cpu-offload`: the worker would bring the VAE decoder to the GPU while the DiT of the next
+        job is there, the peak memory offloading is meant to avoid. Serializing the two would leave nothing to
+        overlap, so the videos are decoded inline instead.
+        """
+        if nccl_info.sp_size > 1:
+            # every rank has to take part in each decode, in the same order as the denoising
+            logger.warning("Async VAE decoding is not supported with sequence parallelism, decoding inline.")
+            return
+        if self.args.cpu_offload:
+            logger.warning("Async VAE decoding is not supported with --cpu-offload, decoding inline.")
+            return
+        if self.decode_worker is None:
+            self.decode_worker = DecodeWorker(self.pipeline, max_pending=max_pending, lock=self.vae_lock)
+
+    def disable_decode_worker(self):
+        if self.decode_worker is not None:
+            self.decode_worker.close()
+            self.decode_worker = None
+
+    def enable_stream_decode(self):
+        """
+        Leave the decode to the caller: `predict` then returns `samples_stream`, a generator of the decoded video in
+        chunks along time (see `stream_samples`), which also takes precedence over the decode worker.
+        """
+        if nccl_info.sp_size > 1:
+            logger.warning("Streaming VAE decoding is not supported with sequence parallelism, decoding inline.")
+            return
+        self.stream_decode = True
+
+    def stream_samples(self, latents, **decode_kwargs):
+        """
+        Generator of the (b, c, t, h, w) float32 CPU chunks of the video of denoised `latents`, decoded as it is
+        iterated, typically by a writer thread feeding an encoder. It holds the VAE lock until exhausted or closed and
+        decodes on its own CUDA stream, ordered after the work that produced the latents.
+        """
+        ready = None
+        if latents.is_cuda:
+            ready = torch.cuda.Event()
+            ready.record(torch.cuda.current_stream(latents.device))
+
+        def chunks():
+            with torch.no_grad(), self.vae_lock:
+                stream = contextlib.nullcontext()
+                if ready is not None:
+                    stream = torch.cuda.Stream(latents.device)
+                    stream.wait_event(ready)
+                    latents.record_stream(stream)
+                    stream = torch.cuda.stream(stream)
+                with stream:
+                    yield from self.pipeline.stream_video_latents(latents, **decode_kwargs)
+        return chunks()
+
+    def enable_audio_batcher(self, wav2vec, max_windows=8, max_wait=0.005):
+        """
+        Encode the audio of concurrent `encode_audio_hidden_states` calls in shared Whisper batches. `wav2vec` has to
+        be the model passed to `predict`.
+        """
+        if self.audio_batcher is None:
+            self.audio_batcher = WhisperBatcher(wav2vec, max_windows=max_windows, max_wait=max_wait,
+                                                lock=self.whisper_lock)
+
+    def disable_audio_batcher(self):
+        if self.audio_batcher is not None:
+            self.audio_batcher.close()
+            self.audio_batcher = None
+
+    def encode_audio_hidden_states(self, wav2vec, audio_feats):
+        """
+        Stitched Whisper hidden states of the log-mel features (n_mels, T) of one track, through the audio batcher
+        when enabled. Safe to call from other threads than `predict`, e.g. the preprocess workers of the server.
+        """
+        return get_audio_hidden_states(wav2vec, audio_feats, cache=get_cache("audio_hidden_states"),
+                                       batcher=self.audio_batcher, lock=self.whisper_lock)
+
+    def encode_ref_latents(self, pixel_value_ref, uncond_pixel_value_ref, ref_image_hash, cpu_offload=0):
+        """
+        Scaled VAE latents of the (b, c, f, h, w) reference frames and of the blank reference, both in [-1, 1].
+
+        The posterior parameters are cached and sampled per request, so hits draw fresh latents like misses do. The VAE
+        lock is only taken to encode on a cache miss: a hit does not wait for a decode running on another thread.
+        """
+        vae_dtype = self.vae.dtype
+        latent_cache = get_cache("ref_latents")
+        vae_settings = (self.args.vae, str(vae_dtype), tuple(pixel_value_ref.shape))
+        ref_key = make_key("ref_latents", ref_image_hash, vae_settings)
+        uncond_key = make_key("uncond_ref_latents", vae_settings)
+        ref_moments = latent_cache.get(ref_key, device=self.device)
+        uncond_ref_moments = latent_cache.get(uncond_key, device=self.device)
+        if ref_moments is None or uncond_ref_moments is None:
+            autocast = torch.autocast(device_type="cuda", dtype=vae_dtype, enabled=vae_dtype != torch.float32)
+            with self.vae_lock, autocast, self.vae.thread_tiling():
+                if cpu_offload:
+                    self.vae.to('cuda')
+
+                self.vae.enable_tiling()
+                if ref_moments is None:
+                    ref_moments = latent_cache.put(
+                        ref_key, self.vae.encode(pixel_value_ref.clone()).latent_dist.parameters)
+                if uncond_ref_moments is None:
+                    uncond_ref_moments = latent_cache.put(
+                        uncond_key, self.vae.encode(uncond_pixel_value_ref).latent_dist.parameters)
+
+                if cpu_offload:
+                    self.vae.to('cpu')
+                    torch.cuda.empty_cache()
+
+        ref_latents = DiagonalGaussianDistribution(ref_moments).sample()
+        uncond_ref_latents = DiagonalGaussianDistribution(uncond_ref_moments).sample()
+        if hasattr(self.vae.config, 'shift_factor') and self.vae.config.shift_factor:
+            ref_latents.sub_(self.vae.config.shift_factor).mul_(self.vae.config.scaling_factor)
+            uncond_ref_latents.sub_(self.vae.config.shift_factor).mul_(self.vae.config.scaling_factor)
+        else:
+            ref_latents.mul_(self.vae.config.scaling_factor)
+            uncond_ref_latents.mul_(self.vae.config.scaling_factor)
+        return ref_latents, uncond_ref_latents
+
+    def encode_negative_prompt_2(self, negative_prompt):
+        """
+        Device-resident `text_encoder_2` (CLIP) embeddings of a negative prompt. They only depend on the text, unlike
+        the LLaVA negative which also sees the reference image and goes through the prompt cache per request.
+        """
+        embeds, mask = self.text_encoder_2.encode_prompt(negative_prompt)
+        return embeds.to(self.device), mask.to(self.device) if mask is not None else None
+
+    def preencode_prompts(self, prompts, pixel_values_llava, negative_prompt=None, batch_size=8):
+        """
+        Encode the prompts of many requests into the prompt cache with batched forwards, so `predict` finds them
+        there. Takes the same inputs as `predict`: the prompt and (1, 3, 336, 336) LLaVA image of each request.
+        """
+        if self.text_encoder.prompt_cache is None:
+            logger.warning("The prompt cache is disabled (--cache-prompt-embeds 0), not pre-encoding prompts.")
+            return
+        negative_prompt = negative_prompt or NEGATIVE_PROMPT
+        cache = self.text_encoder.prompt_cache
+        needed = len(prompts) * (3 if self.text_encoder_2 is not None else 2)
+        if cache.max_items < needed:
+            logger.warning(f"The prompt cache holds {cache.max_items} entries but pre-encoding needs {needed}, "
+                           f"raise --cache-size or the first prompts get encoded again.")
+        # LLaVA encodes the negative prompt with the reference image too
+        self.text_encoder.encode_prompts(
+            list(prompts) + [negative_prompt] * len(prompts), list(pixel_values_llava) * 2,
+            data_type='video', batch_size=batch_size)
+        if self.text_encoder_2 is not None:
+            self.text_encoder_2.encode_prompts(list(prompts), data_type='image', batch_size=batch_size)
+
     def get_rotary_pos_embed(self, video_length, height, width, concat_dict={}):
         target_ndim = 3
         ndim = 5 - 2
@@ -72,7 +253,7 @@ class HunyuanVideoSampler(Inference):
                 size (int): The (height, width) of the output image/video. Default is (256, 256).
                 video_length (int): The frame number of the output video. Default is 1.
                 seed (int or List[str]): The random seed for the generation. Default is a random integer.
-                negative_prompt (str or List[str]): The negative text prompt. Default is an empty string.
+                negative_prompt (str): Overrides the default negative prompt, encoded through the prompt cache.
                 infer_steps (int): The number of inference steps. Default is 100.
                 guidance_scale (float): The guidance scale for the generation. Default is 6.0.
                 num_videos_per_prompt (int): The number of videos per prompt. Default is 1.    
@@ -86,29 +267,40 @@ class HunyuanVideoSampler(Inference):
         prompt = batch['text_prompt'][0]
         image_path = str(batch["image_path"][0])
         audio_path = str(batch["audio_path"][0])
-        neg_prompt = "Aerial view, aerial view, overexposed, low quality, deformation, a poor composition, bad hands, bad teeth, bad eyes, bad limbs, distortion, blurring, Lens changes"
+        neg_prompt = kwargs.get("negative_prompt") or NEGATIVE_PROMPT
         # videoid = batch['videoid'][0]
         fps = batch["fps"].to(self.device)
-        audio_prompts = batch["audio_prompts"].to(self.device)
-        weight_dtype = audio_prompts.dtype
+        weight_dtype = batch["audio_prompts"].dtype
 
-        audio_prompts = [encode_audio(wav2vec, audio_feat.to(dtype=wav2vec.dtype), fps.item(), num_frames=batch["audio_len"][0]) for audio_feat in audio_prompts]
-        audio_prompts = torch.cat(audio_prompts, dim=0).to(device=self.device, dtype=weight_dtype)
-        if audio_prompts.shape[1] <= 129:
-            audio_prompts = torch.cat([audio_prompts, torch.zeros_like(audio_prompts[:, :1]).repeat(1,129-audio_prompts.shape[1], 1, 1, 1)], dim=1)
-        else:
-            audio_prompts = torch.cat([audio_prompts, torch.zeros_like(audio_prompts[:, :1]).repeat(1, 5, 1, 1, 1)], dim=1)
+        # the server encodes the audio in its preprocess workers, where concurrent requests share Whisper batches;
+        # the states come back (and are cached) on the CPU, only the ones of this request go to the GPU
+        audio_hidden_states = batch.get("audio_hidden_states")
+        if audio_hidden_states is None:
+            audio_hidden_states = torch.cat([self.encode_audio_hidden_states(wav2vec, audio_feat)
+                                             for audio_feat in batch["audio_prompts"].cpu()])
+        num_frames = batch["audio_len"][0]
+        if args.max_audio_frames is not None:
+            num_frames = min(num_frames, args.max_audio_frames)
+        # only the 50 Hz hidden states go to the GPU, the pipeline gathers the per-frame context of each segment;
+        # silence pads the frames to at least 129, or by 5 frames
+        audio_prompts = AudioWindows(audio_hidden_states.to(self.device), fps.item(), num_frames,
+                                     length=129 if num_frames <= 129 else num_frames + 5, dtype=weight_dtype)
         
-        wav2vec.to("cpu")
-        torch.cuda.empty_cache()
+        if args.cpu_offload:
+            # Whisper stays on the GPU unless memory is that tight, it is small next to the DiT
+            with self.whisper_lock:
+                wav2vec.to("cpu")
+            torch.cuda.empty_cache()
 
-        uncond_audio_prompts = torch.zeros_like(audio_prompts[:,:129])
+        uncond_audio_prompts = torch.zeros(audio_prompts.shape[:1] + (129,) + audio_prompts.shape[2:],
+                                           dtype=weight_dtype, device=self.device)
         motion_exp = batch["motion_bucket_id_exps"].to(self.device)
         motion_pose = batch["motion_bucket_id_heads"].to(self.device)
         
+        # Everything derived from the reference image is cached by its content.
+        ref_image_hash = hash_tensor(batch['pixel_value_ref'])
         pixel_value_ref = batch['pixel_value_ref'].to(self.device)  # (b f c h w) 取值范围[0,255]
-        face_masks = get_facemask(pixel_value_ref.clone(), align_instance, area=3.0) 
-
+        face_ref = pixel_value_ref
         pixel_value_ref = pixel_value_ref.clone().repeat(1,129,1,1,1)
         uncond_pixel_value_ref = torch.zeros_like(pixel_value_ref)
         pixel_value_ref = pixel_value_ref / 127.5 - 1.             
@@ -122,31 +314,15 @@ class HunyuanVideoSampler(Inference):
         uncond_pixel_value_llava = pixel_value_llava.clone()
     
         # ========== Encode reference latents ==========
-        vae_dtype = self.vae.dtype
-        with torch.autocast(device_type="cuda", dtype=vae_dtype, enabled=vae_dtype != torch.float32):
-
-            if args.cpu_offload:
-                self.vae.to('cuda')
-
-            self.vae.enable_tiling()
-            ref_latents = self.vae.encode(pixel_value_ref_for_vae.clone()).latent_dist.sample()
-            uncond_ref_latents = self.vae.encode(uncond_uncond_pixel_value_ref).latent_dist.sample()
-            self.vae.disable_tiling()
-            if hasattr(self.vae.config, 'shift_factor') and self.vae.config.shift_factor:
-                ref_latents.sub_(self.vae.config.shift_factor).mul_(self.vae.config.scaling_factor)
-                uncond_ref_latents.sub_(self.vae.config.shift_factor).mul_(self.vae.config.scaling_factor)
-            else:
-                ref_latents.mul_(self.vae.config.scaling_factor)
-                uncond_ref_latents.mul_(self.vae.config.scaling_factor)
-            
-            if args.cpu_offload:
-                self.vae.to('cpu')
-                torch.cuda.empty_cache()
-                
-        face_masks = torch.nn.functional.interpolate(face_masks.float().squeeze(2), 
-                                                (ref_latents.shape[-2], 
-                                                ref_latents.shape[-1]), 
-                                                mode="bilinear").unsqueeze(2).to(dtype=ref_latents.dtype)
+        ref_latents, uncond_ref_latents = self.encode_ref_latents(
+            pixel_value_ref_for_vae, uncond_uncond_pixel_value_ref, ref_image_hash, cpu_offload=args.cpu_offload)
+
+        # rasterized straight at the latent resolution
+        latent_size = (ref_latents.shape[-2], ref_latents.shape[-1])
+        face_masks = get_cache("face_mask").get_or_compute(
+            make_key("face_mask", ref_image_hash, 3.0, latent_size),
+            lambda: get_facemask(face_ref, align_instance, area=3.0, size=latent_size),
+            device=self.device).to(dtype=ref_latents.dtype)
 
 
         size = (batch['pixel_value_ref'].shape[-2], batch['pixel_value_ref'].shape[-1])
@@ -181,6 +357,13 @@ class HunyuanVideoSampler(Inference):
         pipeline_kwargs = {
             "cpu_offload": args.cpu_offload
         }
+        if neg_prompt == NEGATIVE_PROMPT and self.negative_prompt_embeds_2 is not None:
+            pipeline_kwargs["negative_prompt_embeds_2"] = self.negative_prompt_embeds_2
+            pipeline_kwargs["negative_attention_mask_2"] = self.negative_attention_mask_2
+        callback_on_step_end = kwargs.get("callback_on_step_end", None)
+        if callback_on_step_end is not None:
+            pipeline_kwargs["callback_on_step_end"] = callback_on_step_end
+            pipeline_kwargs["callback_on_step_end_tensor_inputs"] = callback_on_step_end.tensor_inputs
         start_time = time.time()
         samples = self.pipeline(prompt=prompt,                                
                                 height=target_height,
@@ -209,7 +392,7 @@ class HunyuanVideoSampler(Inference):
                                 attention_mask=None,
                                 negative_prompt_embeds=None,
                                 negative_attention_mask=None,
-                                output_type="pil",
+                                output_type="latent" if self.decode_worker is not None or self.stream_decode else "pil",
                                 freqs_cis=(freqs_cos, freqs_sin),
                                 n_tokens=n_tokens,
                                 data_type='video',
@@ -218,13 +401,22 @@ class HunyuanVideoSampler(Inference):
                                 enable_tiling=self.args.vae_tiling,
                                 **pipeline_kwargs
                                 )[0]
+        if args.cpu_offload:
+            with self.whisper_lock:
+                wav2vec.to(self.device)
         if samples is None:
+            # only rank 0 receives the decoded video when decoding is sharded
             return None
-        out_dict['samples'] = samples
+        if self.stream_decode:
+            out_dict['samples_stream'] = self.stream_samples(
+                samples, enable_tiling=self.args.vae_tiling, cpu_offload=args.cpu_offload)
+        elif self.decode_worker is not None:
+            out_dict['samples_future'] = self.decode_worker.submit(
+                samples, enable_tiling=self.args.vae_tiling, generator=generator, cpu_offload=args.cpu_offload)
+        else:
+            out_dict['samples'] = samples
         gen_time = time.time() - start_time
         logger.info(f"Success, time: {gen_time}")
         
-        wav2vec.to(self.device)
-        
         return out_dict
     
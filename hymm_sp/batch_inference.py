@@ -1,10 +1,8 @@
 import os
 import torch
-import numpy as np
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 from loguru import logger
-from einops import rearrange
-import imageio
 import torch.distributed
 from torch.utils.data.distributed import DistributedSampler
 from torch.utils.data import DataLoader
@@ -13,6 +11,7 @@ from hymm_sp.audio_video_inference import HunyuanVideoSampler
 from hymm_sp.data_kits.audio_dataset import VideoAudioTextLoaderVal
 from hymm_sp.data_kits.data_tools import save_videos_grid
 from hymm_sp.data_kits.face_align import AlignImage
+from hymm_sp.data_kits.video_writer import video_frames, video_writer_kwargs, write_video
 from hymm_sp.modules.parallel_states import (
     initialize_distributed,
     nccl_info,
@@ -54,7 +53,8 @@ def main():
     
     BASE_DIR = f'{MODEL_OUTPUT_PATH}/ckpts/det_align/'
     det_path = os.path.join(BASE_DIR, 'detface.pt')    
-    align_instance = AlignImage("cuda", det_path=det_path)
+    align_instance = AlignImage(args.det_device, det_path=det_path, backend=args.det_backend,
+                                num_threads=args.det_threads)
     
     feature_extractor = AutoFeatureExtractor.from_pretrained(f"{MODEL_OUTPUT_PATH}/ckpts/whisper-tiny/")
 
@@ -69,37 +69,68 @@ def main():
             **kwargs,
         )
 
+    # Encode all the prompts up front in batches, the denoise loop then reads them from the prompt cache.
+    prompt_inputs = [video_dataset.get_prompt_inputs(idx) for idx in range(len(video_dataset))]
+    with torch.no_grad():
+        hunyuan_video_sampler.preencode_prompts(
+            [prompt for prompt, _ in prompt_inputs], [pixel_value_llava for _, pixel_value_llava in prompt_inputs],
+            batch_size=args.text_encode_batch_size)
+    del prompt_inputs
+
     sampler = DistributedSampler(video_dataset, num_replicas=1, rank=0, shuffle=False, drop_last=False)
     json_loader = DataLoader(video_dataset, batch_size=1, shuffle=False, sampler=sampler, drop_last=False)
 
+    # with `--stream-vae-decode` the previous video decodes and encodes here while the next one denoises
+    writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="video-writer")
+    pending = None
+    streamed = None
     for batch_index, batch in enumerate(json_loader, start=1):
 
         fps = batch["fps"]
         videoid = batch['videoid'][0]
         audio_path = str(batch["audio_path"][0])
         save_path = args.save_path 
-        output_path = f"{save_path}/{videoid}.mp4"
         output_audio_path = f"{save_path}/{videoid}_audio.mp4"
 
         samples = hunyuan_video_sampler.predict(args, batch, wav2vec, feature_extractor, align_instance)
-        
-        sample = samples['samples'][0].unsqueeze(0)                    # denoised latent, (bs, 16, t//4, h//8, w//8)
-        sample = sample[:, :, :batch["audio_len"][0]]
-        
-        video = rearrange(sample[0], "c f h w -> f h w c")
-        video = (video * 255.).data.cpu().numpy().astype(np.uint8)  # （f h w c)
-        
-        torch.cuda.empty_cache()
-
-        final_frames = []
-        for frame in video:
-            final_frames.append(frame)
-        final_frames = np.stack(final_frames, axis=0)
-        
-        if rank == 0:
-            imageio.mimsave(output_path, final_frames, fps=fps.item())
-            os.system(f"ffmpeg -i '{output_path}' -i '{audio_path}' -shortest '{output_audio_path}' -y -loglevel quiet; rm '{output_path}'")
-
+        if samples is None:
+            continue
+
+        if 'samples_stream' in samples:
+            if streamed is not None:
+                streamed.result()
+            streamed = writer.submit(save_sample, samples['samples_stream'], batch["audio_len"][0], fps, audio_path,
+                                     output_audio_path, rank=rank, video_kwargs=video_writer_kwargs(args))
+            continue
+
+        if 'samples_future' in samples:
+            # the video decodes in the background, save the previous one while the next job denoises
+            if pending is not None:
+                save_sample(pending[0].result(), *pending[1:], rank=rank, video_kwargs=video_writer_kwargs(args))
+            pending = (samples['samples_future'], batch["audio_len"][0], fps, audio_path, output_audio_path)
+            continue
+
+        save_sample(samples['samples'], batch["audio_len"][0], fps, audio_path, output_audio_path, rank=rank,
+                    video_kwargs=video_writer_kwargs(args))
+
+    if pending is not None:
+        save_sample(pending[0].result(), *pending[1:], rank=rank, video_kwargs=video_writer_kwargs(args))
+    if streamed is not None:
+        streamed.result()
+    writer.shutdown()
+    hunyuan_video_sampler.disable_decode_worker()
+
+
+def save_sample(samples, audio_len, fps, audio_path, output_audio_path, rank=0, video_kwargs=None):
+    """`samples` is the decoded (b, c, t, h, w) video, or an iterable of its chunks along time."""
+    chunks = [samples] if torch.is_tensor(samples) else samples
+
+    torch.cuda.empty_cache()
+
+    if rank == 0:
+        # frames are converted as the encoder takes them, the audio is muxed in the same pass
+        frames = video_frames(chunks, num_frames=audio_len)    # (t h w c)
+        write_video(output_audio_path, frames, fps.item(), audio=audio_path, **(video_kwargs or {}))
 
 
     
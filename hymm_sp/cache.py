@@ -0,0 +1,228 @@
+"""
+Content-addressed caches for per-request work that only depends on the inputs (reference image, prompt, audio).
+
+Each named cache keeps an in-memory LRU bounded by item count and tensor bytes, and optionally mirrors its entries
+on disk so they survive restarts and can be shared between processes. Keys are built with `make_key` from content
+hashes (`hash_file`, `hash_bytes`, `hash_tensor`) and the settings the value depends on.
+"""
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+import torch
+from loguru import logger
+
+
+def hash_bytes(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def hash_file(path, chunk_size: int = 1 << 20) -> str:
+    """Hash of the content of the file at `path`, or of `path` itself when it is the content (bytes)."""
+    if isinstance(path, (bytes, bytearray)):
+        return hash_bytes(bytes(path))
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def hash_tensor(tensor: torch.Tensor) -> str:
+    """Hash of the dtype, shape and values of a tensor, independent of its device and memory layout."""
+    tensor = tensor.detach().cpu().contiguous()
+    h = hashlib.sha256(f"{tensor.dtype}{tuple(tensor.shape)}".encode())
+    h.update(tensor.reshape(-1).view(torch.uint8).numpy().tobytes())
+    return h.hexdigest()
+
+
+def make_key(*parts) -> str:
+    """Combine hashes and settings into a cache key."""
+    return hash_bytes(repr(parts).encode())
+
+
+def tensor_nbytes(value) -> int:
+    if isinstance(value, torch.Tensor):
+        return value.numel() * value.element_size()
+    if isinstance(value, dict):
+        return sum(tensor_nbytes(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(tensor_nbytes(v) for v in value)
+    return 0
+
+
+def to_cpu(value):
+    if isinstance(value, torch.Tensor):
+        # CPU tensors are kept as they are, not copied
+        return value.detach().cpu() if value.requires_grad or value.device.type != "cpu" else value
+    if isinstance(value, dict):
+        return {k: to_cpu(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(to_cpu(v) for v in value)
+    return value
+
+
+class DiskStore:
+    """
+    `torch.save` files under `root`, written atomically so concurrent readers never see partial entries. Entries are
+    loaded memory-mapped, large ones (e.g. the Whisper states of long tracks) are only paged in as they are read.
+    """
+    def __init__(self, root):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def path(self, key):
+        return self.root / key[:2] / f"{key}.pt"
+
+    def load(self, key):
+        path = self.path(key)
+        if not path.exists():
+            return None
+        try:
+            try:
+                return torch.load(path, map_location="cpu", mmap=True)
+            except TypeError:
+                # torch < 2.1
+                return torch.load(path, map_location="cpu")
+        except Exception as e:
+            logger.warning(f"Ignoring unreadable cache entry {path}: {e}")
+            return None
+
+    def save(self, key, value):
+        path = self.path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        torch.save(to_cpu(value), tmp)
+        os.replace(tmp, path)
+
+
+class FeatureCache:
+    """
+    Thread-safe LRU of tensors (or dicts / tuples of tensors) with an optional `DiskStore` behind it.
+
+    Entries are kept on the CPU, in memory as on disk, so a full cache never holds on to GPU memory. Pass `device` to
+    `get` to receive a copy on that device, without it the CPU entry itself is returned and callers must not modify
+    it in place.
+
+    Args:
+        max_items: Maximum number of entries in memory, 0 disables the memory cache.
+        max_bytes: Maximum tensor bytes in memory, `None` for no limit.
+        disk_dir: Directory of the on-disk store, `None` for memory only.
+    """
+    def __init__(self, name, max_items=64, max_bytes=None, disk_dir=None):
+        self.name = name
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.disk = DiskStore(Path(disk_dir) / name) if disk_dir else None
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.max_items > 0 or self.disk is not None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, device=None):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+        if value is None:
+            value = self.disk.load(key) if self.disk is not None else None
+            if value is None:
+                with self.lock:
+                    self.misses += 1
+                return None
+            with self.lock:
+                self.hits += 1
+            self._remember(key, value)
+        return _to_device(value, device) if device is not None else value
+
+    def put(self, key, value):
+        """Store `value` (a CPU copy of it) and return `value` itself."""
+        self._remember(key, value)
+        if self.disk is not None:
+            self.disk.save(key, value)
+        return value
+
+    def get_or_compute(self, key, fn, device=None):
+        value = self.get(key, device=device)
+        if value is None:
+            value = self.put(key, fn())
+        return value
+
+    def _remember(self, key, value):
+        if self.max_items <= 0:
+            return
+        nbytes = tensor_nbytes(value)
+        if self.max_bytes is not None and nbytes > self.max_bytes:
+            return
+        value = to_cpu(value)
+        with self.lock:
+            if key in self.entries:
+                self.nbytes -= tensor_nbytes(self.entries.pop(key))
+            self.entries[key] = value
+            self.nbytes += nbytes
+            while len(self.entries) > self.max_items or (self.max_bytes is not None and self.nbytes > self.max_bytes):
+                _, evicted = self.entries.popitem(last=False)
+                self.nbytes -= tensor_nbytes(evicted)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        return {"name": self.name, "items": len(self.entries), "bytes": self.nbytes,
+                "hits": self.hits, "misses": self.misses}
+
+
+def _to_device(value, device):
+    if isinstance(value, torch.Tensor):
+        return value.to(device)
+    if isinstance(value, dict):
+        return {k: _to_device(v, device) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(_to_device(v, device) for v in value)
+    return value
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+_cache_settings = {"max_items": 64, "max_bytes": None, "disk_dir": None}
+
+
+def configure_caches(max_items=64, max_bytes=None, disk_dir=None):
+    """Set the limits of the named caches. Existing caches are replaced (and emptied)."""
+    with _caches_lock:
+        _cache_settings.update(max_items=max_items, max_bytes=max_bytes, disk_dir=disk_dir)
+        for name in list(_caches):
+            _caches[name] = FeatureCache(name, **_cache_settings)
+
+
+def configure_caches_from_args(args):
+    configure_caches(
+        max_items=args.cache_size,
+        max_bytes=int(args.cache_memory * 1024 ** 3) if args.cache_memory is not None else None,
+        disk_dir=args.cache_dir,
+    )
+
+
+def get_cache(name) -> FeatureCache:
+    """The process-wide cache called `name`, created on first use with the configured limits."""
+    with _caches_lock:
+        if name not in _caches:
+            _caches[name] = FeatureCache(name, **_cache_settings)
+        return _caches[name]
+
+
+def cache_stats():
+    return [cache.stats() for cache in _caches.values()]
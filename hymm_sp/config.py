@@ -23,6 +23,8 @@ def add_extra_args(parser: argparse.ArgumentParser):
     parser = add_extra_models_args(parser)
     parser = add_denoise_schedule_args(parser)
     parser = add_evaluation_args(parser)
+    parser = add_cache_args(parser)
+    parser = add_server_args(parser)
     return parser
 
 def add_network_args(parser: argparse.ArgumentParser):
@@ -43,6 +45,20 @@ def add_extra_models_args(parser: argparse.ArgumentParser):
     group.add_argument("--vae-precision", type=str, default="fp16", 
                        help="Precision mode for the VAE model.")
     group.add_argument("--vae-tiling", action="store_true", default=True, help="Enable tiling for the VAE model.")
+    group.add_argument("--vae-parallel-decode", action="store_true",
+                       help="Shard the VAE decoding tiles over the sequence parallel group and gather them on rank 0.")
+    group.add_argument("--vae-tile-budget", type=float, default=None,
+                       help="Memory budget (GiB) for VAE activations. If set, tiling and tile sizes are chosen "
+                            "automatically per clip instead of using the fixed tiles of `--vae-tiling`.")
+    group.add_argument("--vae-tile-calibrate", action="store_true",
+                       help="Measure the per-tile VAE memory on the GPU at startup for `--vae-tile-budget`.")
+    group.add_argument("--async-vae-decode", action="store_true",
+                       help="Decode videos on a background worker, overlapped with the denoising of the next job. "
+                            "Ignored with sequence parallelism and with --cpu-offload.")
+    group.add_argument("--stream-vae-decode", action="store_true",
+                       help="Decode videos in chunks along time with causal caching and encode every chunk as soon "
+                            "as it is decoded, overlapped with the denoising of the next job. Ignored with sequence "
+                            "parallelism.")
     group.add_argument("--text-encoder", type=str, default="llava-llama-3-8b", choices=list(TEXT_ENCODER_PATH),
                        help="Name of the text encoder model.")
     group.add_argument("--text-encoder-precision", type=str, default="fp16", choices=PRECISIONS,
@@ -60,6 +76,24 @@ def add_extra_models_args(parser: argparse.ArgumentParser):
                        help="Skip layer for hidden states.")
     group.add_argument("--apply-final-norm", action="store_true",
                        help="Apply final normalization to the used text encoder hidden states.")
+    group.add_argument("--text-encoder-truncate", type=str, default="none", choices=["none", "stop", "unload"],
+                       help="Run the LLM text encoder only up to the layer used by --hidden-state-skip-layer. "
+                            "'stop' keeps the skipped layers and LM head aside, 'unload' frees them.")
+    group.add_argument("--text-encoder-service", type=str, default=None,
+                       help="Unix socket of a text encoder service (python3 -m hymm_sp.text_encoder.service) to "
+                            "encode prompts with, instead of loading the text encoders in this process.")
+    group.add_argument("--text-encode-batch-size", type=int, default=8,
+                       help="Prompts per text encoder forward when pre-encoding the prompts of a batch run.")
+
+    # - Face detector
+    group.add_argument("--det-device", type=str, default="cuda",
+                       help="Device of the face detector. 'cpu' keeps it off the GPU.")
+    group.add_argument("--det-backend", type=str, default="torchscript", choices=["torchscript", "onnx", "onnx-int8"],
+                       help="Face detector runtime. The ONNX backends (requires onnxruntime) run on the CPU, "
+                            "'onnx-int8' with dynamically quantized weights; they fall back to TorchScript on the CPU "
+                            "if the detector does not export.")
+    group.add_argument("--det-threads", type=int, default=None,
+                       help="CPU threads of the ONNX face detector.")
 
     # - CLIP
     group.add_argument("--text-encoder-2", type=str, default='clipL', choices=list(TEXT_ENCODER_PATH),
@@ -115,14 +149,61 @@ def add_evaluation_args(parser: argparse.ArgumentParser):
     group.add_argument("--pos-prompt", type=str, default='', help="Prompt for sampling during evaluation.")
     group.add_argument("--neg-prompt", type=str, default='', help="Negative prompt for sampling during evaluation.")
     group.add_argument("--image-size", type=int, default=704)
+    group.add_argument("--whisper-batch-windows", type=int, default=0,
+                       help="Encode the audio of concurrent requests together, up to N 30 s Whisper windows per "
+                            "forward. 0 encodes each request on its own.")
+    group.add_argument("--max-audio-frames", type=int, default=None,
+                       help="Cap on the video frames driven by the audio. Defaults to the whole track, the audio "
+                            "context of each denoising segment is gathered when it runs.")
     group.add_argument("--pad-face-size", type=float, default=0.7, help="Pad bbox for face align.")
     group.add_argument("--image-path", type=str, default="",  help="")
     group.add_argument("--save-path", type=str, default=None, help="Path to save the generated samples.")
+    group.add_argument("--video-codec", type=str, default="libx264", help="Encoder of the saved videos.")
+    group.add_argument("--video-crf", type=int, default=18,
+                       help="Constant rate factor of the saved videos, lower is better quality.")
+    group.add_argument("--video-preset", type=str, default="medium", help="Encoder speed preset of the saved videos.")
+    group.add_argument("--video-threads", type=int, default=0,
+                       help="Threads of the video encoder, 0 lets the encoder decide.")
     group.add_argument("--input", type=str, default=None, help="test data.")
     group.add_argument("--item-name", type=str, default=None, help="")
     group.add_argument("--cfg-scale", type=float, default=7.5, help="Classifier free guidance scale.")
     group.add_argument("--ip-cfg-scale", type=float, default=0, help="Classifier free guidance scale.")
     group.add_argument("--use-deepcache", type=int, default=1)
+    group.add_argument("--preview-steps", type=int, default=0,
+                       help="Render a low resolution preview of the latents every N denoising steps, 0 disables it.")
+    group.add_argument("--preview-decoder", type=str, default=None,
+                       help="Path of a fitted preview decoder (see fit_preview_decoder.py). Defaults to a built-in "
+                            "linear latent-to-RGB projection.")
+    return parser
+
+def add_cache_args(parser: argparse.ArgumentParser):
+    group = parser.add_argument_group(title="Caches")
+    group.add_argument("--cache-size", type=int, default=64,
+                       help="Entries kept in memory per cache (reference image preprocessing, face masks, reference "
+                            "latents, image features, audio features), 0 disables the memory caches.")
+    group.add_argument("--cache-memory", type=float, default=None,
+                       help="Host memory limit (GiB) of the tensors kept per cache, entries live on the CPU and are moved "
+                            "to the GPU on use. Defaults to no limit.")
+    group.add_argument("--cache-dir", type=str, default=None,
+                       help="Directory of an on-disk store behind the memory caches, shared across restarts.")
+    group.add_argument("--cache-image-features", type=int, default=1,
+                       help="Cache the LLaVA image features of reference images.")
+    group.add_argument("--cache-prompt-embeds", type=int, default=1,
+                       help="Cache the text encoder outputs per prompt (and reference image for LLaVA).")
+    return parser
+
+def add_server_args(parser: argparse.ArgumentParser):
+    group = parser.add_argument_group(title="Server")
+    group.add_argument("--job-queue-size", type=int, default=16,
+                       help="Jobs the server keeps waiting behind the running one before it answers 429.")
+    group.add_argument("--job-history", type=int, default=256,
+                       help="Finished jobs whose status and result the server keeps for `GET /jobs/{id}`.")
+    group.add_argument("--job-video-history", type=int, default=16,
+                       help="Last jobs whose fragmented MP4 the server keeps for `GET /jobs/{id}/video`.")
+    group.add_argument("--preprocess-workers", type=int, default=2,
+                       help="Threads preprocessing the next jobs while one job is on the GPU.")
+    group.add_argument("--stage-queue-size", type=int, default=2,
+                       help="Jobs waiting in front of each server stage, e.g. preprocessed jobs waiting for the GPU.")
     return parser
 
 def sanity_check_args(args):
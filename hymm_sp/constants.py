@@ -2,7 +2,7 @@ import os
 import torch
 
 __all__ = [
-    "PROMPT_TEMPLATE", "MODEL_BASE", "PRECISION_TO_TYPE",
+    "PROMPT_TEMPLATE", "NEGATIVE_PROMPT", "MODEL_BASE", "PRECISION_TO_TYPE",
     "PRECISIONS", "VAE_PATH", "TEXT_ENCODER_PATH", "TOKENIZER_PATH",
     "TEXT_PROJECTION",
 ]
@@ -29,6 +29,11 @@ PROMPT_TEMPLATE = {
     "li-dit-encode-video": {"template": PROMPT_TEMPLATE_ENCODE_VIDEO, "crop_start": 95},
 }
 
+NEGATIVE_PROMPT = (
+    "Aerial view, aerial view, overexposed, low quality, deformation, a poor composition, bad hands, bad teeth, "
+    "bad eyes, bad limbs, distortion, blurring, Lens changes"
+)
+
 # ======================= Model ======================
 PRECISIONS = {"fp32", "fp16", "bf16"}
 
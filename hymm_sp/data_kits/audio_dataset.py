@@ -1,10 +1,10 @@
+import io
 import os
 import cv2
 import math
 import json
 import torch
 import random
-import librosa
 import traceback
 import torchvision
 import numpy as np
@@ -16,24 +16,93 @@ from decord import VideoReader, cpu
 from transformers import CLIPImageProcessor
 import torchvision.transforms as transforms
 from torchvision.transforms import ToPILImage
+from hymm_sp.cache import get_cache, hash_file, make_key
+from hymm_sp.data_kits.audio_io import iter_audio_chunks
 
 
 
 def get_audio_feature(feature_extractor, audio_path):
-    audio_input, sampling_rate = librosa.load(audio_path, sr=16000)
-    assert sampling_rate == 16000
+    """
+    Whisper log-mel features of the track (a path or the file as bytes), one 30 s window per chunk, and its length
+    in 25 fps frames.
 
-    audio_features = []
-    window = 750*640
-    for i in range(0, len(audio_input), window):
-        audio_feature = feature_extractor(audio_input[i:i+window], 
-                                        sampling_rate=sampling_rate, 
-                                        return_tensors="pt", 
-                                        ).input_features
-        audio_features.append(audio_feature)
+    The audio is decoded and resampled in blocks and each 30 s chunk goes to the feature extractor as soon as it is
+    complete. Cached by file content, a hit skips decoding the audio.
+    """
+    key = make_key("audio_mel", hash_file(audio_path), "polyphase", type(feature_extractor).__name__,
+                   getattr(feature_extractor, "feature_size", None), getattr(feature_extractor, "hop_length", None),
+                   getattr(feature_extractor, "n_samples", None))
 
-    audio_features = torch.cat(audio_features, dim=-1)
-    return audio_features, len(audio_input) // 640
+    def extract():
+        audio_features = []
+        num_samples = 0
+        for chunk in iter_audio_chunks(audio_path, sample_rate=16000, chunk_size=750*640):
+            audio_feature = feature_extractor(chunk, 
+                                            sampling_rate=16000, 
+                                            return_tensors="pt", 
+                                            ).input_features
+            audio_features.append(audio_feature)
+            num_samples += len(chunk)
+
+        audio_features = torch.cat(audio_features, dim=-1)
+        return audio_features, num_samples // 640
+
+    return get_cache("audio_mel").get_or_compute(key, extract)
+
+
+def get_llava_transform():
+    return transforms.Compose(
+        [
+            transforms.Resize((336, 336), interpolation=transforms.InterpolationMode.BILINEAR), 
+            transforms.ToTensor(), 
+            transforms.Normalize((0.48145466, 0.4578275, 0.4082107), (0.26862954, 0.26130258, 0.27577711)),
+        ]
+    )
+
+
+def resize_ref_image(ref_image, img_size):
+    # Resize reference image
+    w, h = ref_image.size
+    scale = img_size / min(w, h)
+    new_w = round(w * scale / 64) * 64
+    new_h = round(h * scale / 64) * 64
+
+    if img_size == 704:
+        img_size_long = 1216 
+    elif img_size == 512:
+        img_size_long = 768
+    elif img_size == 384:
+        img_size_long = 576
+    elif img_size == 256:
+        img_size_long = 384
+    else:
+        img_size_long = img_size * 1.5  # Default fallback
+
+    if new_w * new_h > img_size * img_size_long:
+        scale = math.sqrt(img_size * img_size_long / w / h)
+        new_w = round(w * scale / 64) * 64
+        new_h = round(h * scale / 64) * 64
+
+    return ref_image.resize((new_w, new_h), Image.LANCZOS)
+
+
+def preprocess_ref_image(image_path, img_size, llava_transform=None):
+    """
+    Resized reference pixels (1, 3, h, w) uint8 and the LLaVA input (1, 3, 336, 336), cached by image content.
+    `image_path` may also be the encoded image as bytes.
+    """
+    llava_transform = llava_transform or get_llava_transform()
+
+    def preprocess():
+        image = Image.open(io.BytesIO(image_path) if isinstance(image_path, bytes) else image_path)
+        ref_image = resize_ref_image(image.convert('RGB'), img_size)
+        pixel_value_ref = rearrange(torch.from_numpy(np.array(ref_image)).unsqueeze(0), "b h w c -> b c h w")
+        to_pil = ToPILImage()
+        pixel_value_ref_llava = torch.stack([llava_transform(to_pil(image)) for image in pixel_value_ref], dim=0)
+        return pixel_value_ref, pixel_value_ref_llava
+
+    key = make_key("ref_image", hash_file(image_path), img_size)
+    return get_cache("ref_image").get_or_compute(key, preprocess)
 
 
 class VideoAudioTextLoaderVal(Dataset):
@@ -63,13 +132,7 @@ class VideoAudioTextLoaderVal(Dataset):
                 }
             )
         
-        self.llava_transform = transforms.Compose(
-            [
-                transforms.Resize((336, 336), interpolation=transforms.InterpolationMode.BILINEAR), 
-                transforms.ToTensor(), 
-                transforms.Normalize((0.48145466, 0.4578275, 0.4082107), (0.26862954, 0.26130258, 0.27577711)),
-            ]
-        )
+        self.llava_transform = get_llava_transform()
         self.clip_image_processor = CLIPImageProcessor()
         
         self.device = torch.device("cuda")
@@ -86,44 +149,25 @@ class VideoAudioTextLoaderVal(Dataset):
         text_mask = text_inputs["attention_mask"].squeeze(0)
         return text_ids, text_mask
     
+    @staticmethod
+    def get_prompt(meta_file):
+        return "Authentic, Realistic, Natural, High-quality, Lens-Fixed, " + meta_file["prompt"]
+
+    def get_prompt_inputs(self, idx):
+        """Prompt and LLaVA reference image of a row, as `predict` passes them to the text encoder."""
+        meta_file = self.meta_files[idx]
+        _, pixel_value_ref_llava = preprocess_ref_image(meta_file["image_path"], self.image_size, self.llava_transform)
+        return self.get_prompt(meta_file), pixel_value_ref_llava.to(dtype=torch.float16)
+
     def get_batch_data(self, idx):
         meta_file = self.meta_files[idx]
         videoid = meta_file["videoid"]
         image_path = meta_file["image_path"]
         audio_path = meta_file["audio_path"]
-        prompt = "Authentic, Realistic, Natural, High-quality, Lens-Fixed, " + meta_file["prompt"]
+        prompt = self.get_prompt(meta_file)
         fps = meta_file["fps"]
         
-        img_size = self.image_size
-        ref_image = Image.open(image_path).convert('RGB')
-        
-        # Resize reference image
-        w, h = ref_image.size
-        scale = img_size / min(w, h)
-        new_w = round(w * scale / 64) * 64
-        new_h = round(h * scale / 64) * 64
-
-        if img_size == 704:
-            img_size_long = 1216 
-        elif img_size == 512:
-            img_size_long = 768
-        elif img_size == 384:
-            img_size_long = 576
-        elif img_size == 256:
-            img_size_long = 384
-        else:
-            img_size_long = img_size * 1.5  # Default fallback
-
-        if new_w * new_h > img_size * img_size_long:
-            import math
-            scale = math.sqrt(img_size * img_size_long / w / h)
-            new_w = round(w * scale / 64) * 64
-            new_h = round(h * scale / 64) * 64
-
-        ref_image = ref_image.resize((new_w, new_h), Image.LANCZOS)
-        
-        ref_image = np.array(ref_image)
-        ref_image = torch.from_numpy(ref_image)
+        pixel_value_ref, pixel_value_ref_llava = preprocess_ref_image(image_path, self.image_size, self.llava_transform)
          
         audio_input, audio_len = get_audio_feature(self.feature_extractor, audio_path)
         audio_prompts = audio_input[0]
@@ -134,11 +178,6 @@ class VideoAudioTextLoaderVal(Dataset):
         motion_bucket_id_exps = torch.from_numpy(motion_bucket_id_exps)
         fps = torch.from_numpy(np.array(fps))
         
-        to_pil = ToPILImage()
-        pixel_value_ref = rearrange(ref_image.clone().unsqueeze(0), "b h w c -> b c h w")   # (b c h w)
-        
-        pixel_value_ref_llava = [self.llava_transform(to_pil(image)) for image in pixel_value_ref]
-        pixel_value_ref_llava = torch.stack(pixel_value_ref_llava, dim=0)
         pixel_value_ref_clip = self.clip_image_processor(
             images=Image.fromarray((pixel_value_ref[0].permute(1,2,0)).data.cpu().numpy().astype(np.uint8)), 
             return_tensors="pt"
@@ -0,0 +1,158 @@
+"""
+Audio ingest: duration from the file header, and block-wise decoding + resampling to the 16 kHz Whisper input.
+
+Decoding goes through soundfile (wav, flac, ogg, mp3 with libsndfile >= 1.1) and falls back to PyAV for the other
+containers (m4a, aac, webm, video files). Blocks are mixed down to mono and resampled with a streaming polyphase
+filter, so a multi-minute upload never sits in memory at its original rate, and its first 30 s can be turned into
+features before the rest is decoded.
+"""
+import io
+import math
+
+import numpy as np
+from scipy.signal import resample_poly
+
+try:
+    import soundfile
+except ImportError:
+    soundfile = None
+try:
+    import av
+except ImportError:
+    av = None
+
+WHISPER_SAMPLE_RATE = 16000
+WHISPER_CHUNK = 750 * 640       # samples in one 30 s Whisper window
+BLOCK_SIZE = 1 << 16            # frames decoded at a time
+
+
+def get_audio_duration(path):
+    """Duration in seconds, read from the header without decoding the samples."""
+    if soundfile is not None:
+        try:
+            return soundfile.info(_open(path)).duration
+        except RuntimeError:
+            pass
+    if av is not None:
+        with av.open(_open(path)) as container:
+            stream = container.streams.audio[0]
+            if stream.duration is not None:
+                return float(stream.duration * stream.time_base)
+            if container.duration is not None:
+                return container.duration / av.time_base
+    import librosa
+    return librosa.get_duration(path=path)
+
+
+class PolyphaseResampler:
+    """
+    Streaming `scipy.signal.resample_poly`: feeding the signal block by block gives the samples of resampling it
+    at once.
+
+    Each output block is computed from its input plus `margin` samples of context on both sides, more than the
+    half-length of the anti-aliasing filter, and block edges are kept on multiples of `down` so the output grid
+    lines up with the one of the whole signal.
+    """
+    def __init__(self, orig_sr, target_sr):
+        g = math.gcd(int(orig_sr), int(target_sr))
+        self.up, self.down = int(target_sr) // g, int(orig_sr) // g
+        # resample_poly's default filter spans 10 * max(up, down) upsampled samples on each side
+        half_len = 10 * max(self.up, self.down) / self.up
+        self.margin = self.down * math.ceil((half_len + 1) / self.down)
+        self.buffer = np.zeros(0, dtype=np.float32)
+        self.buffer_start = 0       # input index of buffer[0]
+        self.done = 0               # input samples already turned into output
+
+    @property
+    def identity(self):
+        return self.up == self.down
+
+    def process(self, block):
+        """Resampled samples that are final once `block` is added."""
+        if self.identity:
+            return block
+        self.buffer = np.concatenate([self.buffer, block])
+        end = (self.buffer_start + len(self.buffer) - self.margin) // self.down * self.down
+        if end <= self.done:
+            return np.zeros(0, dtype=np.float32)
+        return self._emit(end, final=False)
+
+    def flush(self):
+        """The remaining samples, at the end of the signal."""
+        if self.identity:
+            return np.zeros(0, dtype=np.float32)
+        return self._emit(self.buffer_start + len(self.buffer), final=True)
+
+    def _emit(self, end, final):
+        chunk_end = len(self.buffer) if final else end + self.margin - self.buffer_start
+        y = resample_poly(self.buffer[:chunk_end], self.up, self.down).astype(np.float32)
+        first = (self.done - self.buffer_start) * self.up // self.down
+        out = y[first:] if final else y[first:(end - self.buffer_start) * self.up // self.down]
+        self.done = end
+        keep_from = max(end - self.margin, 0)
+        self.buffer = self.buffer[keep_from - self.buffer_start:]
+        self.buffer_start = keep_from
+        return out
+
+
+def _open(path):
+    """`path`, or a new in-memory file when it is the file content (bytes)."""
+    return io.BytesIO(path) if isinstance(path, (bytes, bytearray)) else path
+
+
+def iter_decoded_blocks(path, block_size=BLOCK_SIZE):
+    """Yield (mono float32 block, sample rate) of the file, given by path or as bytes."""
+    if soundfile is not None:
+        try:
+            with soundfile.SoundFile(_open(path)) as f:
+                sample_rate = f.samplerate
+                for block in f.blocks(blocksize=block_size, dtype="float32", always_2d=True):
+                    yield block.mean(axis=1), sample_rate
+            return
+        except RuntimeError:
+            # not a format libsndfile reads
+            pass
+    if av is None:
+        raise RuntimeError(f"Cannot decode {path}: soundfile does not support it and PyAV is not installed.")
+    with av.open(_open(path)) as container:
+        stream = container.streams.audio[0]
+        # only converts the sample format and layout, the rate is left to the polyphase resampler
+        converter = av.AudioResampler(format="flt", layout="mono", rate=stream.rate)
+        for frame in container.decode(stream):
+            for converted in converter.resample(frame):
+                yield converted.to_ndarray().reshape(-1), stream.rate
+        for converted in converter.resample(None):
+            yield converted.to_ndarray().reshape(-1), stream.rate
+
+
+def iter_audio_chunks(path, sample_rate=WHISPER_SAMPLE_RATE, chunk_size=WHISPER_CHUNK):
+    """
+    Yield the mono audio of the file at `sample_rate`, in chunks of `chunk_size` samples (the last one shorter).
+    """
+    resampler = None
+    pending = []
+    pending_len = 0
+
+    def take_chunks(samples, final=False):
+        nonlocal pending, pending_len
+        if len(samples):
+            pending.append(samples)
+            pending_len += len(samples)
+        while pending_len >= chunk_size or (final and pending_len):
+            joined = np.concatenate(pending)
+            yield joined[:chunk_size]
+            pending = [joined[chunk_size:]]
+            pending_len = len(pending[0])
+
+    for block, block_rate in iter_decoded_blocks(path):
+        if resampler is None:
+            resampler = PolyphaseResampler(block_rate, sample_rate)
+        yield from take_chunks(resampler.process(block.astype(np.float32, copy=False)))
+    if resampler is not None:
+        yield from take_chunks(resampler.flush(), final=True)
+
+
+def load_audio(path, sample_rate=WHISPER_SAMPLE_RATE):
+    """The whole file as mono float32 at `sample_rate`, like `librosa.load(path, sr=sample_rate)`."""
+    chunks = list(iter_audio_chunks(path, sample_rate))
+    return np.concatenate(chunks) if chunks else np.zeros(0, dtype=np.float32)
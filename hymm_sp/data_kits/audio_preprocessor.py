@@ -1,6 +1,7 @@
 
 import os
 import cv2
+import contextlib
 import json
 import time
 import decord
@@ -10,63 +11,250 @@ import torch
 import random
 import argparse
 import traceback
-import numpy as np
 from tqdm import tqdm
-from PIL import Image
 from einops import rearrange
+from hymm_sp.cache import hash_tensor, make_key
 
 
 
-def get_facemask(ref_image, align_instance, area=1.25):
-    # ref_image: (b f c h w)
+def _box_coverage(lo, hi, in_size, out_size):
+    """
+    Bilinear resize (align_corners=False) from `in_size` to `out_size` pixels of the 1D masks that are 1 on
+    [lo, hi) for each pair of bounds, (n,) -> (n, out_size).
+    """
+    src = ((torch.arange(out_size, device=lo.device, dtype=torch.float64) + 0.5) * (in_size / out_size) - 0.5)
+    src = src.clamp(min=0)
+    i0 = src.floor()
+    i1 = (i0 + 1).clamp(max=in_size - 1)
+    frac = src - i0
+    inside = lambda i: ((i >= lo[:, None]) & (i < hi[:, None])).double()
+    return (1 - frac) * inside(i0) + frac * inside(i1)
+
+
+def get_facemask(ref_image, align_instance, area=1.25, size=None):
+    """
+    Mask of the (largest) face of each reference frame, its box scaled by `area`; the whole frame without a face.
+
+    Args:
+        ref_image: (b f c h w) RGB tensor with values in [0, 255].
+        size: (height, width) of the mask, e.g. the latent resolution. The rectangles are rasterized straight at
+            that size, with the values a bilinear resize of the full resolution mask would have.
+
+    Returns:
+        (b 1 f height width) mask on the device and in the dtype of `ref_image`.
+    """
     bsz, f, c, h, w = ref_image.shape
-    images = rearrange(ref_image, "b f c h w -> (b f) h w c").data.cpu().numpy().astype(np.uint8)
-    face_masks = []
-    for image in images:
-        image_pil = Image.fromarray(image).convert("RGB")
-        _, _, bboxes_list = align_instance(np.array(image_pil)[:,:,[2,1,0]], maxface=True)
-        try:
-            bboxSrc = bboxes_list[0]
-        except:
-            bboxSrc = [0, 0, w, h]
-        x1, y1, ww, hh = bboxSrc
-        x2, y2 = x1 + ww, y1 + hh
-        ww, hh = (x2-x1) * area, (y2-y1) * area
-        center = [(x2+x1)//2, (y2+y1)//2]
-        x1 = max(center[0] - ww//2, 0)
-        y1 = max(center[1] - hh//2, 0)
-        x2 = min(center[0] + ww//2, w)
-        y2 = min(center[1] + hh//2, h)
-        
-        face_mask = np.zeros_like(np.array(image_pil))
-        face_mask[int(y1):int(y2), int(x1):int(x2)] = 1.0
-        face_masks.append(torch.from_numpy(face_mask[...,:1]))
-    face_masks = torch.stack(face_masks, dim=0)     # (b*f, h, w, c)
-    face_masks = rearrange(face_masks, "(b f) h w c -> b c f h w", b=bsz, f=f)
-    face_masks = face_masks.to(device=ref_image.device, dtype=ref_image.dtype)
-    return face_masks
-
-
-def encode_audio(wav2vec, audio_feats, fps, num_frames=129):
-    if fps == 25:
-        start_ts = [0]
-        step_ts = [1]
-    elif fps == 12.5:
-        start_ts = [0]
-        step_ts = [2]
-    num_frames = min(num_frames, 400)
-    audio_feats = wav2vec.encoder(audio_feats.unsqueeze(0)[:, :, :3000], output_hidden_states=True).hidden_states
-    audio_feats = torch.stack(audio_feats, dim=2)
-    audio_feats = torch.cat([torch.zeros_like(audio_feats[:,:4]), audio_feats], 1)
-    
-    audio_prompts = []
-    for bb in range(1):
-        audio_feats_list = []
-        for f in range(num_frames):
-            cur_t = (start_ts[bb] + f * step_ts[bb]) * 2
-            audio_clip = audio_feats[bb:bb+1, cur_t: cur_t+10]
-            audio_feats_list.append(audio_clip)
-        audio_feats_list = torch.stack(audio_feats_list, 1)
-        audio_prompts.append(audio_feats_list)
-    audio_prompts = torch.cat(audio_prompts)
-    return audio_prompts
\ No newline at end of file
+    height, width = size or (h, w)
+    frames = rearrange(ref_image, "b f c h w -> (b f) c h w")
+    bboxes, _, _, image_index = align_instance.facedet.detect_batch(frames, maxface=True, to_numpy=False,
+                                                                     landmarks=False)
+
+    boxes = torch.tensor([0, 0, w, h], dtype=torch.float64, device=bboxes.device).repeat(bsz * f, 1)
+    boxes[image_index] = bboxes.double()
+    x1, y1 = boxes[:, 0], boxes[:, 1]
+    x2, y2 = x1 + boxes[:, 2], y1 + boxes[:, 3]
+    ww, hh = (x2 - x1) * area, (y2 - y1) * area
+    cx, cy = torch.div(x2 + x1, 2, rounding_mode="floor"), torch.div(y2 + y1, 2, rounding_mode="floor")
+    x1 = (cx - torch.div(ww, 2, rounding_mode="floor")).clamp(min=0).trunc()
+    y1 = (cy - torch.div(hh, 2, rounding_mode="floor")).clamp(min=0).trunc()
+    x2 = (cx + torch.div(ww, 2, rounding_mode="floor")).clamp(max=w).trunc()
+    y2 = (cy + torch.div(hh, 2, rounding_mode="floor")).clamp(max=h).trunc()
+
+    # the mask of a rectangle is the outer product of its row and column masks
+    face_masks = _box_coverage(y1, y2, h, height)[:, :, None] * _box_coverage(x1, x2, w, width)[:, None, :]
+    face_masks = rearrange(face_masks, "(b f) h w -> b 1 f h w", b=bsz, f=f)
+    return face_masks.to(device=ref_image.device, dtype=ref_image.dtype)
+
+
+WHISPER_WINDOW = 3000         # mel frames in one Whisper input, 30 s at 100 Hz
+WHISPER_FRAME_RATE = 50       # encoder output frames per second
+AUDIO_CONTEXT = 10            # encoder frames around each video frame
+AUDIO_CONTEXT_PAD = 4         # encoder frames of silence before the first one
+
+
+def get_whisper_windows(num_mel_frames, window=WHISPER_WINDOW, overlap=500):
+    """
+    Start (in mel frames) of the overlapping Whisper windows covering `num_mel_frames`, and the encoder frame where
+    each window's output takes over from the previous one: the middle of their overlap, so every kept frame has at
+    least `overlap / 2` mel frames of context on both sides.
+    """
+    stride = window - overlap
+    assert stride > 0, f"overlap {overlap} must be smaller than the window {window}"
+    if num_mel_frames <= window:
+        return [0], [0]
+    starts = list(range(0, num_mel_frames - window, stride)) + [num_mel_frames - window]
+    cuts = [0] + [(prev + window + start) // 4 for prev, start in zip(starts[:-1], starts[1:])]
+    return starts, cuts
+
+
+def run_whisper(wav2vec, mels):
+    """Hidden states of all layers of a batch of (n_mels, window) inputs, (b, window // 2, num_layers + 1, c)."""
+    hidden_states = wav2vec.encoder(mels, output_hidden_states=True).hidden_states
+    return torch.stack(hidden_states, dim=2)
+
+
+def split_whisper_windows(audio_feats, window=WHISPER_WINDOW, overlap=500):
+    """The Whisper inputs of a track: (list of (n_mels, window) mel windows, window starts, hand-over frames)."""
+    num_mel_frames = audio_feats.shape[-1]
+    if num_mel_frames < window:
+        raise ValueError(f"Expected at least {window} mel frames, got {num_mel_frames}.")
+    starts, cuts = get_whisper_windows(num_mel_frames, window, overlap)
+    return [audio_feats[:, start:start + window] for start in starts], starts, cuts
+
+
+def stitch_whisper_windows(window_states, starts, cuts, num_mel_frames):
+    """Join the outputs of the windows of `split_whisper_windows` into (1, T // 2, num_layers + 1, c) at 50 Hz."""
+    ends = cuts[1:] + [num_mel_frames // 2]
+    pieces = [states[None, cut - start // 2:end - start // 2]
+              for states, start, cut, end in zip(window_states, starts, cuts, ends)]
+    return torch.cat(pieces, dim=1)
+
+
+def encode_audio_hidden_states(wav2vec, audio_feats, window=WHISPER_WINDOW, overlap=500, batch_size=4):
+    """
+    Whisper hidden states of all layers for audio of any length.
+
+    The encoder only takes 30 s windows, so longer mel features run through overlapping windows (`batch_size` per
+    forward) and the outputs are stitched at 50 Hz.
+
+    Args:
+        audio_feats (torch.Tensor): Log-mel features (n_mels, T) of the whole track, T a multiple of the window for
+            audio longer than one window (`get_audio_feature` pads each 30 s chunk to a full window).
+
+    Returns:
+        (1, T // 2, num_layers + 1, hidden_size) tensor.
+    """
+    mels, starts, cuts = split_whisper_windows(audio_feats, window, overlap)
+    window_states = []
+    for i in range(0, len(mels), batch_size):
+        window_states.extend(run_whisper(wav2vec, torch.stack(mels[i:i + batch_size])).unbind(0))
+    return stitch_whisper_windows(window_states, starts, cuts, audio_feats.shape[-1])
+
+
+def get_audio_frame_starts(fps, num_frames, start_frame=0):
+    """
+    First encoder frame of the context of each video frame, in the zero-padded hidden states. Video frame f sits at
+    f / fps seconds, i.e. encoder frame 50 * f / fps (rounded when the fps does not divide 50).
+    """
+    if fps <= 0:
+        raise ValueError(f"Unsupported fps: {fps}")
+    frames = torch.arange(int(start_frame), int(start_frame) + int(num_frames), dtype=torch.float64)
+    return torch.round(frames * (WHISPER_FRAME_RATE / fps)).long()
+
+
+def gather_audio_windows(audio_hidden_states, fps, num_frames, start_frame=0):
+    """
+    Audio context of all video frames at once, (1, num_frames, 10, num_layers + 1, hidden_size).
+
+    When the encoder frames per video frame are an integer (25, 12.5, 10 fps, ...), this is a strided view of the
+    padded hidden states, otherwise a single gather.
+    """
+    num_frames = int(num_frames)
+    starts = get_audio_frame_starts(fps, num_frames, start_frame)
+    padded = pad_audio_hidden_states(audio_hidden_states, starts)
+    if num_frames == 0:
+        return padded.new_zeros((padded.shape[0], 0, AUDIO_CONTEXT) + padded.shape[2:])
+    step = WHISPER_FRAME_RATE / fps
+    if step == int(step):
+        first = int(starts[0])
+        windows = padded[:, first:].unfold(1, AUDIO_CONTEXT, int(step))[:, :num_frames]
+        return windows.permute(0, 1, 4, 2, 3)
+    index = starts[:, None] + torch.arange(AUDIO_CONTEXT)
+    return padded[:, index.to(padded.device)]
+
+
+def pad_audio_hidden_states(audio_hidden_states, starts):
+    """Silence before the first frame, and after the last one so that every context window is complete."""
+    last = int(starts.max()) if len(starts) else 0
+    end_pad = max(last + AUDIO_CONTEXT - AUDIO_CONTEXT_PAD - audio_hidden_states.shape[1], 0)
+    return torch.cat([torch.zeros_like(audio_hidden_states[:, :1]).expand(-1, AUDIO_CONTEXT_PAD, -1, -1),
+                      audio_hidden_states,
+                      torch.zeros_like(audio_hidden_states[:, :1]).expand(-1, end_pad, -1, -1)], dim=1)
+
+
+class AudioWindows:
+    """
+    Audio context of the video frames, gathered per denoising segment instead of for the whole video at once.
+
+    Holds the stitched 50 Hz hidden states of `encode_audio_hidden_states`, a fifth of the per-frame context at
+    25 fps, and reports the `shape` of the (b, length, 10, num_layers + 1, hidden_size) windows. `frames(index)`
+    builds the windows of the frames a segment needs. Frames from `num_frames` up to `length` are the pipeline's
+    padding and stay silent.
+    """
+    def __init__(self, audio_hidden_states, fps, num_frames, length=None, dtype=None):
+        self.audio_hidden_states = audio_hidden_states
+        self.fps = fps
+        self.num_frames = int(num_frames)
+        self.length = self.num_frames if length is None else int(length)
+        self.dtype = dtype or audio_hidden_states.dtype
+        self.starts = get_audio_frame_starts(fps, self.num_frames)
+        self.padded = pad_audio_hidden_states(audio_hidden_states, self.starts)
+
+    @property
+    def shape(self):
+        batch_size, _, num_layers, hidden_size = self.audio_hidden_states.shape
+        return torch.Size((batch_size, self.length, AUDIO_CONTEXT, num_layers, hidden_size))
+
+    @property
+    def device(self):
+        return self.audio_hidden_states.device
+
+    def with_length(self, length):
+        """The same windows, padded with silence or cut to `length` frames."""
+        return AudioWindows(self.audio_hidden_states, self.fps, min(self.num_frames, length), length, self.dtype)
+
+    def frames(self, index):
+        """Windows of the frames in `index`, (b, len(index), 10, num_layers + 1, hidden_size)."""
+        index = torch.as_tensor(index, dtype=torch.long)
+        if ((index < 0) | (index >= self.length)).any():
+            raise IndexError(f"Frame index out of range for {self.length} frames.")
+        valid = index < self.num_frames
+        if not valid.any():
+            return torch.zeros((self.shape[0], len(index)) + self.shape[2:], dtype=self.dtype, device=self.device)
+        starts = self.starts[index.clamp(max=self.num_frames - 1)]
+        windows = self.padded[:, (starts[:, None] + torch.arange(AUDIO_CONTEXT)).to(self.padded.device)]
+        windows = windows * valid.to(device=windows.device, dtype=windows.dtype)[None, :, None, None, None]
+        return windows.to(self.dtype)
+
+
+def get_audio_hidden_states(wav2vec, audio_feats, cache=None, batcher=None, lock=None):
+    """
+    Stitched Whisper hidden states of one track, (1, T // 2, num_layers + 1, hidden_size), on the device of
+    `audio_feats`.
+
+    Args:
+        audio_feats (torch.Tensor): Log-mel features (n_mels, T) of the whole track.
+        cache (FeatureCache, *optional*): Cache of the hidden states by mel content, kept on the CPU. They do not
+            depend on the fps, a hit serves any fps and frame count without running Whisper.
+        batcher (WhisperBatcher, *optional*): Encode through the batcher, together with concurrent requests.
+        lock (threading.Lock, *optional*): Held around Whisper when it runs without the batcher, for callers sharing
+            the model between threads.
+    """
+    def encode():
+        if batcher is not None:
+            return batcher.encode(audio_feats)
+        with lock or contextlib.nullcontext():
+            # read under the lock, the model may be moved between devices to save memory
+            mels = audio_feats.to(device=getattr(wav2vec, "device", audio_feats.device), dtype=wav2vec.dtype)
+            return encode_audio_hidden_states(wav2vec, mels).to(audio_feats.device)
+
+    if cache is None:
+        return encode()
+    key = make_key("audio_hidden_states", getattr(wav2vec.config, "_name_or_path", type(wav2vec).__name__),
+                   str(wav2vec.dtype), hash_tensor(audio_feats), WHISPER_WINDOW)
+    return cache.get_or_compute(key, encode, device=audio_feats.device)
+
+
+def encode_audio(wav2vec, audio_feats, fps, num_frames=129, max_frames=None, cache=None, batcher=None):
+    """
+    Audio context of each video frame, (1, num_frames, 10, num_layers + 1, hidden_size).
+
+    Args:
+        audio_feats (torch.Tensor): Log-mel features (n_mels, T) of the whole track.
+        max_frames (int, *optional*): Cap on the number of frames, to bound memory. Defaults to no cap.
+        cache, batcher: See `get_audio_hidden_states`.
+    """
+    if max_frames is not None:
+        num_frames = min(num_frames, max_frames)
+    audio_hidden_states = get_audio_hidden_states(wav2vec, audio_feats, cache=cache, batcher=batcher)
+    return gather_audio_windows(audio_hidden_states, fps, num_frames)
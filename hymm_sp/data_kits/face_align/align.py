@@ -4,8 +4,11 @@ import torch
 from .detface import DetFace
 
 class AlignImage(object):
-    def __init__(self, device='cuda', det_path=''):
-        self.facedet = DetFace(pt_path=det_path, confThreshold=0.5, nmsThreshold=0.45, device=device)
+    def __init__(self, device='cuda', det_path='', backend='torchscript', num_threads=None, warmup=True):
+        self.facedet = DetFace(pt_path=det_path, confThreshold=0.5, nmsThreshold=0.45, device=device,
+                               backend=backend, num_threads=num_threads)
+        if warmup:
+            self.facedet.warmup()
 
     @torch.no_grad()
     def __call__(self, im, maxface=False):
@@ -27,8 +30,29 @@ class AlignImage(object):
                 area = (bboxes[i,2])*(bboxes[i,3])
                 if area>max_area:
                     max_idx = i
+                    max_area = area
             five_pts_list = [five_pts_list[max_idx]]
             scores_list = [scores_list[max_idx]]
             bboxes_list = [bboxes_list[max_idx]]
 
-        return five_pts_list, scores_list, bboxes_list
\ No newline at end of file
+        return five_pts_list, scores_list, bboxes_list
+
+    @torch.no_grad()
+    def detect_batch(self, images, maxface=False, landmarks=True):
+        """
+        `__call__` for many images with a single detector forward.
+
+        Args:
+            images: List of BGR uint8 (h, w, 3) arrays, or an RGB (n, 3, h, w) tensor with values in [0, 255].
+            landmarks (bool): Also return the landmarks, otherwise five_pts_list is empty.
+
+        Returns:
+            Per image, (five_pts_list, scores_list, bboxes_list) as returned by `__call__`.
+        """
+        bboxes, kpss, scores, image_index = self.facedet.detect_batch(images, maxface=maxface, landmarks=landmarks)
+        results = []
+        for i in range(len(images)):
+            mask = image_index == i
+            five_pts_list = list(kpss[mask]) if landmarks else []
+            results.append((five_pts_list, list(scores[mask]), list(bboxes[mask])))
+        return results
\ No newline at end of file
@@ -2,8 +2,18 @@
 import os
 import cv2
 import numpy as np
+import tempfile
 import torch
+import uuid
 import torchvision
+from loguru import logger
+
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+BACKENDS = ("torchscript", "onnx", "onnx-int8")
 
 
 def xyxy2xywh(x):
@@ -210,18 +220,219 @@ def non_max_suppression_face(prediction, conf_thres=0.5, iou_thres=0.45, classes
     return output
 
 
+def non_max_suppression_face_batch(prediction, conf_thres=0.5, iou_thres=0.45, agnostic=False):
+    """
+    `non_max_suppression_face` for a whole batch at once, on the device of `prediction`.
+
+    Returns:
+        (detections (n, 16): xyxy, conf, landmarks, cls; image index (n,)), ordered by image and then by confidence.
+    """
+    nc = prediction.shape[2] - 15  # number of classes
+    cls_conf, cls = (prediction[..., 15:] * prediction[..., 4:5]).max(-1)
+    image_index, anchor = ((prediction[..., 4] > conf_thres) & (cls_conf > conf_thres)).nonzero(as_tuple=True)
+    x = prediction[image_index, anchor]
+    conf, cls = cls_conf[image_index, anchor], cls[image_index, anchor]
+
+    box = xywh2xyxy(x[:, :4])
+    groups = image_index * nc + (0 if agnostic else cls)
+    keep = torchvision.ops.batched_nms(box, conf, groups, iou_thres)
+    # batched_nms sorts by confidence, a stable sort by image keeps that order within each image
+    keep = keep[torch.sort(image_index[keep], stable=True).indices]
+    det = torch.cat((box[keep], conf[keep, None], x[keep, 5:15], cls[keep, None].float()), 1)
+    return det, image_index[keep]
+
+
+class OnnxDetector:
+    """onnxruntime CPU session behind the call signature of the TorchScript detector."""
+    def __init__(self, path, num_threads=None):
+        options = onnxruntime.SessionOptions()
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        self.session = onnxruntime.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        self.input_names = [node.name for node in self.session.get_inputs()]
+
+    def __call__(self, img, grids):
+        feeds = {name: tensor.detach().cpu().numpy() for name, tensor in zip(self.input_names, [img, *grids])}
+        return torch.from_numpy(self.session.run(None, feeds)[0])
+
+
+def _write_atomically(path, write):
+    """Call `write` on a temp file next to `path`, then move it in place: readers never load a partial model."""
+    tmp_path = f"{path}.{os.getpid()}.{uuid.uuid4().hex}.tmp"
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def export_onnx(model, grids, pt_path, quantize=False):
+    """
+    Export the TorchScript detector to ONNX next to `pt_path` (or in the temp dir if that is read-only), once.
+    With `quantize`, the weights are then dynamically quantized to int8. The files appear complete or not at all,
+    an interrupted export is redone by the next process.
+    """
+    suffix = ".int8.onnx" if quantize else ".onnx"
+    for directory in (os.path.dirname(os.path.abspath(pt_path)), tempfile.gettempdir()):
+        path = os.path.join(directory, os.path.splitext(os.path.basename(pt_path))[0] + suffix)
+        if os.path.exists(path):
+            return path
+        if os.access(directory, os.W_OK):
+            break
+    fp32_path = path[:-len(suffix)] + ".onnx"
+    if not os.path.exists(fp32_path):
+        names = ["img"] + [f"grid{i}" for i in range(len(grids))]
+        dynamic_axes = {"img": {0: "batch", 2: "height", 3: "width"}, "pred": {0: "batch", 1: "anchors"}}
+        dynamic_axes.update({name: {2: f"ny{i}", 3: f"nx{i}"} for i, name in enumerate(names[1:])})
+        _write_atomically(fp32_path, lambda tmp_path: torch.onnx.export(
+            model, (torch.zeros(1, 3, 416, 416), grids), tmp_path, input_names=names, output_names=["pred"],
+            dynamic_axes=dynamic_axes, opset_version=13))
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        _write_atomically(path, lambda tmp_path: quantize_dynamic(fp32_path, tmp_path, weight_type=QuantType.QUInt8))
+    return path
+
+
 class DetFace():
-    def __init__(self, pt_path, confThreshold=0.5, nmsThreshold=0.45, device='cuda'):
+    def __init__(self, pt_path, confThreshold=0.5, nmsThreshold=0.45, device='cuda', backend='torchscript',
+                 num_threads=None):
+        """
+        Args:
+            device (str): Device of the TorchScript detector. The ONNX backends always run on the CPU.
+            backend (str): 'torchscript', or 'onnx' / 'onnx-int8' to run the detector with onnxruntime, with fp32 or
+                dynamically quantized int8 weights. The ONNX backends fall back to TorchScript on the CPU when
+                onnxruntime is missing or the model does not export.
+            num_threads (int): onnxruntime intra-op threads.
+        """
         assert os.path.exists(pt_path)
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown face detector backend: {backend}, expected one of {BACKENDS}")
 
         self.inpSize = 416
         self.conf_thres = confThreshold
         self.iou_thres = nmsThreshold
-        self.test_device = torch.device(device if torch.cuda.is_available() else "cpu")
-        self.model = torch.jit.load(pt_path).to(self.test_device)
         self.last_w = 416
         self.last_h = 416
         self.grids = None
+        if backend != "torchscript":
+            device = "cpu"
+        self.test_device = torch.device(device if torch.cuda.is_available() else "cpu")
+        # map_location: a CPU detector never initializes CUDA
+        self.model = torch.jit.load(pt_path, map_location=self.test_device).eval()
+        self.backend = "torchscript"
+
+        if backend != "torchscript":
+            if onnxruntime is None:
+                logger.warning("onnxruntime is not installed, running the face detector with TorchScript on the CPU.")
+            else:
+                try:
+                    path = export_onnx(self.model, self.get_grids(416, 416), pt_path, quantize=backend == "onnx-int8")
+                    self.model = OnnxDetector(path, num_threads)
+                    self.backend = backend
+                except Exception as e:
+                    logger.warning(f"Face detector {backend} backend unavailable ({type(e).__name__}: {e}), "
+                                   f"running it with TorchScript on the CPU.")
+        if self.backend == "torchscript" and self.test_device.type == "cpu":
+            try:
+                # folds the batch norms and picks the CPU kernels once
+                self.model = torch.jit.optimize_for_inference(torch.jit.freeze(self.model))
+            except Exception as e:
+                logger.warning(f"Could not optimize the face detector for CPU inference: {e}")
+
+    @torch.no_grad()
+    def warmup(self, size=(416, 416), runs=2):
+        """Run the first (slow) forwards before the first request."""
+        for _ in range(runs):
+            self.detect_batch(torch.zeros((1, 3, *size)), maxface=True, landmarks=False)
+
+    def get_grids(self, h1, w1):
+        if h1 != self.last_h or w1 != self.last_w or self.grids is None:
+            grids = []
+            for scale in [8,16,32]:
+                ny = h1//scale
+                nx = w1//scale
+                yv, xv = torch.meshgrid([torch.arange(ny), torch.arange(nx)])
+                grid = torch.stack((xv, yv), 2).view((1,1,ny, nx, 2)).float()
+                grids.append(grid.to(self.test_device))
+            self.grids = grids
+            self.last_w = w1
+            self.last_h = h1
+        return self.grids
+
+    def letterbox_batch(self, images):
+        """
+        Resize each image like `detect` (shorter side to `inpSize`) and pad them bottom-right to a shared shape that
+        is a multiple of 32.
+
+        Args:
+            images: List of BGR uint8 (h, w, 3) arrays, or an RGB (n, 3, h, w) tensor with values in [0, 255].
+
+        Returns:
+            (batch (n, 3, H, W) float in [0, 1] on the detector device, per-image (x, y) scale factors (n, 2)).
+        """
+        if isinstance(images, torch.Tensor):
+            images = images.to(self.test_device)
+            # same values as the uint8 round trip of the numpy path
+            tensors = list(images.clamp(0, 255).to(torch.uint8))
+        else:
+            tensors = [torch.from_numpy(cv2.cvtColor(image, cv2.COLOR_BGR2RGB)).to(self.test_device).permute(2, 0, 1)
+                       for image in images]
+        sizes = []
+        for image in tensors:
+            h0, w0 = image.shape[-2:]
+            r = self.inpSize / min(h0, w0)
+            sizes.append((h0, w0, int(h0*r+31)//32*32, int(w0*r+31)//32*32))
+        H = max(size[2] for size in sizes)
+        W = max(size[3] for size in sizes)
+
+        batch = torch.zeros((len(tensors), 3, H, W), device=self.test_device)
+        gains = torch.zeros((len(tensors), 2), device=self.test_device)
+        for i, (image, (h0, w0, h1, w1)) in enumerate(zip(tensors, sizes)):
+            batch[i, :, :h1, :w1] = torch.nn.functional.interpolate(
+                image[None].float(), size=(h1, w1), mode="bilinear", align_corners=False)[0] / 255
+            gains[i, 0], gains[i, 1] = w0 / w1, h0 / h1
+        return batch, gains
+
+    @torch.no_grad()
+    def detect_batch(self, images, maxface=False, to_numpy=True, landmarks=True):
+        """
+        Detect faces in many images with one forward and a batched NMS on the device.
+
+        Args:
+            images: List of BGR uint8 (h, w, 3) arrays, or an RGB (n, 3, h, w) tensor with values in [0, 255].
+            maxface (bool): Keep only the largest face of each image.
+            to_numpy (bool): Return numpy arrays, otherwise tensors on the detector device.
+            landmarks (bool): Also map the landmarks back to the images, otherwise kpss is None.
+
+        Returns:
+            bboxes (k, 4) as x, y, w, h, kpss (k, 5, 2), scores (k,) and image index (k,), in the coordinates of the
+            input images.
+        """
+        batch, gains = self.letterbox_batch(images)
+        pred = self.model(batch, self.get_grids(batch.shape[-2], batch.shape[-1]))
+        det, image_index = non_max_suppression_face_batch(pred, self.conf_thres, self.iou_thres)
+
+        gains = gains[image_index]
+        xyxy = det[:, :4] * gains.repeat(1, 2)
+        bboxes = torch.cat((xyxy[:, :2], xyxy[:, 2:] - xyxy[:, :2]), 1)
+        kpss = det[:, 5:15].view(-1, 5, 2) * gains[:, None] if landmarks else None
+        scores = det[:, 4]
+
+        if maxface and len(image_index):
+            # largest box per image: sort by area, then a stable sort by image puts each image's largest first
+            order = torch.argsort(bboxes[:, 2] * bboxes[:, 3], descending=True)
+            order = order[torch.sort(image_index[order], stable=True).indices]
+            first = torch.ones_like(order, dtype=torch.bool)
+            first[1:] = image_index[order][1:] != image_index[order][:-1]
+            keep = order[first]
+            bboxes, scores, image_index = bboxes[keep], scores[keep], image_index[keep]
+            kpss = kpss[keep] if landmarks else None
+
+        outputs = (bboxes, kpss, scores, image_index)
+        if to_numpy:
+            outputs = tuple(None if output is None else output.cpu().numpy() for output in outputs)
+        return outputs
 
     @torch.no_grad()
     def detect(self, srcimg):
@@ -244,19 +455,7 @@ class DetFace():
             img = img.unsqueeze(0)
 
         # Inference
-        if h1 != self.last_h or w1 != self.last_w or self.grids is None:
-            grids = []
-            for scale in [8,16,32]:
-                ny = h1//scale
-                nx = w1//scale
-                yv, xv = torch.meshgrid([torch.arange(ny), torch.arange(nx)])
-                grid = torch.stack((xv, yv), 2).view((1,1,ny, nx, 2)).float()
-                grids.append(grid.to(self.test_device))
-            self.grids = grids
-            self.last_w = w1
-            self.last_h = h1
-
-        pred = self.model(img, self.grids).cpu()
+        pred = self.model(img, self.get_grids(h1, w1)).cpu()
 
         # Apply NMS
         det = non_max_suppression_face(pred, self.conf_thres, self.iou_thres)[0]
@@ -0,0 +1,187 @@
+"""
+In-process MP4 encoding with PyAV: the frames are encoded and the audio track muxed in one pass, without a silent
+intermediate file and an ffmpeg subprocess to add the audio.
+
+    with VideoWriter("out.mp4", fps=25, audio="speech.wav", crf=18) as writer:
+        for frame in frames:            # (h, w, 3) uint8 RGB, or (t, h, w, 3) batches
+            writer.write(frame)
+
+The audio is re-encoded to AAC, interleaved with the video as the frames come in, and cut at the end of the video
+(like `ffmpeg -shortest` when the audio is the longer stream). With `fragmented=True` the output is a fragmented MP4
+that can be written to a non-seekable stream, e.g. an HTTP response, see `iter_video_bytes`.
+"""
+import io
+import os
+from fractions import Fraction
+
+import numpy as np
+
+try:
+    import av
+except ImportError:
+    av = None
+
+FRAGMENTED_MOVFLAGS = "frag_keyframe+empty_moov+default_base_moof"
+
+
+def video_writer_kwargs(args):
+    """`VideoWriter` settings from the command line arguments."""
+    return dict(codec=args.video_codec, crf=args.video_crf, preset=args.video_preset, threads=args.video_threads)
+
+
+class VideoWriter:
+    """
+    Encodes RGB frames to an MP4 file or binary stream, optionally with the audio of `audio`.
+
+    Args:
+        output: Path or writable binary file object.
+        fps (float): Frame rate.
+        audio: Path or bytes of an audio (or video) file to mux, None for a silent video.
+        codec (str): Video encoder, e.g. 'libx264' or 'libx265'.
+        crf (int): Constant rate factor of the x264/x265 encoders, lower is better quality.
+        preset (str): Encoder speed preset.
+        threads (int): Encoder threads, 0 lets the encoder decide.
+        fragmented (bool): Write a fragmented MP4, which needs no seeking.
+        audio_bitrate (int): AAC bitrate.
+    """
+    def __init__(self, output, fps, audio=None, codec="libx264", crf=18, preset="medium", threads=0,
+                 fragmented=False, audio_bitrate=128000):
+        if av is None:
+            raise ImportError("VideoWriter requires PyAV: pip install av")
+        options = {"movflags": FRAGMENTED_MOVFLAGS} if fragmented else {}
+        is_path = isinstance(output, (str, os.PathLike))
+        self.container = av.open(os.fspath(output) if is_path else output, mode="w",
+                                 format=None if is_path else "mp4", options=options)
+        self.fps = Fraction(fps).limit_denominator(1001)
+        self.video_stream = self.container.add_stream(codec, rate=self.fps,
+                                                      options={"crf": str(crf), "preset": preset})
+        self.video_stream.pix_fmt = "yuv420p"
+        self.video_stream.codec_context.thread_type = "AUTO"
+        self.video_stream.codec_context.thread_count = threads
+        self.num_frames = 0
+        self.closed = False
+
+        self.audio_input = None
+        self.audio_stream = None
+        if audio is not None:
+            self.audio_input = av.open(io.BytesIO(audio) if isinstance(audio, bytes) else audio)
+            input_stream = self.audio_input.streams.audio[0]
+            self.audio_layout = "mono" if len(input_stream.codec_context.layout.channels) == 1 else "stereo"
+            self.audio_rate = input_stream.codec_context.sample_rate
+            self.audio_stream = self.container.add_stream("aac", rate=self.audio_rate)
+            self.audio_stream.codec_context.layout = self.audio_layout
+            self.audio_stream.codec_context.bit_rate = audio_bitrate
+            resampler = av.AudioResampler(format="fltp", layout=self.audio_layout, rate=self.audio_rate)
+            self.audio_frames = self._resampled(self.audio_input.decode(input_stream), resampler)
+            self.pending_audio = None
+            self.audio_samples = 0
+
+    @staticmethod
+    def _resampled(frames, resampler):
+        for frame in frames:
+            yield from resampler.resample(frame)
+        yield from resampler.resample(None)
+
+    def write(self, frames):
+        """Encode one (h, w, 3) uint8 RGB frame, or a (t, h, w, 3) batch of them."""
+        frames = np.asarray(frames)
+        for frame in (frames if frames.ndim == 4 else frames[None]):
+            if self.num_frames == 0:
+                self.video_stream.height, self.video_stream.width = frame.shape[:2]
+            video_frame = av.VideoFrame.from_ndarray(np.ascontiguousarray(frame), format="rgb24")
+            video_frame.pts = self.num_frames
+            video_frame.time_base = 1 / self.fps
+            self.container.mux(self.video_stream.encode(video_frame))
+            self.num_frames += 1
+            self._write_audio(self.num_frames / self.fps)
+
+    def _write_audio(self, until, final=False):
+        """Mux the audio up to `until` seconds, the last frame cut there when `final`."""
+        if self.audio_stream is None:
+            return
+        end = int(until * self.audio_rate)
+        while self.audio_samples < end:
+            frame = self.pending_audio or next(self.audio_frames, None)
+            self.pending_audio = None
+            if frame is None:
+                # the audio is shorter than the video
+                break
+            if self.audio_samples + frame.samples > end:
+                if not final:
+                    self.pending_audio = frame
+                    break
+                samples = frame.to_ndarray()[:, :end - self.audio_samples]
+                frame = av.AudioFrame.from_ndarray(np.ascontiguousarray(samples), format="fltp",
+                                                   layout=self.audio_layout)
+                frame.sample_rate = self.audio_rate
+            frame.pts = self.audio_samples
+            frame.time_base = Fraction(1, self.audio_rate)
+            self.audio_samples += frame.samples
+            self.container.mux(self.audio_stream.encode(frame))
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.container.mux(self.video_stream.encode(None))
+            if self.audio_stream is not None:
+                self._write_audio(self.num_frames / self.fps, final=True)
+                self.container.mux(self.audio_stream.encode(None))
+        finally:
+            self.container.close()
+            if self.audio_input is not None:
+                self.audio_input.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def video_frames(chunks, num_frames=None):
+    """
+    uint8 RGB frames of the first video of (b, c, t, h, w) tensor chunks in [0, 1], as (t, h, w, 3) batches cut after
+    `num_frames` frames. Each chunk is converted as the encoder asks for it.
+    """
+    for chunk in chunks:
+        video = chunk[0]
+        if num_frames is not None:
+            video = video[:, :num_frames]
+            num_frames -= video.shape[1]
+        if video.shape[1]:
+            yield (video.permute(1, 2, 3, 0).clamp(0, 1) * 255.).byte().cpu().numpy()
+        if num_frames == 0:
+            break
+
+
+def write_video(output, frames, fps, audio=None, **kwargs):
+    """Encode `frames` (an array of (h, w, 3) uint8 RGB frames, or any iterable of them) to `output`."""
+    with VideoWriter(output, fps, audio=audio, **kwargs) as writer:
+        for frame in frames:
+            writer.write(frame)
+
+
+class _ChunkSink:
+    """Non-seekable binary output that hands out what has been written so far."""
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        chunks, self.chunks = self.chunks, []
+        return chunks
+
+
+def iter_video_bytes(frames, fps, audio=None, **kwargs):
+    """Encode `frames` to a fragmented MP4 and yield its bytes as the fragments are written."""
+    sink = _ChunkSink()
+    with VideoWriter(sink, fps, audio=audio, fragmented=True, **kwargs) as writer:
+        for frame in frames:
+            writer.write(frame)
+            yield from sink.drain()
+    yield from sink.drain()
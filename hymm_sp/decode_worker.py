@@ -0,0 +1,71 @@
+import queue
+import threading
+from concurrent.futures import Future
+
+import torch
+from loguru import logger
+
+
+class DecodeWorker:
+    """
+    Decodes denoised latents on a background thread, so the next job can start denoising while the VAE decodes.
+
+    `submit` returns a `concurrent.futures.Future` holding what `pipeline.decode_video_latents` returns. At most
+    `max_pending` decodes are queued, further submits block, which bounds the latents kept alive on the GPU. On CUDA
+    the decode runs on its own stream, ordered after the work that produced the latents.
+
+    `lock` serializes the VAE with other users on the main thread (e.g. encoding the reference image on a cache
+    miss): the VAE may be offloaded, and two encodes or decodes at once would need twice its memory. It does not
+    serialize the VAE with the denoising, so the sampler does not use the worker with `--cpu-offload`.
+    """
+    def __init__(self, pipeline, max_pending=2, lock=None):
+        self.pipeline = pipeline
+        self.lock = lock or threading.Lock()
+        self.jobs = queue.Queue(maxsize=max_pending)
+        self.thread = threading.Thread(target=self._run, name="vae-decode", daemon=True)
+        self.thread.start()
+
+    def submit(self, latents, **decode_kwargs):
+        if not self.thread.is_alive():
+            raise RuntimeError("The decode worker is closed.")
+        future = Future()
+        ready = None
+        if latents.is_cuda:
+            ready = torch.cuda.Event()
+            ready.record(torch.cuda.current_stream(latents.device))
+        self.jobs.put((future, latents, ready, decode_kwargs))
+        return future
+
+    def _run(self):
+        stream = None
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            future, latents, ready, decode_kwargs = job
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                with torch.no_grad(), self.lock:
+                    if ready is not None:
+                        if stream is None:
+                            stream = torch.cuda.Stream(latents.device)
+                        stream.wait_event(ready)
+                        latents.record_stream(stream)
+                        with torch.cuda.stream(stream):
+                            video = self.pipeline.decode_video_latents(latents, **decode_kwargs)
+                        stream.synchronize()
+                    else:
+                        video = self.pipeline.decode_video_latents(latents, **decode_kwargs)
+                future.set_result(video)
+            except BaseException as e:
+                logger.exception("VAE decoding failed")
+                future.set_exception(e)
+            del job, latents
+
+    def close(self, wait=True):
+        """Finish the queued decodes and stop the thread."""
+        if self.thread.is_alive():
+            self.jobs.put(None)
+            if wait:
+                self.thread.join()
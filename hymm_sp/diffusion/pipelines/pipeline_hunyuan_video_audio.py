@@ -44,6 +44,7 @@ from diffusers.pipelines.pipeline_utils import DiffusionPipeline
 from hymm_sp.constants import PRECISION_TO_TYPE
 from hymm_sp.vae.autoencoder_kl_causal_3d import AutoencoderKLCausal3D
 from hymm_sp.text_encoder import TextEncoder
+from hymm_sp.data_kits.audio_preprocessor import AudioWindows
 from einops import rearrange
 from ...modules import HYVideoDiffusionTransformer
 
@@ -152,7 +153,7 @@ class HunyuanVideoAudioPipeline(DiffusionPipeline):
     model_cpu_offload_seq = "text_encoder->text_encoder_2->transformer->vae"
     _optional_components = ["text_encoder_2"]
     _exclude_from_cpu_offload = ["transformer"]
-    _callback_tensor_inputs = ["latents", "prompt_embeds", "negative_prompt_embeds"]
+    _callback_tensor_inputs = ["latents", "latents_all", "prompt_embeds", "negative_prompt_embeds"]
 
     def __init__(
         self,
@@ -413,6 +414,7 @@ class HunyuanVideoAudioPipeline(DiffusionPipeline):
         negative_prompt=None,
         prompt_embeds: Optional[torch.Tensor] = None,
         negative_prompt_embeds: Optional[torch.Tensor] = None,
+        negative_attention_mask: Optional[torch.Tensor] = None,
         lora_scale: Optional[float] = None,
         clip_skip: Optional[int] = None,
         text_encoder: Optional[TextEncoder] = None,
@@ -445,19 +447,14 @@ class HunyuanVideoAudioPipeline(DiffusionPipeline):
             # textual inversion: process multi-vector tokens if necessary
             if isinstance(self, TextualInversionLoaderMixin):
                 prompt = self.maybe_convert_prompt(prompt, text_encoder.tokenizer)
-            text_inputs = text_encoder.text2tokens(prompt, data_type=data_type) # data_type: video, text_inputs: {'input_ids', 'attention_mask'}
-            
-            text_keys = ['input_ids', 'attention_mask']
-            
-            if pixel_value_llava is not None:
-                text_inputs['pixel_value_llava'] = pixel_value_llava
-                text_inputs['attention_mask'] = torch.cat([text_inputs['attention_mask'], torch.ones((1, 575)).to(text_inputs['attention_mask'])], dim=1)
-
-        
             if clip_skip is None:
-                prompt_outputs = text_encoder.encode(text_inputs, data_type=data_type)
-                prompt_embeds = prompt_outputs.hidden_state
+                # cached per (encoder, template, prompt, image) when the prompt cache is enabled
+                prompt_embeds, attention_mask = text_encoder.encode_prompt(prompt, pixel_value_llava, data_type=data_type)
             else:
+                text_inputs = text_encoder.text2tokens(prompt, data_type=data_type) # data_type: video, text_inputs: {'input_ids', 'attention_mask'}
+                if pixel_value_llava is not None:
+                    text_inputs['pixel_value_llava'] = pixel_value_llava
+                    text_inputs['attention_mask'] = torch.cat([text_inputs['attention_mask'], torch.ones((1, 575)).to(text_inputs['attention_mask'])], dim=1)
                 prompt_outputs = text_encoder.encode(text_inputs, output_hidden_states=True, data_type=data_type)
                 # Access the `hidden_states` first, that contains a tuple of
                 # all the hidden states from the encoder layers. Then index into
@@ -468,8 +465,8 @@ class HunyuanVideoAudioPipeline(DiffusionPipeline):
                 # obtaining the final prompt representations passes through the LayerNorm
                 # layer.
                 prompt_embeds = text_encoder.model.text_model.final_layer_norm(prompt_embeds)
+                attention_mask = prompt_outputs.attention_mask
 
-            attention_mask = prompt_outputs.attention_mask
             if attention_mask is not None:
                 attention_mask = attention_mask.to(device)
                 bs_embed, seq_len = attention_mask.shape
@@ -521,20 +518,9 @@ class HunyuanVideoAudioPipeline(DiffusionPipeline):
             if isinstance(self, TextualInversionLoaderMixin):
                 uncond_tokens = self.maybe_convert_prompt(uncond_tokens, text_encoder.tokenizer)            
             # max_length = prompt_embeds.shape[1]
-            uncond_input = text_encoder.text2tokens(uncond_tokens, data_type=data_type)
+            negative_prompt_embeds, negative_attention_mask = text_encoder.encode_prompt(
+                uncond_tokens, uncond_pixel_value_llava, data_type=data_type)
 
-            # if hasattr(text_encoder.model.config, "use_attention_mask") and text_encoder.model.config.use_attention_mask:
-            #     attention_mask = uncond_input.attention_mask.to(device)
-            # else:
-            #     attention_mask = None
-            if uncond_pixel_value_llava is not None:
-                uncond_input['pixel_value_llava'] = uncond_pixel_value_llava
-                uncond_input['attention_mask'] = torch.cat([uncond_input['attention_mask'], torch.ones((1, 575)).to(uncond_input['attention_mask'])], dim=1)
-
-            negative_prompt_outputs = text_encoder.encode(uncond_input, data_type=data_type)
-            negative_prompt_embeds = negative_prompt_outputs.hidden_state
-
-            negative_attention_mask = negative_prompt_outputs.attention_mask
             if negative_attention_mask is not None:
                 negative_attention_mask = negative_attention_mask.to(device)
                 _, seq_len = negative_attention_mask.shape
@@ -578,6 +564,85 @@ class HunyuanVideoAudioPipeline(DiffusionPipeline):
         else: image = image.cpu().float()
         return image
 
+    def decode_video_latents(self, latents, enable_tiling=True, generator=None, cpu_offload=0):
+        """
+        Decode denoised latents, as returned with `output_type="latent"`, into a float32 CPU video in [0, 1].
+        Returns None on ranks that do not receive the decoded video (sharded VAE decoding).
+        """
+        vae_dtype = PRECISION_TO_TYPE[self.args.vae_precision]
+        vae_autocast_enabled = (vae_dtype != torch.float32) and not self.args.val_disable_autocast
+
+        expand_temporal_dim = False
+        if len(latents.shape) == 4:
+            if isinstance(self.vae, AutoencoderKLCausal3D):
+                latents = latents.unsqueeze(2)
+                expand_temporal_dim = True
+        elif len(latents.shape) == 5:
+            pass
+        else:
+            raise ValueError(
+                f"Only support latents with shape (b, c, h, w) or (b, c, f, h, w), but got {latents.shape}.")
+
+        if hasattr(self.vae.config, 'shift_factor') and self.vae.config.shift_factor:
+            latents = latents / self.vae.config.scaling_factor + self.vae.config.shift_factor
+        else:
+            latents = latents / self.vae.config.scaling_factor
+
+        with torch.autocast(device_type=latents.device.type, dtype=vae_dtype, enabled=vae_autocast_enabled):
+            if enable_tiling:
+                if cpu_offload:
+                    self.vae.post_quant_conv.to('cuda')
+                    self.vae.decoder.to('cuda')
+                # the tiling is private to this thread, an encode on another thread keeps its own
+                with self.vae.thread_tiling():
+                    self.vae.enable_tiling()
+                    image = self.vae.decode(latents, return_dict=False, generator=generator)[0]
+                if cpu_offload:
+                    self.vae.post_quant_conv.to('cpu')
+                    self.vae.decoder.to('cpu')
+                    torch.cuda.empty_cache()
+            else:
+                image = self.vae.decode(latents, return_dict=False, generator=generator)[0]
+        if image is None:
+            return None
+
+        if expand_temporal_dim or image.shape[2] == 1:
+            image = image.squeeze(2)
+
+        image = (image / 2 + 0.5).clamp(0, 1)
+        # we always cast to float32 as this does not cause significant overhead and is compatible with bfloa16
+        return image.cpu().float()
+
+    def stream_video_latents(self, latents, enable_tiling=True, cpu_offload=0, chunk_size=None):
+        """
+        Like `decode_video_latents` for (b, c, f, h, w) latents, but yields the video chunk by chunk along time as
+        `vae.stream_decode` decodes it, so the first frames can be encoded before the whole clip is decoded.
+        """
+        vae_dtype = PRECISION_TO_TYPE[self.args.vae_precision]
+        vae_autocast_enabled = (vae_dtype != torch.float32) and not self.args.val_disable_autocast
+
+        if hasattr(self.vae.config, 'shift_factor') and self.vae.config.shift_factor:
+            latents = latents / self.vae.config.scaling_factor + self.vae.config.shift_factor
+        else:
+            latents = latents / self.vae.config.scaling_factor
+
+        if cpu_offload:
+            self.vae.post_quant_conv.to('cuda')
+            self.vae.decoder.to('cuda')
+        # the chunks are along time, only the spatial tiling applies; it is read when the stream is created
+        with self.vae.thread_tiling():
+            self.vae.enable_spatial_tiling(enable_tiling)
+            chunks = self.vae.stream_decode(latents, chunk_size=chunk_size)
+        try:
+            with torch.autocast(device_type=latents.device.type, dtype=vae_dtype, enabled=vae_autocast_enabled):
+                for image in chunks:
+                    yield (image / 2 + 0.5).clamp(0, 1).cpu().float()
+        finally:
+            if cpu_offload:
+                self.vae.post_quant_conv.to('cpu')
+                self.vae.decoder.to('cpu')
+                torch.cuda.empty_cache()
+
     def prepare_extra_func_kwargs(self, func, kwargs):
         # prepare extra kwargs for the scheduler step, since not all schedulers have the same signature
         # eta (η) is only used with the DDIMScheduler, it will be ignored for other schedulers.
@@ -778,7 +843,7 @@ class HunyuanVideoAudioPipeline(DiffusionPipeline):
         pixel_value_llava: Union[torch.Tensor],                # [1, 3, 336, 336]
         uncond_pixel_value_llava: Union[torch.Tensor],
         face_masks: Union[torch.Tensor],                              # [b f h w]
-        audio_prompts: Union[torch.Tensor], 
+        audio_prompts: AudioWindows,                                  # gathered per segment
         uncond_audio_prompts: Union[torch.Tensor], 
         motion_exp: Union[torch.Tensor], 
         motion_pose: Union[torch.Tensor], 
@@ -801,6 +866,8 @@ class HunyuanVideoAudioPipeline(DiffusionPipeline):
         attention_mask: Optional[torch.Tensor] = None,
         negative_prompt_embeds: Optional[torch.Tensor] = None,
         negative_attention_mask: Optional[torch.Tensor] = None,
+        negative_prompt_embeds_2: Optional[torch.Tensor] = None,
+        negative_attention_mask_2: Optional[torch.Tensor] = None,
         output_type: Optional[str] = "pil",
         return_dict: bool = True,
         cross_attention_kwargs: Optional[Dict[str, Any]] = None,
@@ -868,6 +935,11 @@ class HunyuanVideoAudioPipeline(DiffusionPipeline):
             negative_prompt_embeds (`torch.Tensor`, *optional*):
                 Pre-generated negative text embeddings. Can be used to easily tweak text inputs (prompt weighting). If
                 not provided, `negative_prompt_embeds` are generated from the `negative_prompt` input argument.
+            negative_prompt_embeds_2 (`torch.Tensor`, *optional*):
+                Pre-generated negative embeddings of `text_encoder_2`, e.g. of a constant negative prompt encoded once
+                at load time. If not provided, they are generated from the `negative_prompt` input argument.
+            negative_attention_mask_2 (`torch.Tensor`, *optional*):
+                The attention mask of `negative_prompt_embeds_2`.
                 
             output_type (`str`, *optional*, defaults to `"pil"`):
                 The output format of the generated image. Choose between `PIL.Image` or `np.array`.
@@ -980,6 +1052,7 @@ class HunyuanVideoAudioPipeline(DiffusionPipeline):
                 negative_prompt=negative_prompt,
                 prompt_embeds=prompt_embeds,
                 negative_prompt_embeds=negative_prompt_embeds,
+                negative_attention_mask=negative_attention_mask,
                 lora_scale=lora_scale,
                 clip_skip=self.clip_skip,
                 text_encoder=self.text_encoder,
@@ -998,7 +1071,8 @@ class HunyuanVideoAudioPipeline(DiffusionPipeline):
                     do_classifier_free_guidance=self.do_classifier_free_guidance,
                     negative_prompt=negative_prompt,
                     prompt_embeds=None,
-                    negative_prompt_embeds=None,
+                    negative_prompt_embeds=negative_prompt_embeds_2,
+                    negative_attention_mask=negative_attention_mask_2,
                     lora_scale=lora_scale,
                     clip_skip=self.clip_skip,
                     text_encoder=self.text_encoder_2,
@@ -1068,16 +1142,13 @@ class HunyuanVideoAudioPipeline(DiffusionPipeline):
 
         target_dtype = PRECISION_TO_TYPE[self.args.precision]
         autocast_enabled = (target_dtype != torch.float32) and not self.args.val_disable_autocast
-        vae_dtype = PRECISION_TO_TYPE[self.args.vae_precision]
-        vae_autocast_enabled = (vae_dtype != torch.float32) and not self.args.val_disable_autocast
 
         # 7. Denoising loop
         num_warmup_steps = len(timesteps) - num_inference_steps * self.scheduler.order
         self._num_timesteps = len(timesteps)
 
         latents_all = latents.clone()
-        pad_audio_length = (audio_prompts.shape[1] // 128 + 1) * 128 + 4 - audio_prompts.shape[1]
-        audio_prompts_all = torch.cat([audio_prompts, torch.zeros_like(audio_prompts[:, :pad_audio_length])], dim=1)
+        audio_prompts_all = audio_prompts.with_length((audio_prompts.shape[1] // 128 + 1) * 128 + 4)
 
 
         shift = 0
@@ -1090,7 +1161,7 @@ class HunyuanVideoAudioPipeline(DiffusionPipeline):
             infer_length = 33
             shift_offset = 0
             latents_all = latents_all[:, :, :33]
-            audio_prompts_all = audio_prompts_all[:, :132]
+            audio_prompts_all = audio_prompts_all.with_length(132)
 
         if cpu_offload: torch.cuda.empty_cache()
         with self.progress_bar(total=num_inference_steps) as progress_bar:
@@ -1117,7 +1188,7 @@ class HunyuanVideoAudioPipeline(DiffusionPipeline):
                     latents = latents_all[:, :, idx_list].clone()
 
                     idx_list_audio = [ii % audio_prompts_all.shape[1] for ii in range(index_start * 4, (index_start + frames_per_batch) * 4 - 3)]
-                    audio_prompts = audio_prompts_all[:, idx_list_audio].clone()
+                    audio_prompts = audio_prompts_all.frames(idx_list_audio)
 
                     # expand the latents if we are doing classifier free guidance
                     if self.do_classifier_free_guidance:
@@ -1309,50 +1380,22 @@ class HunyuanVideoAudioPipeline(DiffusionPipeline):
                         step_idx = i // getattr(self.scheduler, "order", 1)
                         callback(step_idx, t, latents)
 
+        if self.interrupt:
+            # aborted from `callback_on_step_end`, e.g. after a bad preview
+            self.maybe_free_model_hooks()
+            return (None, )
+
         latents = latents_all.float()[:, :, :video_length] 
         if cpu_offload: torch.cuda.empty_cache()
 
-        if not output_type == "latent":
-            expand_temporal_dim = False
-            if len(latents.shape) == 4:
-                if isinstance(self.vae, AutoencoderKLCausal3D):
-                    latents = latents.unsqueeze(2)
-                    expand_temporal_dim = True
-            elif len(latents.shape) == 5:
-                pass
-            else:
-                raise ValueError(
-                    f"Only support latents with shape (b, c, h, w) or (b, c, f, h, w), but got {latents.shape}.")
-
-            if hasattr(self.vae.config, 'shift_factor') and self.vae.config.shift_factor:
-                latents = latents / self.vae.config.scaling_factor + self.vae.config.shift_factor
-            else:
-                latents = latents / self.vae.config.scaling_factor
-
-            with torch.autocast(device_type="cuda", dtype=vae_dtype, enabled=vae_autocast_enabled):
-                if enable_tiling:
-                    self.vae.enable_tiling()
-                    if cpu_offload:
-                        self.vae.post_quant_conv.to('cuda')
-                        self.vae.decoder.to('cuda')
-                    image = self.vae.decode(latents, return_dict=False, generator=generator)[0]
-                    self.vae.disable_tiling()
-                    if cpu_offload:
-                        self.vae.post_quant_conv.to('cpu')
-                        self.vae.decoder.to('cpu')
-                        torch.cuda.empty_cache()
-                else:
-                    image = self.vae.decode(latents, return_dict=False, generator=generator)[0]
+        if output_type == "latent":
+            image = latents
+        else:
+            image = self.decode_video_latents(latents, enable_tiling=enable_tiling, generator=generator,
+                                              cpu_offload=cpu_offload)
             if image is None:
                 return (None, )
 
-            if expand_temporal_dim or image.shape[2] == 1:
-                image = image.squeeze(2)
-
-        image = (image / 2 + 0.5).clamp(0, 1)
-        # we always cast to float32 as this does not cause significant overhead and is compatible with bfloa16
-        image = image.cpu().float()
-
         # Offload all models
         self.maybe_free_model_hooks()
         
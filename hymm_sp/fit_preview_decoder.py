@@ -0,0 +1,80 @@
+"""
+Fit the latent preview decoder (`hymm_sp/vae/preview.py`) against the VAE.
+
+    python3 hymm_sp/fit_preview_decoder.py --videos assets/videos/*.mp4 --output weights/preview_decoder.pt
+    python3 hymm_sp/fit_preview_decoder.py --videos ... --hidden-channels 64 --steps 2000   # distill a conv net
+"""
+import argparse
+import imageio
+import numpy as np
+import torch
+import torch.nn.functional as F
+from loguru import logger
+
+from hymm_sp.vae import load_vae
+from hymm_sp.vae.preview import LatentPreviewer, distill_preview, fit_linear_preview, preview_targets
+
+
+def load_clip(path, num_frames, size):
+    """Read up to `num_frames` (4n+1) frames as a (1, 3, f, size, size) tensor in [-1, 1]."""
+    reader = imageio.get_reader(path)
+    frames = []
+    for frame in reader:
+        frames.append(np.asarray(frame)[..., :3])
+        if len(frames) == num_frames:
+            break
+    reader.close()
+    frames = frames[:(len(frames) - 1) // 4 * 4 + 1]
+    video = torch.from_numpy(np.stack(frames)).permute(3, 0, 1, 2).float()
+    video = F.interpolate(video, size=(size, size), mode="bilinear", align_corners=False)
+    return (video / 127.5 - 1.).unsqueeze(0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fit the latent preview decoder")
+    parser.add_argument("--videos", type=str, nargs="+", required=True, help="Videos (or images) to fit on.")
+    parser.add_argument("--output", type=str, required=True, help="Where to save the preview decoder.")
+    parser.add_argument("--vae", type=str, default="884-16c-hy0801", help="Name of the VAE model.")
+    parser.add_argument("--vae-precision", type=str, default="fp16", help="Precision mode for the VAE model.")
+    parser.add_argument("--frames", type=int, default=33, help="Frames per clip, 4n+1.")
+    parser.add_argument("--size", type=int, default=512, help="Clips are resized to size x size.")
+    parser.add_argument("--hidden-channels", type=int, default=0,
+                        help="0 fits a linear projection, otherwise distills a small conv net on top of it.")
+    parser.add_argument("--steps", type=int, default=2000, help="Distillation steps.")
+    parser.add_argument("--lr", type=float, default=1e-3, help="Distillation learning rate.")
+    args = parser.parse_args()
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    vae, _, s_ratio, t_ratio = load_vae(args.vae, args.vae_precision, logger=logger, device=device)
+    vae.enable_tiling()
+
+    latents, targets = [], []
+    with torch.no_grad():
+        for path in args.videos:
+            video = load_clip(path, args.frames, args.size).to(device)
+            with torch.autocast(device_type=device.type, dtype=vae.dtype, enabled=vae.dtype != torch.float32):
+                latent = vae.encode(video).latent_dist.mode()
+            latents.append(latent.float() * vae.config.scaling_factor)
+            targets.append(preview_targets(video, t_ratio, s_ratio))
+            logger.info(f"encoded {path}: {tuple(latent.shape)}")
+
+    # All clips share the spatial size, so they can be stacked along time.
+    latents = torch.cat(latents, dim=2)
+    targets = torch.cat(targets, dim=2)
+
+    previewer = fit_linear_preview(latents, targets)
+    if args.hidden_channels > 0:
+        linear = previewer
+        previewer = LatentPreviewer(latent_channels=linear.latent_channels, hidden_channels=args.hidden_channels)
+        previewer.proj.load_state_dict(linear.proj.state_dict())
+        previewer = distill_preview(previewer, latents, targets, steps=args.steps, lr=args.lr, logger=logger)
+
+    with torch.no_grad():
+        mse = F.mse_loss(previewer.to(latents.device)(latents), targets)
+    logger.info(f"preview mse: {mse.item():.5f}")
+    previewer.save_pretrained(args.output)
+    logger.info(f"saved preview decoder to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
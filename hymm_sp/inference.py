@@ -93,6 +93,25 @@ class Inference(object):
         vae_kwargs = {'s_ratio': s_ratio, 't_ratio': t_ratio}
         
         # Text encoder
+        text_encoder, text_encoder_2 = Inference.build_text_encoders(args, device)
+
+        return cls(args=args, 
+                   vae=vae, 
+                   vae_kwargs=vae_kwargs, 
+                   text_encoder=text_encoder,
+                   model=model, 
+                   text_encoder_2=text_encoder_2, 
+                   device=device, 
+                   logger=logger)
+
+    @staticmethod
+    def build_text_encoders(args, device, use_service=True):
+        """
+        The LLaVA and (optional) CLIP text encoders. With `--text-encoder-service` and `use_service`, they are clients
+        of the service and only load their tokenizers.
+        """
+        service_address = args.text_encoder_service if use_service else None
+        encoder_device = 'cpu' if args.cpu_offload and service_address is None else device
         if args.prompt_template_video is not None:
             crop_start = PROMPT_TEMPLATE[args.prompt_template_video].get("crop_start", 0)
         else:
@@ -111,8 +130,10 @@ class Inference(object):
                                    hidden_state_skip_layer = args.hidden_state_skip_layer,
                                    apply_final_norm = args.apply_final_norm,
                                    reproduce = args.reproduce,
+                                   truncate_mode = args.text_encoder_truncate,
+                                   service_address = service_address,
                                    logger = logger,
-                                   device = 'cpu' if args.cpu_offload else device ,
+                                   device = encoder_device ,
                                    )
         text_encoder_2 = None
         if args.text_encoder_2 is not None:
@@ -122,18 +143,11 @@ class Inference(object):
                                          tokenizer_type=args.tokenizer_2,
                                          use_attention_mask=args.use_attention_mask,
                                          reproduce=args.reproduce,
+                                         service_address=service_address,
                                          logger=logger,
-                                         device='cpu' if args.cpu_offload else device , # if not args.use_cpu_offload else 'cpu'
+                                         device=encoder_device , # if not args.use_cpu_offload else 'cpu'
                                          )
-
-        return cls(args=args, 
-                   vae=vae, 
-                   vae_kwargs=vae_kwargs, 
-                   text_encoder=text_encoder,
-                   model=model, 
-                   text_encoder_2=text_encoder_2, 
-                   device=device, 
-                   logger=logger)
+        return text_encoder, text_encoder_2
 
     @staticmethod
     def load_state_dict(args, model, ckpt_path):
@@ -4,7 +4,6 @@ import time
 import numpy as np
 from pathlib import Path
 from loguru import logger
-import imageio
 import torch
 from einops import rearrange
 import torch.distributed
@@ -14,6 +13,7 @@ from hymm_sp.config import parse_args
 from hymm_sp.audio_video_inference import HunyuanVideoSampler
 from hymm_sp.data_kits.audio_dataset import VideoAudioTextLoaderVal
 from hymm_sp.data_kits.face_align import AlignImage
+from hymm_sp.data_kits.video_writer import video_frames, video_writer_kwargs, write_video
 
 # Import config for memory optimization
 import sys
@@ -160,7 +160,8 @@ def load_models_with_offloading(args, device):
     print("👤 Loading face alignment...")
     BASE_DIR = f'{MODEL_OUTPUT_PATH}/ckpts/det_align/'
     det_path = os.path.join(BASE_DIR, 'detface.pt')    
-    align_instance = AlignImage("cuda", det_path=det_path)
+    align_instance = AlignImage(args.det_device, det_path=det_path, backend=args.det_backend,
+                                num_threads=args.det_threads)
     
     monitor_memory_usage("After face alignment loading")
     
@@ -179,7 +180,6 @@ def process_batch_ultra_low_memory(args, batch, hunyuan_video_sampler, wav2vec,
     videoid = batch['videoid'][0]
     audio_path = str(batch["audio_path"][0])
     save_path = args.save_path 
-    output_path = f"{save_path}/{videoid}.mp4"
     output_audio_path = f"{save_path}/{videoid}_audio.mp4"
     
     print(f"🎬 Processing: {videoid}")
@@ -237,7 +237,19 @@ def process_batch_ultra_low_memory(args, batch, hunyuan_video_sampler, wav2vec,
         wav2vec = wav2vec.cpu()
         cleanup_memory()
     
+    if 'samples_stream' in samples:
+        # decoded chunk by chunk and encoded as it goes, the whole clip is never held in memory
+        print(f"💾 Saving video: {output_audio_path}")
+        write_video(output_audio_path, video_frames(samples['samples_stream'], num_frames=batch["audio_len"][0]),
+                    fps.item(), audio=audio_path, **video_writer_kwargs(args))
+        del samples
+        cleanup_memory()
+        print(f"✅ Completed: {videoid}")
+        return output_audio_path
+
     # Process samples
+    if 'samples_future' in samples:
+        samples['samples'] = samples.pop('samples_future').result()
     sample = samples['samples'][0].unsqueeze(0)
     sample = sample[:, :, :batch["audio_len"][0]]
     
@@ -258,13 +270,9 @@ def process_batch_ultra_low_memory(args, batch, hunyuan_video_sampler, wav2vec,
         final_frames.append(frame)
     final_frames = np.stack(final_frames, axis=0)
     
-    # Save video
-    print(f"💾 Saving video: {output_path}")
-    imageio.mimsave(output_path, final_frames, fps=fps.item())
-    
-    # Add audio with ffmpeg
-    print(f"🎵 Adding audio: {output_audio_path}")
-    os.system(f"ffmpeg -i '{output_path}' -i '{audio_path}' -shortest '{output_audio_path}' -y -loglevel quiet; rm '{output_path}'")
+    # Save video with its audio in one pass
+    print(f"💾 Saving video: {output_audio_path}")
+    write_video(output_audio_path, final_frames, fps.item(), audio=audio_path, **video_writer_kwargs(args))
     
     # Final cleanup
     del final_frames, video
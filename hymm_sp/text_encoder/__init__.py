@@ -10,6 +10,7 @@ from transformers import (
 )
 from transformers.utils import ModelOutput
 from ..constants import TEXT_ENCODER_PATH, TOKENIZER_PATH, PRECISION_TO_TYPE
+from ..cache import hash_tensor, make_key
 
 CPU_OFFLOAD = int(os.environ.get("CPU_OFFLOAD", 0))
 print(f'text_encoder: cpu_offload={CPU_OFFLOAD}')
@@ -50,6 +51,20 @@ def load_text_encoder(text_encoder_type,
 
     return text_encoder, text_encoder_path
 
+def get_llama_parts(model):
+    """
+    (decoder model holding `layers` and `norm`, causal LM holding `lm_head`) of a Llava model, across the
+    transformers layouts before and after the `LlavaModel` refactor.
+    """
+    language_model = getattr(model, "language_model", None)
+    if language_model is not None and hasattr(language_model, "lm_head"):
+        return language_model.model, language_model
+    inner = getattr(model, "model", None)
+    if inner is not None and hasattr(inner, "language_model") and hasattr(model, "lm_head"):
+        return inner.language_model, model
+    raise ValueError(f"Unsupported Llava layout: {type(model).__name__}")
+
+
 def load_tokenizer(tokenizer_type,
                    tokenizer_path=None,
                    padding_side="right",
@@ -109,6 +124,8 @@ class TextEncoder(nn.Module):
                  hidden_state_skip_layer: Optional[int] = None,
                  apply_final_norm: bool = False,
                  reproduce: bool = False,
+                 truncate_mode: str = "none",
+                 service_address: Optional[str] = None,
                  logger=None,
                  device=None,
                  ):
@@ -147,15 +164,35 @@ class TextEncoder(nn.Module):
         else:
             raise ValueError(f"Unsupported text encoder type: {text_encoder_type}")
 
-        self.model, self.model_path = load_text_encoder(
-            text_encoder_type=self.text_encoder_type,
-            text_encoder_precision=self.precision,
-            text_encoder_path=self.model_path,
-            logger=self.logger,
-            device=device
-        )
-        self.dtype = self.model.dtype
-        self.device = self.model.device
+        self.prompt_cache = None
+        # only relevant if the LLM is truncated to `hidden_state_skip_layer`
+        self.truncate_mode = "none"
+        self.skipped_modules = None
+
+        self.client = None
+        if service_address is not None:
+            # Client mode: the model runs in a `TextEncoderService`, only the tokenizer is loaded here.
+            from .service import TextEncoderClient
+            self.client = TextEncoderClient(service_address, text_encoder_type)
+            info = self.client.check_compatible(self)
+            self.model = None
+            self.model_path = info["model_path"]
+            self.dtype = info["dtype"]
+            self.device = torch.device(device if device is not None else "cuda" if torch.cuda.is_available() else "cpu")
+            if self.logger is not None:
+                self.logger.info(f"Using {text_encoder_type} of the text encoder service at {service_address}")
+        else:
+            self.model, self.model_path = load_text_encoder(
+                text_encoder_type=self.text_encoder_type,
+                text_encoder_precision=self.precision,
+                text_encoder_path=self.model_path,
+                logger=self.logger,
+                device=device
+            )
+            self.dtype = self.model.dtype
+            self.device = self.model.device
+            if truncate_mode != "none":
+                self.truncate_to_skip_layer(unload=truncate_mode == "unload")
 
         self.tokenizer, self.tokenizer_path = load_tokenizer(
             tokenizer_type=self.tokenizer_type,
@@ -167,6 +204,159 @@ class TextEncoder(nn.Module):
     def __repr__(self):
         return f"{self.text_encoder_type} ({self.precision} - {self.model_path})"
 
+    def truncate_to_skip_layer(self, unload=False):
+        """
+        Stop the LLM at the layer picked by `hidden_state_skip_layer`: the layers after it are dropped and the final
+        norm and LM head become identities, so the logits are exactly `hidden_states[-(skip + 1)]` of the full model,
+        without running the skipped layers or materializing the per-layer hidden states.
+
+        Args:
+            unload (bool): Free the dropped layers and the LM head. Otherwise they are kept aside (off the module
+                tree, so they are neither moved nor run) and `restore_full_model` brings them back.
+        """
+        skip = self.hidden_state_skip_layer
+        if self.client is not None or "llama" not in self.text_encoder_type or not skip:
+            # The last hidden state already is the output of the full model.
+            return
+        if self.truncate_mode != "none":
+            return
+        decoder, causal_lm = get_llama_parts(self.model)
+        num_layers = len(decoder.layers)
+        assert 0 < skip < num_layers, f"hidden_state_skip_layer {skip} out of range for {num_layers} layers"
+
+        skipped = {"layers": decoder.layers[num_layers - skip:], "norm": decoder.norm, "lm_head": causal_lm.lm_head}
+        decoder.layers = decoder.layers[:num_layers - skip]
+        decoder.norm = nn.Identity()
+        causal_lm.lm_head = nn.Identity()
+        self.truncate_mode = "unload" if unload else "stop"
+        if unload:
+            del skipped
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+        else:
+            self.skipped_modules = skipped
+        if self.logger is not None:
+            self.logger.info(f"{self.text_encoder_type}: running {num_layers - skip}/{num_layers} layers "
+                             f"({self.truncate_mode} mode)")
+
+    def restore_full_model(self):
+        """Undo `truncate_to_skip_layer(unload=False)`."""
+        if self.truncate_mode == "none":
+            return
+        if self.skipped_modules is None:
+            raise RuntimeError("The skipped layers were unloaded, reload the text encoder to restore them.")
+        decoder, causal_lm = get_llama_parts(self.model)
+        device = next(decoder.parameters()).device
+        decoder.layers.extend(m.to(device) for m in self.skipped_modules["layers"])
+        decoder.norm = self.skipped_modules["norm"].to(device)
+        causal_lm.lm_head = self.skipped_modules["lm_head"].to(device)
+        self.skipped_modules = None
+        self.truncate_mode = "none"
+
+    def enable_image_feature_cache(self, cache):
+        """
+        Memoize the LLaVA vision tower + projector output per image content in `cache` (a `FeatureCache`), so a
+        known reference image skips the vision tower even when the prompt changes.
+        """
+        if self.client is not None:
+            # the vision tower runs in the service
+            return
+        get_image_features = getattr(self.model, "get_image_features", None)
+        if get_image_features is None:
+            if self.logger is not None:
+                self.logger.warning(f"{self.text_encoder_type} has no `get_image_features`, "
+                                    f"image features are not cached (needs a newer transformers).")
+            return
+
+        def cached_get_image_features(pixel_values, *args, **kwargs):
+            key = make_key("llava_image_features", self.model_path, str(self.dtype), hash_tensor(pixel_values),
+                           args, sorted(kwargs.items()))
+            return cache.get_or_compute(key, lambda: get_image_features(pixel_values, *args, **kwargs),
+                                        device=pixel_values.device)
+
+        self.model.get_image_features = cached_get_image_features
+
+    def enable_prompt_cache(self, cache):
+        """Memoize `encode_prompt` in `cache` (a `FeatureCache`)."""
+        self.prompt_cache = cache
+
+    def prompt_cache_key(self, text, pixel_value_llava=None, data_type='video', name='person'):
+        if isinstance(text, (list, tuple)) and len(text) == 1:
+            # a single prompt tokenizes the same as a string
+            text = text[0]
+        image_hash = hash_tensor(pixel_value_llava) if pixel_value_llava is not None else None
+        return make_key("prompt_embeds", self.text_encoder_type, self.model_path, self.prompt_template_video,
+                        self.max_length, text, name, image_hash, self.hidden_state_skip_layer, self.apply_final_norm,
+                        str(self.dtype), data_type)
+
+    def encode_prompt(self, text, pixel_value_llava=None, data_type='video', name='person'):
+        """
+        Tokenize and encode `text`, with the LLaVA image if given.
+
+        Returns:
+            (hidden_state, attention_mask), served from the prompt cache when enabled. A hit neither runs nor moves
+            the model (`CPU_OFFLOAD`). Do not modify the returned tensors in place.
+        """
+        def encode():
+            text_inputs = self.text2tokens(text, data_type=data_type, name=name)
+            if pixel_value_llava is not None:
+                text_inputs['pixel_value_llava'] = pixel_value_llava
+                text_inputs['attention_mask'] = torch.cat([text_inputs['attention_mask'], torch.ones((1, 575)).to(text_inputs['attention_mask'])], dim=1)
+            outputs = self.encode(text_inputs, data_type=data_type)
+            return outputs.hidden_state, outputs.attention_mask
+
+        if self.prompt_cache is None:
+            return encode()
+        key = self.prompt_cache_key(text, pixel_value_llava, data_type, name)
+        return self.prompt_cache.get_or_compute(key, encode, device=self.device)
+
+    def encode_prompts(self, texts, pixel_values_llava=None, data_type='video', name='person', batch_size=8):
+        """
+        Encode many prompts with batched forwards, e.g. to warm the prompt cache for a whole dataset.
+
+        Prompts are padded to `max_length` by the tokenizer, so rows of a batch only differ by whether they carry a
+        LLaVA image. Cached prompts are not encoded again, and new results go into the prompt cache under the same
+        keys as `encode_prompt`.
+
+        Args:
+            texts (list of str): Prompts.
+            pixel_values_llava (list, *optional*): LLaVA image (1, 3, H, W) or None for each prompt.
+            batch_size (int): Maximum prompts per forward.
+
+        Returns:
+            List of (hidden_state, attention_mask) per prompt, each with a batch dimension of 1.
+        """
+        if pixel_values_llava is None:
+            pixel_values_llava = [None] * len(texts)
+        assert len(pixel_values_llava) == len(texts), "Expected one LLaVA image (or None) per prompt."
+
+        results = [None] * len(texts)
+        keys = [None] * len(texts)
+        todo = {False: [], True: []}
+        for i, (text, pixel_value_llava) in enumerate(zip(texts, pixel_values_llava)):
+            if self.prompt_cache is not None:
+                keys[i] = self.prompt_cache_key(text, pixel_value_llava, data_type, name)
+                results[i] = self.prompt_cache.get(keys[i], device=self.device)
+            if results[i] is None:
+                todo[pixel_value_llava is not None].append(i)
+
+        for with_image, indices in todo.items():
+            for start in range(0, len(indices), batch_size):
+                chunk = indices[start:start + batch_size]
+                text_inputs = self.text2tokens([texts[i] for i in chunk], data_type=data_type, name=name)
+                if with_image:
+                    text_inputs['pixel_value_llava'] = torch.cat([pixel_values_llava[i] for i in chunk], dim=0)
+                    text_inputs['attention_mask'] = torch.cat([text_inputs['attention_mask'], torch.ones((len(chunk), 575)).to(text_inputs['attention_mask'])], dim=1)
+                outputs = self.encode(text_inputs, data_type=data_type)
+                for row, i in enumerate(chunk):
+                    # clone, so a cached row does not keep the whole batch alive
+                    hidden_state = outputs.hidden_state[row:row + 1].clone()
+                    attention_mask = outputs.attention_mask[row:row + 1].clone() if outputs.attention_mask is not None else None
+                    results[i] = (hidden_state, attention_mask)
+                    if self.prompt_cache is not None:
+                        self.prompt_cache.put(keys[i], results[i])
+        return results
+
     @staticmethod
     def apply_text_to_template(text, template):
         """
@@ -244,12 +434,28 @@ class TextEncoder(nn.Module):
         use_attention_mask = use_default(use_attention_mask, self.use_attention_mask)
         hidden_state_skip_layer = use_default(hidden_state_skip_layer, self.hidden_state_skip_layer)
         do_sample = use_default(do_sample, not self.reproduce)
+        if self.client is not None:
+            if output_hidden_states:
+                raise ValueError("The text encoder service only returns the selected hidden state.")
+            return self.client.encode(batch_encoding, self.device, use_attention_mask=use_attention_mask,
+                                      hidden_state_skip_layer=hidden_state_skip_layer, data_type=data_type)
         if CPU_OFFLOAD:
             self.model.to('cuda')
             print(f'encode prompt: move text_encoder to cuda')
 
         attention_mask = batch_encoding["attention_mask"].to(self.model.device) if use_attention_mask else None
-        if 'pixel_value_llava' in batch_encoding:
+        truncated = self.truncate_mode != "none"
+        if truncated and (output_hidden_states or hidden_state_skip_layer != self.hidden_state_skip_layer):
+            raise ValueError(f"{self.text_encoder_type} is truncated to hidden_state_skip_layer="
+                             f"{self.hidden_state_skip_layer}, other layers are not available.")
+        if truncated:
+            # The truncated LLM has identity norm / LM head, its logits are the requested hidden state.
+            outputs = self.model(
+                input_ids=batch_encoding["input_ids"].to(self.model.device),
+                attention_mask=attention_mask,
+                pixel_values=batch_encoding["pixel_value_llava"].to(self.model.device) if 'pixel_value_llava' in batch_encoding else None,
+                use_cache=False)
+        elif 'pixel_value_llava' in batch_encoding:
             outputs = self.model(
                 input_ids=batch_encoding["input_ids"].to(self.model.device),
                 attention_mask=attention_mask,
@@ -260,7 +466,11 @@ class TextEncoder(nn.Module):
             input_ids=batch_encoding["input_ids"].to(self.model.device),
             attention_mask=attention_mask,
             output_hidden_states=output_hidden_states or hidden_state_skip_layer is not None,)
-        if hidden_state_skip_layer is not None:
+        if truncated:
+            last_hidden_state = outputs.logits.to(self.dtype)
+            if self.apply_final_norm:
+                last_hidden_state = self.model.final_layer_norm(last_hidden_state)
+        elif hidden_state_skip_layer is not None:
             last_hidden_state = outputs.hidden_states[-(hidden_state_skip_layer + 1)]
             # Real last hidden state already has layer norm applied. So here we only apply it
             # for intermediate layers.
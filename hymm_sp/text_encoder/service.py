@@ -0,0 +1,274 @@
+"""
+Out-of-process text encoding, so that the DiT workers of a host share one copy of the text encoders.
+
+Start the service with the text encoder arguments of the workers, then start the workers with the same
+`--text-encoder-service` address:
+
+    python3 -m hymm_sp.text_encoder.service --text-encoder-service /tmp/hymm_text_encoder.sock --ckpt ...
+
+Workers keep their tokenizers and send token ids (and the LLaVA image) over the Unix socket. The hidden states come
+back in POSIX shared memory, the worker maps them and copies them once, straight to its device.
+
+Requests are pickled, so only clients knowing the authkey may connect and the socket is only accessible to its owner.
+Set the same `HYMM_TEXT_ENCODER_AUTHKEY` on both sides, or leave it unset: the service then generates a random key
+and writes it next to the socket (`<socket>.key`, mode 0600), where workers of the same user read it.
+"""
+import math
+import os
+import secrets
+import socket
+import sys
+import threading
+from multiprocessing import shared_memory
+from multiprocessing.connection import Client, Listener
+
+import torch
+from loguru import logger
+
+from . import TextEncoderModelOutput
+
+AUTHKEY_ENV = "HYMM_TEXT_ENCODER_AUTHKEY"
+
+# Settings the worker tokenizes with, they have to match the encoder behind the service.
+COMPATIBILITY_KEYS = ("max_length", "prompt_template_video", "hidden_state_skip_layer", "apply_final_norm",
+                      "use_attention_mask")
+
+
+def authkey_path(address):
+    return f"{address}.key"
+
+
+def get_authkey(address):
+    """The key set in `HYMM_TEXT_ENCODER_AUTHKEY`, or else the one the service at `address` wrote next to its socket."""
+    if os.environ.get(AUTHKEY_ENV):
+        return os.environ[AUTHKEY_ENV].encode()
+    try:
+        with open(authkey_path(address), "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        raise RuntimeError(f"No authkey for the text encoder service at {address}: set {AUTHKEY_ENV} or start the "
+                           f"service as the same user, so that {authkey_path(address)} can be read.") from None
+
+
+def create_authkey(address):
+    """Random key written to the owner-only key file of `address`, replacing a stale one."""
+    authkey = secrets.token_bytes(32)
+    path = authkey_path(address)
+    if os.path.exists(path):
+        os.unlink(path)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, "wb") as f:
+        f.write(authkey)
+    return authkey
+
+
+def _attach(name):
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    shm = shared_memory.SharedMemory(name=name)
+    # The service owns the block, don't let this process' resource tracker unlink it at exit.
+    from multiprocessing import resource_tracker
+    resource_tracker.unregister(shm._name, "shared_memory")
+    return shm
+
+
+def to_shared(tensor, blocks):
+    """Copy `tensor` into a new shared memory block (appended to `blocks`) and return its descriptor."""
+    if tensor is None:
+        return None
+    tensor = tensor.detach().contiguous()
+    shm = shared_memory.SharedMemory(create=True, size=max(tensor.numel() * tensor.element_size(), 1))
+    blocks.append(shm)
+    if tensor.numel() > 0:
+        torch.frombuffer(shm.buf, dtype=tensor.dtype, count=tensor.numel()).view(tensor.shape).copy_(tensor)
+    return shm.name, tuple(tensor.shape), tensor.dtype
+
+
+def from_shared(descriptor, device):
+    """Copy the tensor described by `descriptor` out of shared memory onto `device`."""
+    if descriptor is None:
+        return None
+    name, shape, dtype = descriptor
+    if math.prod(shape) == 0:
+        return torch.empty(shape, dtype=dtype, device=device)
+    shm = _attach(name)
+    try:
+        view = torch.frombuffer(shm.buf, dtype=dtype, count=math.prod(shape)).view(shape)
+        tensor = view.to(device, copy=True)
+        del view
+    finally:
+        shm.close()
+    return tensor
+
+
+def free_blocks(blocks):
+    for shm in blocks:
+        shm.close()
+        shm.unlink()
+    blocks.clear()
+
+
+class TextEncoderService:
+    """
+    Serves `encode` of local `TextEncoder`s, keyed by their `text_encoder_type`, over a Unix socket.
+
+    Each connection is handled on its own thread, calls to the same encoder are serialized. The shared memory of a
+    reply is released when its connection sends the next request or closes.
+
+    Without `authkey` or `HYMM_TEXT_ENCODER_AUTHKEY`, a random key is written to the key file of `address` and
+    removed again by `close`.
+    """
+    def __init__(self, encoders, address, authkey=None):
+        self.encoders = encoders
+        self.locks = {name: threading.Lock() for name in encoders}
+        self.key_file = None
+        if authkey is None and os.environ.get(AUTHKEY_ENV):
+            authkey = os.environ[AUTHKEY_ENV].encode()
+        if authkey is None:
+            authkey = create_authkey(address)
+            self.key_file = authkey_path(address)
+        self.authkey = authkey
+        # the socket is created owner-only instead of chmod-ed afterwards, so there is no window for others
+        umask = os.umask(0o177)
+        try:
+            self.listener = Listener(address, family="AF_UNIX", authkey=self.authkey)
+        finally:
+            os.umask(umask)
+        self.address = self.listener.address
+        self.closed = threading.Event()
+        self.thread = None
+
+    def start(self):
+        """Serve on a background thread."""
+        self.thread = threading.Thread(target=self.serve_forever, name="text-encoder-service", daemon=True)
+        self.thread.start()
+        return self
+
+    def serve_forever(self):
+        while not self.closed.is_set():
+            try:
+                conn = self.listener.accept()
+            except Exception as e:
+                if self.closed.is_set():
+                    break
+                logger.warning(f"Rejected text encoder client: {e}")
+                continue
+            if self.closed.is_set():
+                conn.close()
+                break
+            threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+
+    def close(self):
+        if self.closed.is_set():
+            return
+        self.closed.set()
+        try:
+            # wake up `accept`. A bare connection fails the handshake, a client would wait forever for it if the loop
+            # saw `closed` between two accepts and is already gone.
+            with socket.socket(socket.AF_UNIX) as sock:
+                sock.connect(self.address)
+        except OSError:
+            pass
+        if self.thread is not None:
+            self.thread.join()
+        self.listener.close()
+        if self.key_file is not None and os.path.exists(self.key_file):
+            os.unlink(self.key_file)
+
+    def info(self, name):
+        encoder = self.encoders[name]
+        info = {key: getattr(encoder, key) for key in COMPATIBILITY_KEYS}
+        info.update(text_encoder_type=encoder.text_encoder_type, model_path=encoder.model_path, dtype=encoder.dtype)
+        return info
+
+    def encode(self, name, batch_encoding, kwargs, blocks):
+        with self.locks[name], torch.no_grad():
+            outputs = self.encoders[name].encode(batch_encoding, **kwargs)
+        return to_shared(outputs.hidden_state, blocks), to_shared(outputs.attention_mask, blocks)
+
+    def _handle(self, conn):
+        blocks = []
+        try:
+            while True:
+                try:
+                    request = conn.recv()
+                except EOFError:
+                    break
+                free_blocks(blocks)
+                try:
+                    if request[0] == "info":
+                        reply = self.info(request[1])
+                    elif request[0] == "encode":
+                        reply = self.encode(*request[1:], blocks)
+                    else:
+                        raise ValueError(f"Unknown request: {request[0]}")
+                    conn.send(("ok", reply))
+                except Exception as e:
+                    logger.exception("Text encoder request failed")
+                    free_blocks(blocks)
+                    conn.send(("error", f"{type(e).__name__}: {e}"))
+        finally:
+            free_blocks(blocks)
+            conn.close()
+
+
+class TextEncoderClient:
+    """Connection of a worker to the `TextEncoderService` encoder called `name`. Thread-safe."""
+    def __init__(self, address, name, authkey=None):
+        self.name = name
+        self.conn = Client(address, family="AF_UNIX", authkey=authkey or get_authkey(address))
+        self.lock = threading.Lock()
+
+    def _call(self, request, reply_fn=lambda reply: reply):
+        with self.lock:
+            self.conn.send(request)
+            status, reply = self.conn.recv()
+            if status != "ok":
+                raise RuntimeError(f"Text encoder service: {reply}")
+            # the reply's shared memory stays valid until the next request on this connection
+            return reply_fn(reply)
+
+    def info(self):
+        return self._call(("info", self.name))
+
+    def check_compatible(self, encoder):
+        info = self.info()
+        mismatches = [key for key in COMPATIBILITY_KEYS if info[key] != getattr(encoder, key)]
+        if mismatches:
+            raise ValueError(f"The text encoder service runs {self.name} with different settings: "
+                             + ", ".join(f"{key}={info[key]!r} (here {getattr(encoder, key)!r})" for key in mismatches))
+        return info
+
+    def encode(self, batch_encoding, device, **kwargs):
+        batch_encoding = {key: value.cpu() if isinstance(value, torch.Tensor) else value
+                          for key, value in batch_encoding.items()}
+        hidden_state, attention_mask = self._call(
+            ("encode", self.name, batch_encoding, kwargs),
+            lambda reply: (from_shared(reply[0], device), from_shared(reply[1], device)))
+        return TextEncoderModelOutput(hidden_state, attention_mask)
+
+    def close(self):
+        self.conn.close()
+
+
+def main():
+    from hymm_sp.config import parse_args
+    from hymm_sp.inference import Inference
+
+    args = parse_args()
+    if args.text_encoder_service is None:
+        raise ValueError("Pass the socket path to serve on with --text-encoder-service.")
+    if os.path.exists(args.text_encoder_service):
+        # left over by a previous run
+        os.unlink(args.text_encoder_service)
+    torch.set_grad_enabled(False)
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    encoders = Inference.build_text_encoders(args, device, use_service=False)
+    service = TextEncoderService({encoder.text_encoder_type: encoder for encoder in encoders if encoder is not None},
+                                 args.text_encoder_service)
+    logger.info(f"Serving {', '.join(service.encoders)} on {service.address}")
+    service.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
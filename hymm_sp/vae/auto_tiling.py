@@ -0,0 +1,183 @@
+import math
+from dataclasses import dataclass
+from typing import Optional, Sequence, Tuple
+
+import torch
+
+# Full-resolution activations that are alive at the same time inside a resnet / upsampler
+# (input, norm, activation, padded copy, conv output, fp32 upcast of the nearest upsample).
+ACTIVATION_COPIES = 6
+TEMPORAL_TILE_CANDIDATES = (32, 24, 16, 12, 8, 4)
+SPATIAL_TILE_STEP = 8
+
+
+@dataclass
+class TileMemoryModel:
+    """
+    Peak activation bytes of one forward pass of the encoder or decoder:
+    `bytes_per_voxel * pixel_voxels + bytes_per_token_pair * latent_tokens ** 2 + overhead`.
+
+    `pixel_voxels` counts frames * height * width in pixel space (input of the encoder, output of the decoder),
+    `latent_tokens` counts the tokens of the mid-block attention, whose causal mask is materialized.
+    """
+    bytes_per_voxel: float
+    bytes_per_token_pair: float = 0.
+    overhead: float = 0.
+
+    def __call__(self, pixel_voxels: int, latent_tokens: int) -> float:
+        return self.bytes_per_voxel * pixel_voxels + self.bytes_per_token_pair * latent_tokens ** 2 + self.overhead
+
+
+@dataclass
+class TilingPlan:
+    use_spatial_tiling: bool
+    use_temporal_tiling: bool
+    tile_latent_min_size: int
+    tile_latent_min_tsize: int
+    tile_batch_size: int = 1
+    estimated_bytes: float = 0.
+
+
+def default_memory_model(vae, kind: str = "decode", dtype: torch.dtype = torch.float16) -> TileMemoryModel:
+    """Analytic (uncalibrated) memory model derived from the VAE config."""
+    elem = torch.finfo(dtype).bits // 8
+    channels = vae.config.block_out_channels
+    if kind == "decode":
+        # The last up block runs at full resolution, and so does the upsampler of the block before it.
+        full_res_channels = max(channels[:2])
+    else:
+        full_res_channels = channels[0]
+    bytes_per_token_pair = elem if vae.config.mid_block_causal_attn else 0.
+    return TileMemoryModel(ACTIVATION_COPIES * full_res_channels * elem, bytes_per_token_pair)
+
+
+def _tile_workload(vae, latent_frames: int, latent_h: int, latent_w: int, batch_size: int = 1):
+    s_ratio = vae.config.spatial_compression_ratio
+    t_ratio = vae.config.time_compression_ratio
+    pixel_frames = 1 + (latent_frames - 1) * t_ratio
+    pixel_voxels = batch_size * pixel_frames * latent_h * s_ratio * latent_w * s_ratio
+    latent_tokens = latent_frames * latent_h * latent_w
+    return pixel_voxels, latent_tokens
+
+
+@torch.no_grad()
+def calibrate_memory_model(vae, kind: str = "decode", device=None, dtype: Optional[torch.dtype] = None,
+                           tile_shapes: Sequence[Tuple[int, int]] = ((2, 8), (3, 8), (2, 16), (3, 16), (5, 16))):
+    """
+    Fit a `TileMemoryModel` by measuring the peak CUDA memory of the encoder or decoder on a few small tiles.
+
+    Args:
+        tile_shapes: (latent frames, latent spatial size) of the probe tiles.
+    """
+    device = torch.device(device or vae.device)
+    assert device.type == "cuda", "Memory calibration needs a CUDA device."
+    dtype = dtype or vae.dtype
+    s_ratio = vae.config.spatial_compression_ratio
+    t_ratio = vae.config.time_compression_ratio
+
+    features, peaks = [], []
+    for latent_frames, latent_size in tile_shapes:
+        if kind == "decode":
+            x = torch.randn(1, vae.config.latent_channels, latent_frames, latent_size, latent_size,
+                            device=device, dtype=dtype)
+            fn = lambda t: vae.decoder(vae.post_quant_conv(t))
+        else:
+            x = torch.randn(1, vae.config.in_channels, 1 + (latent_frames - 1) * t_ratio,
+                            latent_size * s_ratio, latent_size * s_ratio, device=device, dtype=dtype)
+            fn = lambda t: vae.quant_conv(vae.encoder(t))
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        base = torch.cuda.memory_allocated(device)
+        out = fn(x)
+        torch.cuda.synchronize(device)
+        peaks.append(torch.cuda.max_memory_allocated(device) - base)
+        del out, x
+
+        pixel_voxels, latent_tokens = _tile_workload(vae, latent_frames, latent_size, latent_size)
+        features.append([pixel_voxels, latent_tokens ** 2, 1.])
+
+    A = torch.tensor(features, dtype=torch.float64)
+    b = torch.tensor(peaks, dtype=torch.float64).unsqueeze(1)
+    coeffs = torch.linalg.lstsq(A, b).solution.squeeze(1).clamp(min=0).tolist()
+    return TileMemoryModel(*coeffs)
+
+
+def plan_tiling(vae, shape, budget_bytes: float, kind: str = "decode",
+                memory_model: Optional[TileMemoryModel] = None, dtype: torch.dtype = torch.float16) -> TilingPlan:
+    """
+    Pick spatial / temporal tile sizes and the number of tiles decoded (or encoded) per batch for a byte budget.
+
+    Args:
+        shape: (b, c, t, h, w) of the latents to decode, or of the pixels to encode.
+        budget_bytes: Bytes available for activations and the assembled output.
+
+    Returns:
+        `TilingPlan` with tiling disabled when the whole clip fits, otherwise the largest tiles that fit.
+    """
+    s_ratio = vae.config.spatial_compression_ratio
+    t_ratio = vae.config.time_compression_ratio
+    elem = torch.finfo(dtype).bits // 8
+    memory_model = memory_model or default_memory_model(vae, kind, dtype)
+    overlap = 1 - vae.tile_overlap_factor
+
+    B, _, T, H, W = shape
+    if kind == "encode":
+        T, H, W = (T - 1) // t_ratio + 1, H // s_ratio, W // s_ratio
+
+    # The assembled output (decoded video or latents) is alive next to the per-tile activations, twice during concat.
+    if kind == "decode":
+        pixel_voxels, _ = _tile_workload(vae, T, H, W, B)
+        output_bytes = 2 * vae.config.out_channels * pixel_voxels * elem
+    else:
+        output_bytes = 2 * 2 * vae.config.latent_channels * B * T * H * W * elem
+
+    whole = memory_model(*_tile_workload(vae, T, H, W, B)) + output_bytes
+    if whole <= budget_bytes:
+        return TilingPlan(False, False, vae.tile_latent_min_size, vae.tile_latent_min_tsize, 1, whole)
+
+    temporal_sizes = [None] + [t for t in TEMPORAL_TILE_CANDIDATES if t < T - 1]
+    spatial_sizes = [None] + list(range(math.ceil(max(H, W) / SPATIAL_TILE_STEP) * SPATIAL_TILE_STEP - SPATIAL_TILE_STEP,
+                                        0, -SPATIAL_TILE_STEP))
+    best = None
+    for tsize in temporal_sizes:
+        tile_frames = T if tsize is None else tsize + 1
+        n_temporal = 1 if tsize is None else math.ceil(T / int(tsize * overlap))
+        for size in spatial_sizes:
+            tile_h, tile_w = (H, W) if size is None else (min(H, size), min(W, size))
+            n_spatial = 1 if size is None else math.ceil(H / int(size * overlap)) * math.ceil(W / int(size * overlap))
+            per_tile = memory_model(*_tile_workload(vae, tile_frames, tile_h, tile_w, B))
+            if per_tile + output_bytes > budget_bytes:
+                continue
+            # Fewest tiles first, then the least recomputed overlap.
+            cost = (n_temporal * n_spatial, n_temporal * n_spatial * tile_frames * tile_h * tile_w)
+            if best is None or cost < best[0]:
+                best = (cost, tsize, size, per_tile, n_spatial)
+
+    if best is None:
+        # Nothing fits: fall back to the smallest tiles and let the allocator decide.
+        tsize, size = TEMPORAL_TILE_CANDIDATES[-1], SPATIAL_TILE_STEP
+        per_tile = memory_model(*_tile_workload(vae, tsize + 1, min(H, size), min(W, size), B))
+        return TilingPlan(True, True, size, tsize, 1, per_tile + output_bytes)
+
+    _, tsize, size, per_tile, n_spatial = best
+    tile_batch_size = 1
+    if size is not None:
+        tile_batch_size = int(max(1, min(n_spatial, (budget_bytes - output_bytes) // per_tile)))
+    return TilingPlan(
+        use_spatial_tiling=size is not None,
+        use_temporal_tiling=tsize is not None,
+        tile_latent_min_size=size or vae.tile_latent_min_size,
+        tile_latent_min_tsize=tsize or vae.tile_latent_min_tsize,
+        tile_batch_size=tile_batch_size,
+        estimated_bytes=per_tile * tile_batch_size + output_bytes,
+    )
+
+
+def apply_tiling_plan(vae, plan: TilingPlan):
+    vae.enable_spatial_tiling(plan.use_spatial_tiling)
+    vae.enable_temporal_tiling(plan.use_temporal_tiling)
+    vae.tile_latent_min_size = plan.tile_latent_min_size
+    vae.tile_sample_min_size = plan.tile_latent_min_size * vae.config.spatial_compression_ratio
+    vae.tile_latent_min_tsize = plan.tile_latent_min_tsize
+    vae.tile_sample_min_tsize = plan.tile_latent_min_tsize * vae.config.time_compression_ratio
+    vae.tile_batch_size = plan.tile_batch_size
@@ -1,11 +1,14 @@
 import os
 import math
+import contextlib
+import threading
 from typing import Dict, Optional, Tuple, Union
 from dataclasses import dataclass
 from torch import distributed as dist
 import loguru
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import torch.distributed
 
 RECOMMENDED_DTYPE = torch.float16
@@ -21,6 +24,10 @@ def mpi_rank():
 def mpi_world_size():
     return dist.get_world_size()
 
+def balanced_tile_assignment(num_tiles, world_size):
+    """Deal tile indices round-robin over the ranks, so per-rank counts differ by at most one."""
+    return [list(range(rank, num_tiles, world_size)) for rank in range(world_size)]
+
 
 class TorchIGather:
     def __init__(self):
@@ -93,6 +100,9 @@ from diffusers.models.attention_processor import (
 from diffusers.models.modeling_outputs import AutoencoderKLOutput
 from diffusers.models.modeling_utils import ModelMixin
 from .vae import DecoderCausal3D, BaseOutput, DecoderOutput, DiagonalGaussianDistribution, EncoderCausal3D
+from .unet_causal_3d_blocks import get_causal_cache, load_causal_cache, set_causal_cache
+from .auto_tiling import apply_tiling_plan, calibrate_memory_model, default_memory_model, plan_tiling
+from .cpu_decode import optimize_for_cpu_decode
 
 """
 use trt need install polygraphy and onnx-graphsurgeon
@@ -117,6 +127,37 @@ CPU_OFFLOAD = int(os.environ.get("CPU_OFFLOAD", 0))
 DISABLE_SP = int(os.environ.get("DISABLE_SP", 0))
 print(f'vae: cpu_offload={CPU_OFFLOAD}, DISABLE_SP={DISABLE_SP}')
 
+TILING_SETTINGS = ("use_spatial_tiling", "use_temporal_tiling", "tile_sample_min_size", "tile_latent_min_size",
+                   "tile_sample_min_tsize", "tile_latent_min_tsize", "tile_batch_size")
+_thread_tiling = threading.local()
+
+
+class _ThreadTilingSetting:
+    """
+    Tiling setting of `AutoencoderKLCausal3D`. Inside `thread_tiling` the current thread reads and writes its own
+    copy, otherwise the value of the instance.
+    """
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def _scope(self, obj):
+        return getattr(_thread_tiling, "scopes", {}).get(id(obj))
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        scope = self._scope(obj)
+        if scope is not None:
+            return scope[self.name]
+        try:
+            return obj.__dict__[self.name]
+        except KeyError:
+            raise AttributeError(self.name)
+
+    def __set__(self, obj, value):
+        scope = self._scope(obj)
+        (obj.__dict__ if scope is None else scope)[self.name] = value
+
 
 class AutoencoderKLCausal3D(ModelMixin, ConfigMixin, FromOriginalVAEMixin):
     r"""
@@ -152,6 +193,15 @@ class AutoencoderKLCausal3D(ModelMixin, ConfigMixin, FromOriginalVAEMixin):
 
     _supports_gradient_checkpointing = True
 
+    # private to the current thread inside `thread_tiling`
+    use_spatial_tiling = _ThreadTilingSetting()
+    use_temporal_tiling = _ThreadTilingSetting()
+    tile_sample_min_size = _ThreadTilingSetting()
+    tile_latent_min_size = _ThreadTilingSetting()
+    tile_sample_min_tsize = _ThreadTilingSetting()
+    tile_latent_min_tsize = _ThreadTilingSetting()
+    tile_batch_size = _ThreadTilingSetting()
+
     @register_to_config
     def __init__(
         self,
@@ -233,6 +283,11 @@ class AutoencoderKLCausal3D(ModelMixin, ConfigMixin, FromOriginalVAEMixin):
         )
         self.tile_latent_min_size = int(sample_size / (2 ** (len(self.config.block_out_channels) - 1)))
         self.tile_overlap_factor = 0.25
+        self.tile_batch_size = 1
+
+        # only relevant if auto tiling is enabled
+        self.auto_tiling_budget = None
+        self.tile_memory_models = {}
 
         use_trt_engine = False #if CPU_OFFLOAD else True
         # ============= parallism related code ===================
@@ -246,6 +301,17 @@ class AutoencoderKLCausal3D(ModelMixin, ConfigMixin, FromOriginalVAEMixin):
         
         self.use_trt_decoder = use_trt_engine
 
+        # only relevant if dist decode is enabled
+        self.use_dist_decode = False
+        self.dist_decode_group = None
+
+        # only relevant if cpu decode is enabled
+        self.cpu_decode_dtype = None
+        self.cpu_decode_channels_last = False
+
+        # set while `stream_decode` runs, the causal caches of the decoder are then in use
+        self.streaming = False
+
     @property
     def igather(self):
         assert self.nccl_gather and self.gather_to_rank0
@@ -296,6 +362,107 @@ class AutoencoderKLCausal3D(ModelMixin, ConfigMixin, FromOriginalVAEMixin):
         self.disable_spatial_tiling()
         self.disable_temporal_tiling()
 
+    @contextlib.contextmanager
+    def thread_tiling(self):
+        r"""
+        Keep the tiling changes of the current thread to itself until the block exits. Inside the block,
+        `enable_tiling`, the tile sizes and the plans of auto tiling start from the settings of the instance, are not
+        seen by other threads and are dropped on exit, so an encode and a decode running on different threads cannot
+        change each other's tiles. `encode`, `decode` and `stream_decode` use it for their auto tiling plans.
+        """
+        scopes = _thread_tiling.__dict__.setdefault("scopes", {})
+        if id(self) in scopes:
+            yield
+            return
+        scopes[id(self)] = {name: getattr(self, name) for name in TILING_SETTINGS}
+        try:
+            yield
+        finally:
+            del scopes[id(self)]
+
+    def enable_auto_tiling(self, budget_bytes: int, calibrate: bool = False):
+        r"""
+        Pick tiling, tile sizes and the number of tiles per batch on every `encode` / `decode` call so that the
+        activations fit into `budget_bytes`. Tiling is skipped entirely when the whole clip fits.
+
+        Args:
+            budget_bytes (`int`): Bytes available for activations and the assembled output.
+            calibrate (`bool`, *optional*, defaults to `False`):
+                Measure the per-tile memory of the encoder and decoder on the current CUDA device instead of using
+                the analytic estimate.
+        """
+        if self.auto_tiling_budget is None:
+            self._fixed_tiling = (self.tile_latent_min_size, self.tile_sample_min_size,
+                                  self.tile_latent_min_tsize, self.tile_sample_min_tsize)
+        self.auto_tiling_budget = budget_bytes
+        for kind in ("encode", "decode"):
+            if calibrate:
+                self.tile_memory_models[kind] = calibrate_memory_model(self, kind)
+            else:
+                self.tile_memory_models[kind] = default_memory_model(self, kind, self.dtype)
+
+    def disable_auto_tiling(self):
+        if self.auto_tiling_budget is None:
+            return
+        self.auto_tiling_budget = None
+        (self.tile_latent_min_size, self.tile_sample_min_size,
+         self.tile_latent_min_tsize, self.tile_sample_min_tsize) = self._fixed_tiling
+        self.tile_batch_size = 1
+
+    def _apply_auto_tiling(self, shape, kind):
+        plan = plan_tiling(self, shape, self.auto_tiling_budget, kind=kind,
+                           memory_model=self.tile_memory_models.get(kind), dtype=self.dtype)
+        apply_tiling_plan(self, plan)
+
+    def _run_tiles(self, fn, tiles):
+        """Apply `fn` to every tile, batching up to `tile_batch_size` tiles of the same shape."""
+        if self.tile_batch_size <= 1:
+            return [fn(tile) for tile in tiles]
+
+        outputs = [None] * len(tiles)
+        same_shape = {}
+        for idx, tile in enumerate(tiles):
+            same_shape.setdefault(tuple(tile.shape), []).append(idx)
+        for indices in same_shape.values():
+            for k in range(0, len(indices), self.tile_batch_size):
+                chunk = indices[k : k + self.tile_batch_size]
+                batch = fn(torch.cat([tiles[idx] for idx in chunk]))
+                for idx, out in zip(chunk, batch.split(tiles[chunk[0]].shape[0])):
+                    outputs[idx] = out
+        return outputs
+
+    def enable_dist_decode(self, group=None):
+        r"""
+        Shard the tiles of `spatial_tiled_decode` over the ranks of a `torch.distributed` process group (gloo or
+        nccl) and gather the decoded tiles on the first rank of the group. Other ranks get `None` back.
+
+        Args:
+            group (`ProcessGroup`, *optional*): The group to shard over, defaults to the world group.
+        """
+        self.use_dist_decode = True
+        self.dist_decode_group = group
+
+    def disable_dist_decode(self):
+        self.use_dist_decode = False
+        self.dist_decode_group = None
+
+    def enable_cpu_decode(self, dtype: torch.dtype = torch.bfloat16, channels_last: bool = True, fold: bool = True,
+                          compile: bool = False):
+        r"""
+        Optimize decoding of latents on the CPU: autocast to `dtype`, channels_last_3d activations and weights,
+        `post_quant_conv` folded into the first decoder conv and optionally a compiled decoder. Latents on other
+        devices decode as before, except that the fold is permanent.
+
+        Args:
+            dtype (`torch.dtype`, *optional*, defaults to `torch.bfloat16`): The CPU autocast dtype.
+            channels_last (`bool`, *optional*, defaults to `True`): Use the channels_last_3d memory format.
+            fold (`bool`, *optional*, defaults to `True`): Fold `post_quant_conv` into `decoder.conv_in`.
+            compile (`bool`, *optional*, defaults to `False`): `torch.compile` the decoder.
+        """
+        optimize_for_cpu_decode(self, channels_last=channels_last, fold=fold, compile=compile)
+        self.cpu_decode_dtype = dtype
+        self.cpu_decode_channels_last = channels_last
+
     def enable_slicing(self):
         r"""
         Enable sliced VAE decoding. When this option is enabled, the VAE will split the input tensor in slices to
@@ -424,6 +591,13 @@ class AutoencoderKLCausal3D(ModelMixin, ConfigMixin, FromOriginalVAEMixin):
         """
         assert len(x.shape) == 5, "The input tensor should have 5 dimensions"
 
+        with self.thread_tiling():
+            return self._encode(x, return_dict=return_dict)
+
+    def _encode(self, x: torch.FloatTensor, return_dict: bool = True):
+        if self.auto_tiling_budget is not None:
+            self._apply_auto_tiling(x.shape, "encode")
+
         if self.use_temporal_tiling and x.shape[2] > self.tile_sample_min_tsize:
             return self.temporal_tiled_encode(x, return_dict=return_dict)
         
@@ -483,6 +657,8 @@ class AutoencoderKLCausal3D(ModelMixin, ConfigMixin, FromOriginalVAEMixin):
                 returned.
 
         """
+        if self.streaming:
+            raise RuntimeError("The decoder is in use by `stream_decode`.")
 
         if self.parallel_decode:
             if z.dtype != RECOMMENDED_DTYPE:
@@ -493,17 +669,30 @@ class AutoencoderKLCausal3D(ModelMixin, ConfigMixin, FromOriginalVAEMixin):
                 )
                 z = z.to(RECOMMENDED_DTYPE)
 
-        if self.use_slicing and z.shape[0] > 1:
-            decoded_slices = [self._decode(z_slice).sample for z_slice in z.split(1)]
-            decoded = torch.cat(decoded_slices)
-        else:
-            decoded = self._decode(z).sample
+        with self.thread_tiling():
+            if self.auto_tiling_budget is not None:
+                self._apply_auto_tiling(z[:1].shape if self.use_slicing else z.shape, "decode")
+            decoded = self._decode_slices(z)
 
         if not return_dict:
             return (decoded,)
 
         return DecoderOutput(sample=decoded)
 
+    def _decode_slices(self, z: torch.FloatTensor) -> torch.FloatTensor:
+        autocast = contextlib.nullcontext()
+        if self.cpu_decode_dtype is not None and z.device.type == "cpu":
+            if self.cpu_decode_channels_last:
+                z = z.contiguous(memory_format=torch.channels_last_3d)
+            autocast = torch.autocast(device_type="cpu", dtype=self.cpu_decode_dtype,
+                                      enabled=self.cpu_decode_dtype != torch.float32)
+
+        with autocast:
+            if self.use_slicing and z.shape[0] > 1:
+                decoded_slices = [self._decode(z_slice).sample for z_slice in z.split(1)]
+                return torch.cat(decoded_slices)
+            return self._decode(z).sample
+
     def blend_v(self, a: torch.Tensor, b: torch.Tensor, blend_extent: int) -> torch.Tensor:
         blend_extent = min(a.shape[-2], b.shape[-2], blend_extent)
         if blend_extent == 0:
@@ -575,14 +764,17 @@ class AutoencoderKLCausal3D(ModelMixin, ConfigMixin, FromOriginalVAEMixin):
         row_limit = self.tile_latent_min_size - blend_extent
 
         # Split video into tiles and encode them separately.
+        tiles = [
+            x[:, :, :, i : i + self.tile_sample_min_size, j : j + self.tile_sample_min_size]
+            for i in range(0, x.shape[-2], overlap_size)
+            for j in range(0, x.shape[-1], overlap_size)
+        ]
+        encoded = iter(self._run_tiles(lambda tile: self.quant_conv(self.encoder(tile)), tiles))
         rows = []
         for i in range(0, x.shape[-2], overlap_size):
             row = []
             for j in range(0, x.shape[-1], overlap_size):
-                tile = x[:, :, :, i : i + self.tile_sample_min_size, j : j + self.tile_sample_min_size]
-                tile = self.encoder(tile)
-                tile = self.quant_conv(tile)
-                row.append(tile)
+                row.append(next(encoded))
             rows.append(row)
         result_rows = []
         for i, row in enumerate(rows):
@@ -628,7 +820,11 @@ class AutoencoderKLCausal3D(ModelMixin, ConfigMixin, FromOriginalVAEMixin):
 
         # Split z into overlapping tiles and decode them separately.
         # The tiles have an overlap to avoid seams between tiles.
-        if self.parallel_decode:
+        if self.use_dist_decode:
+            rows = self._dist_decode_tiles(z, overlap_size)
+            if rows is None:
+                return DecoderOutput(sample=None)
+        elif self.parallel_decode:
 
             rank = mpi_rank()
             torch.cuda.set_device(rank) # set device for trt_runner
@@ -729,16 +925,26 @@ class AutoencoderKLCausal3D(ModelMixin, ConfigMixin, FromOriginalVAEMixin):
                     row.append(next(decoded_results_iter).to(rank))
                 rows.append(row)
         else:
+            tiles = [
+                z[:, :, :, i : i + self.tile_latent_min_size, j : j + self.tile_latent_min_size]
+                for i in range(0, z.shape[-2], overlap_size)
+                for j in range(0, z.shape[-1], overlap_size)
+            ]
+            decoded = iter(self._run_tiles(lambda tile: self.decoder(self.post_quant_conv(tile)), tiles))
             rows = []
             for i in range(0, z.shape[-2], overlap_size):
                 row = []
                 for j in range(0, z.shape[-1], overlap_size):
-                    tile = z[:, :, :, i : i + self.tile_latent_min_size, j : j + self.tile_latent_min_size]
-                    tile = self.post_quant_conv(tile)
-                    decoded = self.decoder(tile)
-                    row.append(decoded)
+                    row.append(next(decoded))
                 rows.append(row)
 
+        dec = self._blend_tile_rows(rows, blend_extent, row_limit)
+        if not return_dict:
+            return (dec,)
+
+        return DecoderOutput(sample=dec)
+
+    def _blend_tile_rows(self, rows, blend_extent: int, row_limit: int) -> torch.FloatTensor:
         result_rows = []
         for i, row in enumerate(rows):
             result_row = []
@@ -751,12 +957,56 @@ class AutoencoderKLCausal3D(ModelMixin, ConfigMixin, FromOriginalVAEMixin):
                     tile = self.blend_h(row[j - 1], tile, blend_extent)
                 result_row.append(tile[:, :, :, :row_limit, :row_limit])
             result_rows.append(torch.cat(result_row, dim=-1))
-
-        dec = torch.cat(result_rows, dim=-2)
-        if not return_dict:
-            return (dec,)
-
-        return DecoderOutput(sample=dec)
+        return torch.cat(result_rows, dim=-2)
+
+    def _dist_decode_tiles(self, z: torch.FloatTensor, overlap_size: int):
+        """Decode this rank's share of the spatial tiles; returns the rows of decoded tiles on rank 0, else None."""
+        group = self.dist_decode_group
+        rank = dist.get_rank(group=group)
+        world_size = dist.get_world_size(group=group)
+        dst = dist.get_global_rank(group, 0) if group is not None else 0
+        size = self.tile_latent_min_size
+        scale = self.config.spatial_compression_ratio
+        full_h, full_w = min(size, z.shape[-2]) * scale, min(size, z.shape[-1]) * scale
+
+        positions = [(i, j) for i in range(0, z.shape[-2], overlap_size) for j in range(0, z.shape[-1], overlap_size)]
+        assignment = balanced_tile_assignment(len(positions), world_size)
+        n_slots = len(assignment[0])
+
+        # dist.gather demands the same shape on every rank. Edge tiles are decoded as they are, like in the
+        # single-rank path, and their output is zero-padded to the full tile size for the gather only. Ranks with
+        # one tile less send an empty slot, ranks without any tile (fewer tiles than ranks) decode the first tile
+        # only to learn the output shape.
+        decoded = []
+        for k in assignment[rank] or [0]:
+            i, j = positions[k]
+            tile = self.decoder(self.post_quant_conv(z[:, :, :, i : i + size, j : j + size]))
+            decoded.append(F.pad(tile, (0, full_w - tile.shape[-1], 0, full_h - tile.shape[-2])))
+        slots = decoded[:len(assignment[rank])]
+        slots += [torch.zeros_like(decoded[0])] * (n_slots - len(slots))
+        send = torch.stack(slots)
+
+        gather_list = [torch.empty_like(send) for _ in range(world_size)] if rank == 0 else None
+        dist.gather(send, gather_list, dst=dst, group=group)
+        if rank != 0:
+            return None
+
+        tiles = [None] * len(positions)
+        for r, indices in enumerate(assignment):
+            for slot, k in enumerate(indices):
+                tiles[k] = gather_list[r][slot]
+
+        # Crop the padding region in pixel level
+        rows = []
+        tiles_iter = iter(tiles)
+        for i in range(0, z.shape[-2], overlap_size):
+            row = []
+            for j in range(0, z.shape[-1], overlap_size):
+                tile_h = min(size, z.shape[-2] - i) * scale
+                tile_w = min(size, z.shape[-1] - j) * scale
+                row.append(next(tiles_iter)[:, :, :, :tile_h, :tile_w])
+            rows.append(row)
+        return rows
 
     def temporal_tiled_encode(self, x: torch.FloatTensor, return_dict: bool = True) -> AutoencoderKLOutput:
         assert not self.disable_causal_conv, "Temporal tiling is only compatible with causal convolutions."
@@ -802,7 +1052,12 @@ class AutoencoderKLCausal3D(ModelMixin, ConfigMixin, FromOriginalVAEMixin):
         overlap_size = int(self.tile_latent_min_tsize * (1 - self.tile_overlap_factor))
         blend_extent = int(self.tile_sample_min_tsize * self.tile_overlap_factor)
         t_limit = self.tile_sample_min_tsize - blend_extent
-        rank = 0 if CPU_OFFLOAD or DISABLE_SP else mpi_rank()
+        if self.use_dist_decode:
+            gather_to_rank0 = True
+            rank = dist.get_rank(group=self.dist_decode_group)
+        else:
+            gather_to_rank0 = not CPU_OFFLOAD and not DISABLE_SP and self.parallel_decode and self.gather_to_rank0
+            rank = 0 if CPU_OFFLOAD or DISABLE_SP else mpi_rank()
         row = []
         for i in range(0, T, overlap_size):
             tile = z[:, :, i : i + self.tile_latent_min_tsize + 1, :, :]
@@ -811,10 +1066,10 @@ class AutoencoderKLCausal3D(ModelMixin, ConfigMixin, FromOriginalVAEMixin):
             else:
                 tile = self.post_quant_conv(tile)
                 decoded = self.decoder(tile)
-            if i > 0 and (not (self.parallel_decode and self.gather_to_rank0) or rank == 0):
+            if i > 0 and (not gather_to_rank0 or rank == 0):
                 decoded = decoded[:, :, 1:, :, :]
             row.append(decoded)
-        if not CPU_OFFLOAD and not DISABLE_SP and self.parallel_decode and self.gather_to_rank0 and rank != 0:
+        if gather_to_rank0 and rank != 0:
             return DecoderOutput(sample=None)
         result_row = []
         for i, tile in enumerate(row):
@@ -830,6 +1085,71 @@ class AutoencoderKLCausal3D(ModelMixin, ConfigMixin, FromOriginalVAEMixin):
 
         return DecoderOutput(sample=dec)
 
+    def stream_decode(self, z: torch.FloatTensor, chunk_size: Optional[int] = None):
+        r"""
+        Decode latents chunk by chunk along time and yield the decoded frames of every chunk.
+
+        Unlike `temporal_tiled_decode`, chunks do not overlap: every causal convolution keeps the trailing frames of
+        the previous chunk as its temporal padding, so no latent frame is decoded twice and peak memory only depends
+        on `chunk_size`. With spatial tiling, every tile of a chunk is decoded with the causal state of the same tile in
+        the previous chunk and the tiles are blended like in `spatial_tiled_decode`.
+
+        With more than one chunk the frames deviate from `decode`: group norm statistics and the mid-block attention
+        are computed per chunk, the same approximation temporal tiling makes. The deviation grows with how much the
+        latents change over time and shrinks with larger chunks. A static clip decodes exactly, and it stays below the
+        deviation of `temporal_tiled_decode`.
+
+        The causal caches live in the decoder, so only one stream can run at a time and `decode` raises until it is
+        exhausted or closed. The tiling settings are read when the generator is created, later changes do not apply.
+
+        Args:
+            z (`torch.FloatTensor`): Input batch of latent vectors.
+            chunk_size (`int`, *optional*):
+                Number of latent frames decoded per step. Defaults to `tile_latent_min_tsize`.
+
+        Returns:
+            A generator of `torch.FloatTensor`. The first chunk yields `1 + (chunk_size - 1) * time_compression_ratio`
+            frames, every following chunk `chunk_size * time_compression_ratio` frames.
+        """
+        assert len(z.shape) == 5, "The input tensor should have 5 dimensions"
+        assert not self.disable_causal_conv, "Streaming decode is only supported with causal convolutions."
+        with self.thread_tiling():
+            if self.auto_tiling_budget is not None:
+                self._apply_auto_tiling(z[:, :, :chunk_size or self.tile_latent_min_tsize].shape, "decode")
+            chunk_size = chunk_size or self.tile_latent_min_tsize
+            tiles = None
+            if self.use_spatial_tiling and (z.shape[-1] > self.tile_latent_min_size or z.shape[-2] > self.tile_latent_min_size):
+                blend_extent = int(self.tile_sample_min_size * self.tile_overlap_factor)
+                tiles = (self.tile_latent_min_size, blend_extent, self.tile_sample_min_size - blend_extent)
+        return self._stream_chunks(z, chunk_size, tiles)
+
+    def _stream_chunks(self, z: torch.FloatTensor, chunk_size: int, tiles: Optional[Tuple[int, int, int]]):
+        if self.streaming:
+            raise RuntimeError("Another `stream_decode` is running, the causal caches of the decoder are in use.")
+        self.streaming = True
+        set_causal_cache(self.decoder, True)
+        try:
+            if tiles is not None:
+                size, blend_extent, row_limit = tiles
+                overlap_size = int(size * (1 - self.tile_overlap_factor))
+                positions = [(i, j) for i in range(0, z.shape[-2], overlap_size) for j in range(0, z.shape[-1], overlap_size)]
+                states = {}
+                for t in range(0, z.shape[2], chunk_size):
+                    rows = {}
+                    for i, j in positions:
+                        load_causal_cache(self.decoder, states.get((i, j)))
+                        tile = self.post_quant_conv(z[:, :, t : t + chunk_size, i : i + size, j : j + size])
+                        rows.setdefault(i, []).append(self.decoder(tile))
+                        states[(i, j)] = get_causal_cache(self.decoder)
+                    yield self._blend_tile_rows(list(rows.values()), blend_extent, row_limit)
+            else:
+                for t in range(0, z.shape[2], chunk_size):
+                    tile = self.post_quant_conv(z[:, :, t : t + chunk_size])
+                    yield self.decoder(tile)
+        finally:
+            set_causal_cache(self.decoder, False)
+            self.streaming = False
+
     def forward(
         self,
         sample: torch.FloatTensor,
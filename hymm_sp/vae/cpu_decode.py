@@ -0,0 +1,145 @@
+"""
+CPU-optimized VAE decoding, for preview and overflow decodes on nodes without a GPU.
+
+Benchmark against the plain fp32 NCDHW path:
+
+    python3 -m hymm_sp.vae.cpu_decode --vae 884-16c-hy0801 --sizes 384 512 704 --frames 33
+"""
+import argparse
+import time
+
+import torch
+import torch.nn as nn
+
+
+def fold_post_quant_conv(vae) -> bool:
+    """
+    Fold the 1x1x1 `post_quant_conv` into the first conv of the decoder and replace it by `nn.Identity`.
+
+    The fold is exact: a pointwise affine map commutes with the replicate padding of `CausalConv3d`. The decoder
+    GroupNorms are not foldable, they normalize with statistics computed at runtime and precede their convs.
+    The state dict of the VAE changes, so do not save it afterwards.
+
+    Returns:
+        `True` if the conv was folded, `False` if there was nothing (left) to fold.
+    """
+    pq = vae.post_quant_conv
+    conv_in = vae.decoder.conv_in
+    if not isinstance(pq, nn.Conv3d) or conv_in.pad_mode != "replicate":
+        return False
+
+    with torch.no_grad():
+        w_pq = pq.weight.double().flatten(1)                # (c_mid, c_in)
+        b_pq = pq.bias.double() if pq.bias is not None else torch.zeros(w_pq.shape[0], dtype=torch.float64)
+        w = conv_in.conv.weight.double()                    # (c_out, c_mid, kt, kh, kw)
+        b = conv_in.conv.bias.double() if conv_in.conv.bias is not None else torch.zeros(w.shape[0], dtype=torch.float64)
+
+        folded_w = torch.einsum("omthw,mi->oithw", w, w_pq)
+        folded_b = b + torch.einsum("omthw,m->o", w, b_pq)
+
+        conv = nn.Conv3d(w_pq.shape[1], w.shape[0], kernel_size=conv_in.conv.kernel_size,
+                         stride=conv_in.conv.stride, dilation=conv_in.conv.dilation, bias=True)
+        conv = conv.to(device=conv_in.conv.weight.device, dtype=conv_in.conv.weight.dtype)
+        conv.weight.copy_(folded_w)
+        conv.bias.copy_(folded_b)
+    conv_in.conv = conv
+    vae.post_quant_conv = nn.Identity()
+    return True
+
+
+def optimize_for_cpu_decode(vae, channels_last: bool = True, fold: bool = True, compile: bool = False):
+    """
+    Prepare the decoder of `vae` for CPU inference in place: fold `post_quant_conv`, convert the conv weights to
+    channels_last_3d and optionally `torch.compile` the decoder.
+    """
+    if fold:
+        fold_post_quant_conv(vae)
+    if channels_last:
+        vae.decoder.to(memory_format=torch.channels_last_3d)
+    if compile:
+        # Edge tiles have their own shapes, don't recompile for each of them.
+        vae.decoder.compile(dynamic=True)
+    return vae
+
+
+def make_latents(vae, height, width, frames, batch_size=1, seed=0):
+    s_ratio = vae.config.spatial_compression_ratio
+    t_ratio = vae.config.time_compression_ratio
+    generator = torch.Generator().manual_seed(seed)
+    shape = (batch_size, vae.config.latent_channels, (frames - 1) // t_ratio + 1, height // s_ratio, width // s_ratio)
+    return torch.randn(shape, generator=generator)
+
+
+@torch.no_grad()
+def time_decode(vae, latents, repeats=3, warmup=1):
+    """Median wall time in seconds of `vae.decode(latents)` and the last decoded video."""
+    video = None
+    for _ in range(warmup):
+        video = vae.decode(latents, return_dict=False)[0]
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        video = vae.decode(latents, return_dict=False)[0]
+        times.append(time.perf_counter() - start)
+    return sorted(times)[len(times) // 2], video
+
+
+def benchmark(baseline, optimized, sizes, frames, repeats=3, warmup=1, log=print):
+    """
+    Decode random latents at each `size x size` resolution with both VAEs.
+
+    Returns:
+        List of dicts with the resolution, the median time of both paths, the speedup and the max abs difference.
+    """
+    results = []
+    for size in sizes:
+        latents = make_latents(baseline, size, size, frames)
+        base_time, base_video = time_decode(baseline, latents, repeats, warmup)
+        opt_time, opt_video = time_decode(optimized, latents, repeats, warmup)
+        result = {
+            "size": size,
+            "frames": frames,
+            "baseline_s": base_time,
+            "optimized_s": opt_time,
+            "speedup": base_time / opt_time,
+            "max_abs_diff": (base_video.float() - opt_video.float()).abs().max().item(),
+        }
+        log(f"{size}x{size}x{frames}: baseline {base_time:.2f}s, optimized {opt_time:.2f}s, "
+            f"speedup {result['speedup']:.2f}x, max abs diff {result['max_abs_diff']:.4f}")
+        results.append(result)
+    return results
+
+
+def main():
+    import copy
+    from loguru import logger
+    from hymm_sp.vae import load_vae
+
+    parser = argparse.ArgumentParser(description="Benchmark the CPU-optimized VAE decode against the plain path")
+    parser.add_argument("--vae", type=str, default="884-16c-hy0801", help="Name of the VAE model.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[384, 512, 704], help="Square output resolutions.")
+    parser.add_argument("--frames", type=int, default=33, help="Output frames, 4n+1.")
+    parser.add_argument("--dtype", type=str, default="bf16", choices=["bf16", "fp32"], help="Autocast dtype.")
+    parser.add_argument("--no-channels-last", action="store_true", help="Keep the NCDHW memory format.")
+    parser.add_argument("--no-fold", action="store_true", help="Keep post_quant_conv separate.")
+    parser.add_argument("--compile", action="store_true", help="torch.compile the decoder.")
+    parser.add_argument("--no-tiling", action="store_true", help="Decode without tiling.")
+    parser.add_argument("--threads", type=int, default=None, help="torch.set_num_threads.")
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    baseline, _, _, _ = load_vae(args.vae, "fp32", logger=logger, device="cpu")
+    if not args.no_tiling:
+        baseline.enable_tiling()
+    optimized = copy.deepcopy(baseline)
+    optimized.enable_cpu_decode(dtype=torch.bfloat16 if args.dtype == "bf16" else torch.float32,
+                                channels_last=not args.no_channels_last, fold=not args.no_fold,
+                                compile=args.compile)
+    logger.info(f"threads: {torch.get_num_threads()}")
+    benchmark(baseline, optimized, args.sizes, args.frames, repeats=args.repeats, log=logger.info)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from einops import rearrange
+
+# Approximate linear map from the (scaled) 16-channel latents of the 884-16c VAE to RGB in [-1, 1].
+# Good enough for progress previews; refit with `hymm_sp/fit_preview_decoder.py` for exact colors.
+DEFAULT_LATENT_RGB_FACTORS = [
+    [-0.0395, -0.0331, 0.0445],
+    [0.0696, 0.0795, 0.0518],
+    [0.0135, -0.0945, -0.0282],
+    [0.0108, -0.0250, -0.0765],
+    [-0.0209, 0.0032, 0.0224],
+    [-0.0804, -0.0254, -0.0639],
+    [-0.0991, 0.0271, -0.0669],
+    [-0.0646, -0.0422, -0.0400],
+    [-0.0696, -0.0595, -0.0894],
+    [-0.0799, -0.0208, -0.0375],
+    [0.1166, 0.1627, 0.0962],
+    [0.1165, 0.0432, 0.0407],
+    [-0.2315, -0.1920, -0.1355],
+    [-0.0270, 0.0401, -0.0821],
+    [-0.0616, -0.0997, -0.0727],
+    [0.0249, -0.0469, -0.1703],
+]
+DEFAULT_LATENT_RGB_BIAS = [0.0259, -0.0192, -0.0761]
+
+
+class LatentPreviewer(nn.Module):
+    """
+    Cheap latent -> RGB decoder for progress previews at latent resolution.
+
+    A per-voxel linear projection, optionally refined by a small per-frame conv net (`hidden_channels > 0`) that can
+    be distilled from the VAE decoder.
+    """
+    def __init__(self, latent_channels=16, hidden_channels=0):
+        super().__init__()
+        self.latent_channels = latent_channels
+        self.hidden_channels = hidden_channels
+        self.proj = nn.Conv2d(latent_channels, 3, kernel_size=1)
+        if hidden_channels > 0:
+            self.refine = nn.Sequential(
+                nn.Conv2d(latent_channels + 3, hidden_channels, kernel_size=3, padding=1),
+                nn.SiLU(),
+                nn.Conv2d(hidden_channels, hidden_channels, kernel_size=3, padding=1),
+                nn.SiLU(),
+                nn.Conv2d(hidden_channels, 3, kernel_size=3, padding=1),
+            )
+            nn.init.zeros_(self.refine[-1].weight)
+            nn.init.zeros_(self.refine[-1].bias)
+        else:
+            self.refine = None
+
+    @classmethod
+    def default(cls):
+        previewer = cls(latent_channels=len(DEFAULT_LATENT_RGB_FACTORS))
+        with torch.no_grad():
+            previewer.proj.weight.copy_(torch.tensor(DEFAULT_LATENT_RGB_FACTORS).t()[:, :, None, None])
+            previewer.proj.bias.copy_(torch.tensor(DEFAULT_LATENT_RGB_BIAS))
+        return previewer
+
+    @classmethod
+    def from_pretrained(cls, path):
+        ckpt = torch.load(path, map_location="cpu")
+        previewer = cls(**ckpt["config"])
+        previewer.load_state_dict(ckpt["state_dict"])
+        return previewer
+
+    def save_pretrained(self, path):
+        config = {"latent_channels": self.latent_channels, "hidden_channels": self.hidden_channels}
+        torch.save({"config": config, "state_dict": self.state_dict()}, path)
+
+    def forward(self, latents):
+        """(b, c, t, h, w) scaled latents -> (b, 3, t, h, w) RGB in [-1, 1]."""
+        b = latents.shape[0]
+        x = rearrange(latents, "b c t h w -> (b t) c h w")
+        rgb = self.proj(x)
+        if self.refine is not None:
+            rgb = rgb + self.refine(torch.cat([x, rgb], dim=1))
+        return rearrange(rgb, "(b t) c h w -> b c t h w", b=b)
+
+    @torch.no_grad()
+    def to_frames(self, latents, frame_stride=1):
+        """Preview frames of the first sample as a (t, h, w, 3) uint8 array."""
+        param = next(self.parameters())
+        if param.device != latents.device:
+            self.to(latents.device)
+        rgb = self(latents[:1, :, ::frame_stride].to(dtype=param.dtype))[0]
+        rgb = ((rgb + 1) * 127.5).clamp(0, 255).to(torch.uint8)
+        return rgb.permute(1, 2, 3, 0).cpu().numpy()
+
+
+class LatentPreviewCallback:
+    """
+    `callback_on_step_end` hook that renders `latents_all` every `every_n_steps` denoising steps.
+
+    The pipeline calls the hook once per temporal window, so `latents_all` is the state after the previous step.
+    `on_preview(step, frames)` receives (t, h, w, 3) uint8 frames. If `should_abort()` returns True the pipeline is
+    interrupted and returns no video; do not abort from a single rank under sequence parallelism.
+    """
+    tensor_inputs = ["latents_all"]
+
+    def __init__(self, previewer, on_preview, every_n_steps=5, frame_stride=4, should_abort=None):
+        self.previewer = previewer
+        self.on_preview = on_preview
+        self.every_n_steps = every_n_steps
+        self.frame_stride = frame_stride
+        self.should_abort = should_abort
+        self.last_step = None
+
+    def __call__(self, pipeline, step, timestep, callback_kwargs):
+        if self.should_abort is not None and self.should_abort():
+            pipeline._interrupt = True
+        if step == self.last_step or step % self.every_n_steps != 0:
+            return {}
+        self.last_step = step
+        frames = self.previewer.to_frames(callback_kwargs["latents_all"], self.frame_stride)
+        self.on_preview(step, frames)
+        return {}
+
+
+def preview_targets(video, time_compression_ratio=4, spatial_compression_ratio=8):
+    """
+    Average a (b, 3, f, H, W) video in [-1, 1] down to latent resolution. The first frame has its own latent frame,
+    every following latent frame covers `time_compression_ratio` frames.
+    """
+    first, rest = video[:, :, :1], video[:, :, 1:]
+    rest = rearrange(rest, "b c (t k) h w -> b c t k h w", k=time_compression_ratio).mean(dim=3)
+    video = torch.cat([first, rest], dim=2)
+    b = video.shape[0]
+    video = rearrange(video, "b c t h w -> (b t) c h w")
+    video = F.avg_pool2d(video, spatial_compression_ratio)
+    return rearrange(video, "(b t) c h w -> b c t h w", b=b)
+
+
+def fit_linear_preview(latents, targets):
+    """Least squares fit of a linear `LatentPreviewer` on (b, c, t, h, w) latents and latent-resolution targets."""
+    x = rearrange(latents.float(), "b c t h w -> (b t h w) c")
+    y = rearrange(targets.float(), "b c t h w -> (b t h w) c")
+    x = torch.cat([x, torch.ones_like(x[:, :1])], dim=1)
+    solution = torch.linalg.lstsq(x.cpu(), y.cpu()).solution
+
+    previewer = LatentPreviewer(latent_channels=latents.shape[1])
+    with torch.no_grad():
+        previewer.proj.weight.copy_(solution[:-1].t()[:, :, None, None])
+        previewer.proj.bias.copy_(solution[-1])
+    return previewer
+
+
+def distill_preview(previewer, latents, targets, steps=2000, lr=1e-3, log_every=200, logger=None):
+    """Train the conv refinement of `previewer` to match the targets."""
+    device = latents.device
+    previewer = previewer.to(device).train()
+    optimizer = torch.optim.AdamW(previewer.parameters(), lr=lr)
+    with torch.enable_grad():
+        for step in range(steps):
+            loss = F.mse_loss(previewer(latents.float()), targets.float())
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            if logger is not None and (step % log_every == 0 or step == steps - 1):
+                logger.info(f"step {step}: mse {loss.item():.5f}")
+    return previewer.eval()
+
+
+def frames_to_grid(frames, cols=4):
+    """Tile (t, h, w, 3) preview frames into a single image."""
+    t, h, w, c = frames.shape
+    rows = (t + cols - 1) // cols
+    grid = np.zeros((rows * h, cols * w, c), dtype=frames.dtype)
+    for idx, frame in enumerate(frames):
+        r, col = divmod(idx, cols)
+        grid[r * h:(r + 1) * h, col * w:(col + 1) * w] = frame
+    return grid
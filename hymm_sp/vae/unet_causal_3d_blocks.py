@@ -64,10 +64,53 @@ class CausalConv3d(nn.Module):
 
         self.conv = nn.Conv3d(chan_in, chan_out, kernel_size, stride = stride, dilation = dilation, **kwargs)
 
+        # only relevant if streaming (causal cache) is enabled
+        self.use_cache = False
+        self.cache = None
+
+    def reset_cache(self):
+        self.cache = None
+
     def forward(self, x):
-        x = F.pad(x, self.time_causal_padding, mode=self.pad_mode)
+        pad_t = self.time_causal_padding[4]
+        if not self.use_cache or pad_t == 0:
+            x = F.pad(x, self.time_causal_padding, mode=self.pad_mode)
+            return self.conv(x)
+
+        # Streaming: the trailing frames of the previous chunk take the place of the causal padding,
+        # so chunked outputs match a single pass over the whole sequence.
+        if self.cache is None:
+            x = F.pad(x, (0, 0, 0, 0, pad_t, 0), mode=self.pad_mode)
+        else:
+            x = torch.cat([self.cache.to(x), x], dim=2)
+        self.cache = x[:, :, -pad_t:].clone()
+        x = F.pad(x, self.time_causal_padding[:4] + (0, 0), mode=self.pad_mode)
         return self.conv(x)
     
+def set_causal_cache(module: nn.Module, enabled: bool):
+    """Enable or disable streaming for all causal layers inside `module`. The per-layer state is always reset."""
+    for m in module.modules():
+        if isinstance(m, (CausalConv3d, UpsampleCausal3D)):
+            m.use_cache = enabled
+            m.reset_cache()
+
+
+def get_causal_cache(module: nn.Module):
+    """Streaming state of the causal layers inside `module`, e.g. of one spatial tile, for `load_causal_cache`."""
+    return [m.cache if isinstance(m, CausalConv3d) else m.stream_started
+            for m in module.modules() if isinstance(m, (CausalConv3d, UpsampleCausal3D))]
+
+
+def load_causal_cache(module: nn.Module, state):
+    """Restore the streaming state saved by `get_causal_cache`, None starts a new stream."""
+    layers = [m for m in module.modules() if isinstance(m, (CausalConv3d, UpsampleCausal3D))]
+    for m, value in zip(layers, state or [None] * len(layers)):
+        if isinstance(m, CausalConv3d):
+            m.cache = value
+        else:
+            m.stream_started = bool(value)
+
+
 class CausalAvgPool3d(nn.Module):
     def __init__(
         self,
@@ -136,6 +179,10 @@ class UpsampleCausal3D(nn.Module):
         self.upsample_factor = upsample_factor
         self.disable_causal = disable_causal
 
+        # only relevant if streaming (causal cache) is enabled
+        self.use_cache = False
+        self.stream_started = False
+
         if norm_type == "ln_norm":
             self.norm = nn.LayerNorm(channels, eps, elementwise_affine)
         elif norm_type == "rms_norm":
@@ -163,6 +210,9 @@ class UpsampleCausal3D(nn.Module):
         else:
             self.Conv2d_0 = conv
 
+    def reset_cache(self):
+        self.stream_started = False
+
     def forward(
         self,
         hidden_states: torch.FloatTensor,
@@ -192,7 +242,11 @@ class UpsampleCausal3D(nn.Module):
         # size and do not make use of `scale_factor=2`
         if self.interpolate:
             B, C, T, H, W = hidden_states.shape
-            if not self.disable_causal:
+            # When streaming, only the first frame of the first chunk is kept un-upsampled in time.
+            first_frame_causal = not (self.use_cache and self.stream_started)
+            if self.use_cache:
+                self.stream_started = True
+            if not self.disable_causal and first_frame_causal:
                 first_h, other_h = hidden_states.split((1, T-1), dim=2)
                 if output_size is None:
                     if T > 1:
@@ -0,0 +1,105 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import torch
+from loguru import logger
+
+from hymm_sp.data_kits.audio_preprocessor import (
+    WHISPER_WINDOW,
+    run_whisper,
+    split_whisper_windows,
+    stitch_whisper_windows,
+)
+
+
+class WhisperBatcher:
+    """
+    Runs the Whisper encoder of concurrent requests on shared batches of their 30 s windows.
+
+    `submit` returns a `concurrent.futures.Future` holding the stitched hidden states of `encode_audio_hidden_states`.
+    After the first pending request the worker waits up to `max_wait` seconds for others to join, then encodes all
+    their windows, `max_windows` per forward. The windows all have the same length, so requests batch without
+    padding.
+
+    `lock` serializes Whisper with other users of the model, e.g. a caller moving it between devices.
+    """
+    def __init__(self, wav2vec, max_windows=8, max_wait=0.005, lock=None):
+        self.wav2vec = wav2vec
+        self.max_windows = max_windows
+        self.max_wait = max_wait
+        self.lock = lock or threading.Lock()
+        self.jobs = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name="whisper-batcher", daemon=True)
+        self.thread.start()
+
+    def submit(self, audio_feats):
+        if not self.thread.is_alive():
+            raise RuntimeError("The Whisper batcher is closed.")
+        future = Future()
+        self.jobs.put((future, audio_feats))
+        return future
+
+    def encode(self, audio_feats):
+        return self.submit(audio_feats).result()
+
+    def _collect(self, first):
+        jobs = [first]
+        deadline = time.monotonic() + self.max_wait
+        while True:
+            num_windows = sum(job[1].shape[-1] // WHISPER_WINDOW for job in jobs)
+            if num_windows >= self.max_windows:
+                return jobs, False
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return jobs, False
+            try:
+                job = self.jobs.get(timeout=remaining)
+            except queue.Empty:
+                return jobs, False
+            if job is None:
+                return jobs, True
+            jobs.append(job)
+
+    def _run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            jobs, stop = self._collect(job)
+            jobs = [(future, audio_feats) for future, audio_feats in jobs if future.set_running_or_notify_cancel()]
+            if jobs:
+                self._encode(jobs)
+            if stop:
+                break
+
+    def _encode(self, jobs):
+        try:
+            plans = [split_whisper_windows(audio_feats) for _, audio_feats in jobs]
+            mels = [mel for plan in plans for mel in plan[0]]
+            window_states = []
+            with torch.no_grad(), self.lock:
+                device = next(self.wav2vec.parameters()).device
+                for i in range(0, len(mels), self.max_windows):
+                    batch = torch.stack(mels[i:i + self.max_windows]).to(device=device, dtype=self.wav2vec.dtype)
+                    window_states.extend(run_whisper(self.wav2vec, batch).unbind(0))
+        except BaseException as e:
+            logger.exception("Whisper encoding failed")
+            for future, _ in jobs:
+                future.set_exception(e)
+            return
+
+        offset = 0
+        for (future, audio_feats), (job_mels, starts, cuts) in zip(jobs, plans):
+            states = window_states[offset:offset + len(job_mels)]
+            offset += len(job_mels)
+            hidden_states = stitch_whisper_windows(states, starts, cuts, audio_feats.shape[-1])
+            future.set_result(hidden_states.to(audio_feats.device))
+
+    def close(self, wait=True):
+        """Finish the pending requests and stop the thread."""
+        if self.thread.is_alive():
+            self.jobs.put(None)
+            if wait:
+                self.thread.join()
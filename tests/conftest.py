@@ -98,6 +98,25 @@ test2,assets/image/1.png,assets/audio/2.WAV,Another test prompt,30
     csv_path.write_text(csv_content)
     return csv_path
 
+@pytest.fixture
+def tiny_vae():
+    """Randomly initialised causal 3D VAE with the production layout at toy width."""
+    from hymm_sp.vae.autoencoder_kl_causal_3d import AutoencoderKLCausal3D
+
+    torch.manual_seed(0)
+    vae = AutoencoderKLCausal3D(
+        down_block_types=("DownEncoderBlockCausal3D",) * 4,
+        up_block_types=("UpDecoderBlockCausal3D",) * 4,
+        block_out_channels=(8, 16, 16, 16),
+        layers_per_block=1,
+        latent_channels=4,
+        norm_num_groups=4,
+        sample_size=32,
+        sample_tsize=16,
+        mid_block_causal_attn=True,
+    )
+    return vae.eval()
+
 @pytest.fixture
 def mock_model_weights(temp_dir):
     """Create mock model weights directory."""
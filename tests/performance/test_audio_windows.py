@@ -0,0 +1,55 @@
+"""
+Performance tests for gathering the per-frame audio context of long clips.
+"""
+
+import time
+import pytest
+import torch
+import sys
+from pathlib import Path
+
+# Add project root to path
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+from hymm_sp.data_kits.audio_preprocessor import gather_audio_windows
+
+
+def gather_audio_windows_loop(audio_hidden_states, num_frames, step=1):
+    """The former per-frame loop of `encode_audio` (25 fps: step 1, 12.5 fps: step 2)."""
+    audio_feats = torch.cat([torch.zeros_like(audio_hidden_states[:, :4]), audio_hidden_states], 1)
+    audio_feats_list = []
+    for f in range(num_frames):
+        cur_t = f * step * 2
+        audio_feats_list.append(audio_feats[0:1, cur_t: cur_t + 10])
+    return torch.stack(audio_feats_list, 1)
+
+
+def median_time(fn, repeats=5):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return sorted(times)[len(times) // 2]
+
+
+@pytest.mark.performance
+class TestAudioWindowsPerformance:
+    """Benchmark of the vectorized audio context against the per-frame loop."""
+
+    @pytest.mark.parametrize("seconds", [60, 300])
+    def test_vectorized_is_faster_on_long_clips(self, seconds):
+        """A minute-long clip and longer gather faster, with the same result."""
+        num_frames = seconds * 25
+        # whisper-tiny: 5 hidden states of 384 channels at 50 Hz
+        hidden_states = torch.randn(1, seconds * 50 + 8, 5, 384)
+
+        expected = gather_audio_windows_loop(hidden_states, num_frames)
+        # materialize the view, the pipeline moves it to the GPU right away
+        actual = gather_audio_windows(hidden_states, 25, num_frames).contiguous()
+        assert torch.equal(actual, expected)
+
+        loop_time = median_time(lambda: gather_audio_windows_loop(hidden_states, num_frames))
+        vectorized_time = median_time(lambda: gather_audio_windows(hidden_states, 25, num_frames).contiguous())
+        print(f"{seconds}s: loop {loop_time * 1000:.1f} ms, vectorized {vectorized_time * 1000:.1f} ms")
+        assert vectorized_time < loop_time
@@ -0,0 +1,30 @@
+"""
+Performance tests for the CPU-optimized VAE decode.
+"""
+
+import copy
+import pytest
+import torch
+import sys
+from pathlib import Path
+
+# Add project root to path
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+from hymm_sp.vae.cpu_decode import benchmark
+
+
+@pytest.mark.performance
+class TestCPUDecodePerformance:
+    """Benchmark of the CPU decode path against the plain fp32 NCDHW path."""
+
+    def test_benchmark_reports_all_sizes(self, tiny_vae):
+        """The benchmark runs both paths at every resolution and they agree."""
+        optimized = copy.deepcopy(tiny_vae)
+        optimized.enable_cpu_decode(dtype=torch.float32)
+        results = benchmark(tiny_vae, optimized, sizes=[64, 128], frames=9, repeats=1, log=lambda msg: None)
+
+        assert [r["size"] for r in results] == [64, 128]
+        for r in results:
+            assert r["baseline_s"] > 0 and r["optimized_s"] > 0
+            assert r["max_abs_diff"] < 1e-3
@@ -0,0 +1,216 @@
+"""
+Unit tests for the Whisper audio encoding of long tracks.
+"""
+
+import pytest
+import torch
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+
+# Add project root to path
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+from hymm_sp.cache import FeatureCache
+from hymm_sp.data_kits.audio_preprocessor import (
+    AudioWindows,
+    encode_audio,
+    encode_audio_hidden_states,
+    gather_audio_windows,
+    get_audio_frame_starts,
+    get_audio_hidden_states,
+    get_whisper_windows,
+    pad_audio_hidden_states,
+)
+
+
+class FakeWhisper:
+    """Whisper stand-in without temporal context: encoder frame j of layer l is l + mean(mel[:, 2j:2j+2])."""
+    config = SimpleNamespace(_name_or_path="fake-whisper")
+    dtype = torch.float32
+
+    def __init__(self, num_layers=2):
+        self.num_layers = num_layers
+        self.calls = 0
+        self.encoder = self
+
+    def __call__(self, mels, output_hidden_states=True):
+        assert mels.shape[-1] == 3000, "Whisper only takes 30 s windows"
+        self.calls += 1
+        pooled = mels.mean(dim=1).unflatten(-1, (-1, 2)).mean(-1).unsqueeze(-1).repeat(1, 1, 3)
+        return SimpleNamespace(hidden_states=tuple(pooled + layer for layer in range(self.num_layers + 1)))
+
+
+def reference_hidden_states(mel, num_layers=2):
+    pooled = mel.mean(dim=0).unflatten(-1, (-1, 2)).mean(-1)[None, :, None, None].repeat(1, 1, num_layers + 1, 3)
+    return pooled + torch.arange(num_layers + 1.)[None, None, :, None]
+
+
+class TestWhisperWindows:
+    """Test suite for the overlapping Whisper windows."""
+
+    def test_short_track_is_one_window(self):
+        """Up to 30 s the encoder runs once, as before."""
+        assert get_whisper_windows(3000) == ([0], [0])
+
+    def test_windows_cover_the_track(self):
+        """Windows overlap, stay inside the features and hand over inside the overlap."""
+        starts, cuts = get_whisper_windows(9000, overlap=500)
+        assert starts[0] == 0 and starts[-1] == 6000
+        for prev, start, cut in zip(starts[:-1], starts[1:], cuts[1:]):
+            assert start < prev + 3000
+            assert start // 2 < cut < (prev + 3000) // 2
+
+
+class TestEncodeAudio:
+    """Test suite for encoding tracks longer than one Whisper window."""
+
+    def test_stitched_states_match_frame_rate(self):
+        """Stitching gives one 50 Hz frame per two mel frames, each computed from its own audio."""
+        mel = torch.randn(80, 9000)
+        wav2vec = FakeWhisper()
+        hidden_states = encode_audio_hidden_states(wav2vec, mel, batch_size=2)
+        assert hidden_states.shape == (1, 4500, 3, 3)
+        assert torch.allclose(hidden_states, reference_hidden_states(mel), atol=1e-6)
+        assert wav2vec.calls == 2
+
+    def test_long_track_is_not_truncated(self):
+        """Frames past 30 s (and past the former 400 frame cap) get their own audio."""
+        mel = torch.randn(80, 6000)
+        audio_prompts = encode_audio(FakeWhisper(), mel, fps=25, num_frames=1400)
+        assert audio_prompts.shape == (1, 1400, 10, 3, 3)
+        expected = reference_hidden_states(mel)[:, 2 * 1000 - 4:2 * 1000 + 6]
+        assert torch.allclose(audio_prompts[:, 1000], expected, atol=1e-6)
+
+    def test_max_frames(self):
+        """`max_frames` still caps the frames when asked to."""
+        audio_prompts = encode_audio(FakeWhisper(), torch.randn(80, 3000), fps=25, num_frames=129, max_frames=33)
+        assert audio_prompts.shape[1] == 33
+
+    def test_leading_silence(self):
+        """The context of the first frame starts with the silence before the track."""
+        hidden_states = reference_hidden_states(torch.randn(80, 3000))
+        first = gather_audio_windows(hidden_states, fps=12.5, num_frames=10)[:, 0]
+        assert first.shape == (1, 10, 3, 3)
+        assert torch.equal(first[:, :4], torch.zeros_like(first[:, :4]))
+        assert torch.equal(first[:, 4:], hidden_states[:, :6])
+
+
+class TestGatherAudioWindows:
+    """Test suite for the vectorized per-frame audio context."""
+
+    @pytest.mark.parametrize("fps", [25, 12.5, 10, 24, 30])
+    def test_matches_frame_by_frame_windows(self, fps):
+        """All frames at once equal the frame-by-frame windows, for any fps."""
+        hidden_states = torch.randn(1, 1500, 3, 4)
+        windows = gather_audio_windows(hidden_states, fps, num_frames=200)
+        assert windows.shape == (1, 200, 10, 3, 4)
+        starts = get_audio_frame_starts(fps, 200)
+        padded = pad_audio_hidden_states(hidden_states, starts)
+        expected = torch.stack([padded[:, cur_t:cur_t + 10] for cur_t in starts.tolist()], 1)
+        assert torch.equal(windows, expected)
+
+    def test_start_frame(self):
+        """Windows of a later video segment start at its own audio."""
+        hidden_states = torch.randn(1, 1500, 3, 4)
+        windows = gather_audio_windows(hidden_states, 25, num_frames=10, start_frame=100)
+        assert torch.equal(windows[:, 0], hidden_states[:, 196:206])
+
+    def test_integer_step_is_a_view(self):
+        """With an integer step the windows share the memory of the padded hidden states."""
+        hidden_states = torch.randn(1, 1500, 3, 4)
+        windows = gather_audio_windows(hidden_states, 25, num_frames=700)
+        assert windows._base is not None
+
+
+class TestAudioWindows:
+    """Test suite for the audio context gathered per denoising segment."""
+
+    def padded_windows(self, hidden_states, fps, num_frames, length):
+        """The full per-frame context padded with silence to `length` frames, as predict used to build it."""
+        windows = gather_audio_windows(hidden_states, fps, num_frames)
+        return torch.cat([windows, windows.new_zeros((1, length - num_frames) + windows.shape[2:])], dim=1)
+
+    @pytest.mark.parametrize("fps", [25, 24])
+    def test_segments_match_the_full_context(self, fps):
+        """Every segment of the pipeline, wrapping around the padded frames, gets the windows it used to slice."""
+        hidden_states = torch.randn(1, 3000, 3, 4)
+        num_frames = 700
+        audio_prompts = AudioWindows(hidden_states, fps, num_frames, length=num_frames + 5)
+        assert audio_prompts.shape == (1, 705, 10, 3, 4)
+        length = (705 // 128 + 1) * 128 + 4
+        expected_all = self.padded_windows(hidden_states, fps, num_frames, length)
+        audio_prompts_all = audio_prompts.with_length(length)
+        for index_start in (-10, 0, 23, 170):
+            idx_list_audio = [ii % length for ii in range(index_start * 4, (index_start + 33) * 4 - 3)]
+            assert torch.equal(audio_prompts_all.frames(idx_list_audio), expected_all[:, idx_list_audio])
+
+    def test_short_track_is_cut_and_padded(self):
+        """A short track padded to 129 frames and cut to 132 keeps its silent padding."""
+        hidden_states = torch.randn(1, 1500, 3, 4)
+        audio_prompts = AudioWindows(hidden_states, 25, 50, length=129, dtype=torch.float16).with_length(132)
+        windows = audio_prompts.frames(range(132))
+        assert windows.dtype == torch.float16
+        assert torch.equal(windows, self.padded_windows(hidden_states, 25, 50, 132).half())
+        assert not windows[:, 50:].any()
+
+    def test_holds_only_the_hidden_states(self):
+        """Nothing of the size of the per-frame context is kept."""
+        hidden_states = torch.randn(1, 3000, 3, 4)
+        audio_prompts = AudioWindows(hidden_states, 25, 1500)
+        assert audio_prompts.padded.numel() < hidden_states.numel() * 1.01
+        assert audio_prompts.shape.numel() == 5 * hidden_states.numel()
+
+
+class TestAudioCache:
+    """Test suite for caching the audio features of repeated tracks."""
+
+    def test_hidden_states_hit_skips_whisper(self):
+        """A known track is served for any fps without running Whisper again."""
+        mel = torch.randn(80, 3000)
+        wav2vec, cache = FakeWhisper(), FeatureCache("audio_hidden_states")
+        first = encode_audio(wav2vec, mel, fps=25, num_frames=129, cache=cache)
+        second = encode_audio(wav2vec, mel.clone(), fps=12.5, num_frames=64, cache=cache)
+        assert wav2vec.calls == 1
+        assert torch.equal(second, encode_audio(FakeWhisper(), mel, fps=12.5, num_frames=64))
+        assert torch.equal(first, encode_audio(FakeWhisper(), mel, fps=25, num_frames=129))
+
+    def test_hidden_states_are_cached_on_the_cpu(self):
+        """The cache holds the states on the CPU and a hit returns them on the device of the mels."""
+        mel = torch.randn(80, 3000)
+        cache = FeatureCache("audio_hidden_states")
+        hidden_states = get_audio_hidden_states(FakeWhisper(), mel, cache=cache)
+        (entry,) = cache.entries.values()
+        assert entry.device.type == "cpu"
+        wav2vec = FakeWhisper()
+        assert torch.equal(get_audio_hidden_states(wav2vec, mel, cache=cache), hidden_states)
+        assert wav2vec.calls == 0
+
+    def test_hidden_states_survive_restart(self, temp_dir):
+        """Entries written to disk are read back (memory-mapped) by a new cache."""
+        mel = torch.randn(80, 3000)
+        encode_audio(FakeWhisper(), mel, fps=25, num_frames=33, cache=FeatureCache("audio", disk_dir=temp_dir))
+        wav2vec = FakeWhisper()
+        encode_audio(wav2vec, mel, fps=25, num_frames=33, cache=FeatureCache("audio", disk_dir=temp_dir))
+        assert wav2vec.calls == 0
+
+    def test_mel_hit_skips_decoding(self, temp_dir):
+        """The mel features of a file are extracted once per content."""
+        pytest.importorskip("decord")
+        soundfile = pytest.importorskip("soundfile")
+        import numpy as np
+        from unittest.mock import MagicMock
+        from hymm_sp.data_kits.audio_dataset import get_audio_feature
+
+        audio = np.random.uniform(-0.1, 0.1, 16000).astype(np.float32)
+        soundfile.write(temp_dir / "a.wav", audio, 16000)
+        soundfile.write(temp_dir / "b.wav", audio, 16000)
+        feature_extractor = MagicMock(side_effect=lambda chunk, **kwargs: SimpleNamespace(
+            input_features=torch.zeros(1, 80, 3000)))
+        feature_extractor.feature_size, feature_extractor.hop_length, feature_extractor.n_samples = 80, 160, 480000
+
+        features, audio_len = get_audio_feature(feature_extractor, str(temp_dir / "a.wav"))
+        features_b, audio_len_b = get_audio_feature(feature_extractor, str(temp_dir / "b.wav"))
+        assert feature_extractor.call_count == 1
+        assert audio_len == audio_len_b == 25
+        assert features_b is features
@@ -0,0 +1,72 @@
+"""
+Unit tests for the block-wise audio decoding and resampling.
+"""
+
+import pytest
+import numpy as np
+import sys
+from pathlib import Path
+
+# Add project root to path
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+from scipy.signal import resample_poly
+
+from hymm_sp.data_kits.audio_io import PolyphaseResampler, get_audio_duration, iter_audio_chunks, load_audio
+
+
+def resample_in_blocks(signal, orig_sr, target_sr, block_size):
+    resampler = PolyphaseResampler(orig_sr, target_sr)
+    out = [resampler.process(signal[i:i + block_size]) for i in range(0, len(signal), block_size)]
+    return np.concatenate(out + [resampler.flush()])
+
+
+class TestPolyphaseResampler:
+    """Test suite for the streaming polyphase resampler."""
+
+    @pytest.mark.parametrize("orig_sr", [44100, 48000, 22050, 8000])
+    @pytest.mark.parametrize("block_size", [1000, 4096, 65536])
+    def test_blocks_match_one_shot(self, orig_sr, block_size):
+        """Resampling block by block gives the samples of resampling the whole signal."""
+        signal = np.random.default_rng(0).uniform(-1, 1, orig_sr * 2 + 123).astype(np.float32)
+        g = np.gcd(orig_sr, 16000)
+        expected = resample_poly(signal, 16000 // g, orig_sr // g)
+        actual = resample_in_blocks(signal, orig_sr, 16000, block_size)
+        assert actual.shape == expected.shape
+        assert np.allclose(actual, expected, atol=1e-5)
+
+    def test_same_rate_passes_through(self):
+        """16 kHz input is not filtered."""
+        signal = np.random.default_rng(0).uniform(-1, 1, 5000).astype(np.float32)
+        assert np.array_equal(resample_in_blocks(signal, 16000, 16000, 1024), signal)
+
+
+class TestAudioFiles:
+    """Test suite for reading audio files."""
+
+    def test_duration_from_header(self, temp_dir):
+        """The duration is read without decoding."""
+        soundfile = pytest.importorskip("soundfile")
+        soundfile.write(temp_dir / "a.wav", np.zeros(44100 * 3, dtype=np.float32), 44100)
+        assert get_audio_duration(str(temp_dir / "a.wav")) == pytest.approx(3.0)
+
+    def test_chunks_are_whisper_windows(self, temp_dir):
+        """A stereo 44.1 kHz file comes out as mono 16 kHz in 30 s chunks."""
+        soundfile = pytest.importorskip("soundfile")
+        stereo = np.random.default_rng(0).uniform(-0.5, 0.5, (44100 * 65, 2)).astype(np.float32)
+        soundfile.write(temp_dir / "a.wav", stereo, 44100)
+
+        chunks = list(iter_audio_chunks(str(temp_dir / "a.wav")))
+        assert [len(chunk) for chunk in chunks] == [480000, 480000, 80000]
+        expected = resample_poly(stereo.mean(axis=1), 160, 441)
+        assert np.allclose(np.concatenate(chunks), expected, atol=1e-4)
+        assert len(load_audio(str(temp_dir / "a.wav"))) == 16000 * 65
+
+    def test_in_memory_upload(self, temp_dir):
+        """The file content as bytes decodes like the file."""
+        soundfile = pytest.importorskip("soundfile")
+        audio = np.random.default_rng(0).uniform(-0.5, 0.5, 22050 * 2).astype(np.float32)
+        soundfile.write(temp_dir / "a.wav", audio, 22050)
+        data = (temp_dir / "a.wav").read_bytes()
+        assert get_audio_duration(data) == pytest.approx(2.0)
+        assert np.array_equal(load_audio(data), load_audio(str(temp_dir / "a.wav")))
@@ -0,0 +1,132 @@
+"""
+Unit tests for the content-addressed feature caches.
+"""
+
+import pytest
+import numpy as np
+import torch
+import sys
+from pathlib import Path
+
+# Add project root to path
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+from hymm_sp.cache import FeatureCache, configure_caches, get_cache, hash_file, hash_tensor, make_key
+
+
+class TestHashing:
+    """Test suite for the content hashes."""
+
+    def test_hash_tensor_ignores_layout(self):
+        """Equal values hash equally, whatever the memory layout."""
+        x = torch.randn(3, 4)
+        assert hash_tensor(x) == hash_tensor(x.t().contiguous().t())
+
+    def test_hash_tensor_sees_dtype_and_values(self):
+        """Dtype, shape and values all change the hash."""
+        x = torch.zeros(2, 3)
+        assert hash_tensor(x) != hash_tensor(x.half())
+        assert hash_tensor(x) != hash_tensor(x.reshape(3, 2))
+        y = x.clone()
+        y[0, 0] = 1
+        assert hash_tensor(x) != hash_tensor(y)
+
+    def test_hash_file(self, temp_dir):
+        """Files with the same bytes share a hash, also with in-memory content."""
+        a, b = temp_dir / "a.bin", temp_dir / "b.bin"
+        a.write_bytes(b"portrait")
+        b.write_bytes(b"portrait")
+        assert hash_file(a) == hash_file(b)
+        assert hash_file(b"portrait") == hash_file(a)
+
+    def test_make_key_depends_on_all_parts(self):
+        """Keys differ when any part differs."""
+        assert make_key("face_mask", "abc", 3.0) != make_key("face_mask", "abc", 1.25)
+
+
+class TestFeatureCache:
+    """Test suite for FeatureCache."""
+
+    def test_lru_eviction_by_items(self):
+        """The least recently used entry is evicted first."""
+        cache = FeatureCache("test", max_items=2)
+        cache.put("a", torch.ones(1))
+        cache.put("b", torch.ones(1))
+        cache.get("a")
+        cache.put("c", torch.ones(1))
+        assert cache.get("a") is not None
+        assert cache.get("b") is None
+        assert cache.get("c") is not None
+
+    def test_eviction_by_bytes(self):
+        """Entries are evicted to stay within the byte budget."""
+        cache = FeatureCache("test", max_items=10, max_bytes=2 * 4 * 100)
+        for key in "abc":
+            cache.put(key, torch.zeros(100))
+        assert len(cache) == 2
+        assert cache.nbytes == 2 * 4 * 100
+
+    def test_get_or_compute_skips_work_on_hit(self):
+        """The compute function only runs on a miss."""
+        cache = FeatureCache("test")
+        calls = []
+        compute = lambda: calls.append(1) or (torch.ones(2), torch.zeros(2))
+        first = cache.get_or_compute("k", compute)
+        second = cache.get_or_compute("k", compute)
+        assert len(calls) == 1
+        assert all(a is b for a, b in zip(first, second))
+        assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 1
+
+    def test_entries_stay_on_the_cpu(self):
+        """`get` with a device returns a copy on that device, the entry in memory stays on the CPU."""
+        cache = FeatureCache("test")
+        cache.put("k", {"mean": torch.ones(2), "std": torch.zeros(2)})
+        moved = cache.get("k", device="meta")
+        assert moved["mean"].device.type == "meta" and moved["std"].device.type == "meta"
+        assert all(v.device.type == "cpu" for v in cache.entries["k"].values())
+        assert cache.get("k")["mean"].device.type == "cpu"
+
+    def test_disk_store_survives_restart(self, temp_dir):
+        """A new cache on the same directory serves entries written by an earlier one."""
+        value = {"mean": torch.randn(2, 3), "std": torch.rand(2, 3)}
+        FeatureCache("test", disk_dir=temp_dir).put("k", value)
+
+        loaded = FeatureCache("test", disk_dir=temp_dir).get("k")
+        assert torch.equal(loaded["mean"], value["mean"])
+        assert torch.equal(loaded["std"], value["std"])
+
+    def test_memory_disabled(self):
+        """`max_items=0` keeps nothing in memory."""
+        cache = FeatureCache("test", max_items=0)
+        cache.put("k", torch.ones(1))
+        assert cache.get("k") is None
+
+    def test_configure_replaces_named_caches(self):
+        """Reconfiguring applies the new limits to the named caches."""
+        get_cache("unit_test").put("k", torch.ones(1))
+        configure_caches(max_items=3)
+        try:
+            assert get_cache("unit_test").max_items == 3
+            assert get_cache("unit_test").get("k") is None
+        finally:
+            configure_caches()
+
+
+class TestRefImageCache:
+    """Test suite for the cached reference image preprocessing."""
+
+    def test_same_content_is_preprocessed_once(self, temp_dir):
+        """Two paths with the same image bytes share one preprocessing result."""
+        pytest.importorskip("decord")
+        from PIL import Image
+        from hymm_sp.data_kits.audio_dataset import preprocess_ref_image
+
+        image = Image.fromarray(np.random.randint(0, 255, (300, 200, 3), dtype=np.uint8))
+        image.save(temp_dir / "a.png")
+        image.save(temp_dir / "b.png")
+
+        pixels, llava = preprocess_ref_image(str(temp_dir / "a.png"), 256)
+        pixels_b, llava_b = preprocess_ref_image(str(temp_dir / "b.png"), 256)
+        assert pixels.shape == (1, 3, 384, 256) and pixels.dtype == torch.uint8
+        assert llava.shape == (1, 3, 336, 336)
+        assert pixels_b is pixels and llava_b is llava
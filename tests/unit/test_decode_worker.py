@@ -0,0 +1,155 @@
+"""
+Unit tests for the background VAE decode worker.
+"""
+
+import pytest
+import threading
+import torch
+import sys
+import uuid
+from pathlib import Path
+from types import SimpleNamespace
+
+# Add project root to path
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+from hymm_sp.decode_worker import DecodeWorker
+
+
+class FakePipeline:
+    def __init__(self, release=None):
+        self.release = release
+        self.calls = []
+
+    def decode_video_latents(self, latents, **kwargs):
+        if self.release is not None:
+            self.release.wait()
+        self.calls.append(kwargs)
+        return latents * 2
+
+
+class TestDecodeWorker:
+    """Test suite for DecodeWorker."""
+
+    def test_results_in_order(self):
+        """Each future holds the decode of its own latents."""
+        worker = DecodeWorker(FakePipeline())
+        futures = [worker.submit(torch.full((1, 2), float(i)), enable_tiling=True) for i in range(4)]
+        for i, future in enumerate(futures):
+            assert torch.equal(future.result(timeout=10), torch.full((1, 2), 2. * i))
+        worker.close()
+
+    def test_submit_does_not_wait_for_decode(self):
+        """Submitting returns before the decode finishes, so the caller can start the next job."""
+        release = threading.Event()
+        worker = DecodeWorker(FakePipeline(release))
+        future = worker.submit(torch.ones(1))
+        assert not future.done()
+        release.set()
+        assert torch.equal(future.result(timeout=10), torch.full((1,), 2.))
+        worker.close()
+
+    def test_lock_is_held_while_decoding(self):
+        """The shared VAE lock is taken around each decode."""
+        lock = threading.Lock()
+        seen = []
+
+        class LockCheckingPipeline:
+            def decode_video_latents(self, latents, **kwargs):
+                seen.append(lock.locked())
+                return latents
+
+        worker = DecodeWorker(LockCheckingPipeline(), lock=lock)
+        worker.submit(torch.ones(1)).result(timeout=10)
+        worker.close()
+        assert seen == [True]
+
+    def test_errors_are_set_on_future(self):
+        """A failing decode surfaces through the future and the worker keeps serving."""
+        class FailingPipeline:
+            def decode_video_latents(self, latents, **kwargs):
+                if latents.sum() < 0:
+                    raise ValueError("bad latents")
+                return latents
+
+        worker = DecodeWorker(FailingPipeline())
+        with pytest.raises(ValueError):
+            worker.submit(-torch.ones(1)).result(timeout=10)
+        assert torch.equal(worker.submit(torch.ones(1)).result(timeout=10), torch.ones(1))
+        worker.close()
+
+    def test_submit_after_close_raises(self):
+        """A closed worker refuses new jobs."""
+        worker = DecodeWorker(FakePipeline())
+        worker.close()
+        with pytest.raises(RuntimeError):
+            worker.submit(torch.ones(1))
+
+
+def make_sampler(vae):
+    """HunyuanVideoSampler with only what `encode_ref_latents` uses."""
+    from hymm_sp.audio_video_inference import HunyuanVideoSampler
+
+    sampler = HunyuanVideoSampler.__new__(HunyuanVideoSampler)
+    sampler.args = SimpleNamespace(vae="884-16c-hy", cpu_offload=False)
+    sampler.device = torch.device("cpu")
+    sampler.vae = vae
+    sampler.vae_lock = threading.Lock()
+    return sampler
+
+
+class TestEnableDecodeWorker:
+    """Test suite for HunyuanVideoSampler.enable_decode_worker."""
+
+    @pytest.mark.parametrize("cpu_offload", [False, True])
+    def test_not_enabled_with_cpu_offload(self, tiny_vae, cpu_offload):
+        """With CPU offload the VAE is not put on the GPU next to the DiT, videos are decoded inline."""
+        sampler = make_sampler(tiny_vae)
+        sampler.args.cpu_offload = cpu_offload
+        sampler.pipeline, sampler.decode_worker = FakePipeline(), None
+        sampler.enable_decode_worker()
+        try:
+            assert (sampler.decode_worker is None) == cpu_offload
+        finally:
+            sampler.disable_decode_worker()
+
+
+class TestPendingDecode:
+    """Test suite for the next job starting while the previous video decodes."""
+
+    def test_cached_ref_latents_do_not_wait_for_decode(self, tiny_vae):
+        """A ref-latent cache hit does not take the VAE lock, a miss waits for the pending decode."""
+        sampler = make_sampler(tiny_vae)
+        pixels = torch.rand(1, 3, 5, 16, 16) * 2 - 1
+        cached_hash, new_hash = uuid.uuid4().hex, uuid.uuid4().hex
+        sampler.encode_ref_latents(pixels, torch.zeros_like(pixels) - 1, cached_hash)
+
+        started, release = threading.Event(), threading.Event()
+
+        class BlockingPipeline:
+            def decode_video_latents(self, latents, **kwargs):
+                started.set()
+                release.wait()
+                return latents
+
+        worker = DecodeWorker(BlockingPipeline(), lock=sampler.vae_lock)
+        future = worker.submit(torch.ones(1))
+        assert started.wait(timeout=10)
+        done = {}
+
+        def predict(ref_hash):
+            ref_latents, _ = sampler.encode_ref_latents(pixels, torch.zeros_like(pixels) - 1, ref_hash)
+            done[ref_hash] = ref_latents.shape
+
+        threads = [threading.Thread(target=predict, args=(ref_hash,), daemon=True) for ref_hash in (cached_hash, new_hash)]
+        try:
+            for thread in threads:
+                thread.start()
+            threads[0].join(timeout=10)
+            assert cached_hash in done and not future.done()
+            assert new_hash not in done
+        finally:
+            release.set()
+            threads[1].join(timeout=30)
+            worker.close()
+        assert done[new_hash] == done[cached_hash] == (1, 4, 2, 2, 2)
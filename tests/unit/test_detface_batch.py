@@ -0,0 +1,241 @@
+"""
+Unit tests for batched face detection.
+"""
+
+import pytest
+import torch
+import sys
+from pathlib import Path
+from typing import List
+
+# Add project root to path
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+np = pytest.importorskip("numpy")
+cv2 = pytest.importorskip("cv2")
+pytest.importorskip("torchvision")
+
+from hymm_sp.data_kits.audio_preprocessor import get_facemask
+from hymm_sp.data_kits.face_align.align import AlignImage
+from hymm_sp.data_kits.face_align import detface
+from hymm_sp.data_kits.face_align.detface import (
+    DetFace,
+    non_max_suppression_face,
+    non_max_suppression_face_batch,
+)
+
+
+class FakeDetector:
+    """
+    Stand-in for the TorchScript detector: one face on the bright pixels of each image, a shifted duplicate of it
+    for NMS to remove, and a candidate under the confidence threshold.
+    """
+    def __init__(self):
+        self.batch_sizes = []
+
+    def __call__(self, img, grids):
+        self.batch_sizes.append(img.shape[0])
+        pred = torch.zeros(img.shape[0], 3, 16)
+        for i, image in enumerate(img):
+            ys, xs = (image.mean(0) > 0.5).nonzero(as_tuple=True)
+            x1, y1, x2, y2 = xs.min(), ys.min(), xs.max() + 1, ys.max() + 1
+            box = torch.stack([(x1 + x2) / 2, (y1 + y2) / 2, x2 - x1, y2 - y1]).float()
+            landmarks = torch.stack([x1, y1, x2, y1, (x1 + x2) / 2, (y1 + y2) / 2, x1, y2, x2, y2]).float()
+            pred[i, 0] = torch.cat([box, torch.tensor([0.9]), landmarks, torch.tensor([1.])])
+            pred[i, 1] = torch.cat([box + torch.tensor([2., 2., 0., 0.]), torch.tensor([0.8]), landmarks,
+                                    torch.tensor([1.])])
+            pred[i, 2] = torch.cat([box / 2, torch.tensor([0.3]), landmarks, torch.tensor([1.])])
+        return pred.to(img.device)
+
+
+def make_detector():
+    detector = DetFace.__new__(DetFace)
+    detector.inpSize = 416
+    detector.conf_thres = 0.5
+    detector.iou_thres = 0.45
+    detector.test_device = torch.device("cpu")
+    detector.model = FakeDetector()
+    detector.last_w = detector.last_h = 416
+    detector.grids = None
+    return detector
+
+
+def make_image(h, w, x1, y1, x2, y2):
+    image = np.zeros((h, w, 3), dtype=np.uint8)
+    image[y1:y2, x1:x2] = 255
+    return image
+
+
+class TestBatchedNMS:
+    """Test suite for the vectorized NMS."""
+
+    def test_matches_per_image_nms(self):
+        """Same detections as the per-image loop, tagged with their image."""
+        torch.manual_seed(0)
+        pred = torch.rand(3, 200, 16)
+        pred[..., :2] *= 400
+        pred[..., 2:4] = pred[..., 2:4] * 80 + 10
+        det, image_index = non_max_suppression_face_batch(pred.clone())
+        for i, expected in enumerate(non_max_suppression_face(pred.clone())):
+            assert torch.allclose(det[image_index == i], expected)
+
+    def test_no_candidates(self):
+        """Nothing above the threshold gives empty outputs."""
+        det, image_index = non_max_suppression_face_batch(torch.zeros(2, 10, 16))
+        assert det.shape == (0, 16) and image_index.shape == (0,)
+
+
+class TestDetectBatch:
+    """Test suite for DetFace.detect_batch."""
+
+    def test_matches_detect(self):
+        """Images of different sizes share one forward and give the boxes of `detect`."""
+        detector = make_detector()
+        images = [make_image(512, 512, 100, 120, 300, 360), make_image(480, 640, 200, 50, 400, 300)]
+        bboxes, kpss, scores, image_index = detector.detect_batch(images)
+        assert detector.model.batch_sizes == [2]
+        assert image_index.tolist() == [0, 1]
+        for i, image in enumerate(images):
+            expected_bboxes, expected_kpss, expected_scores = detector.detect(image)
+            assert np.allclose(bboxes[image_index == i], expected_bboxes, atol=2)
+            assert np.allclose(kpss[image_index == i], expected_kpss, atol=2)
+            assert np.allclose(scores[image_index == i], expected_scores)
+
+    def test_tensor_input(self):
+        """An RGB tensor batch gives the boxes of its BGR arrays."""
+        detector = make_detector()
+        images = [make_image(256, 256, 10, 20, 100, 200), make_image(256, 256, 50, 60, 250, 250)]
+        from_arrays = detector.detect_batch(images)
+        tensor = torch.from_numpy(np.stack(images)[..., ::-1].copy()).permute(0, 3, 1, 2).half()
+        for a, b in zip(from_arrays, detector.detect_batch(tensor)):
+            assert np.allclose(a, b)
+
+    def test_maxface_keeps_largest_per_image(self):
+        """`maxface` keeps the largest box of each image, not the last one."""
+        detector = make_detector()
+        pred = torch.zeros(1, 3, 16)
+        pred[0, :, 4] = 0.9
+        pred[0, :, 15] = 1
+        pred[0, :, :4] = torch.tensor([[50., 50., 20., 20.], [200., 200., 80., 80.], [350., 350., 40., 40.]])
+        detector.model = lambda img, grids: pred.repeat(img.shape[0], 1, 1)
+        images = [np.zeros((416, 416, 3), dtype=np.uint8)] * 2
+        results = AlignImage.detect_batch(type("Align", (), {"facedet": detector})(), images, maxface=True)
+        for _, scores_list, bboxes_list in results:
+            assert len(bboxes_list) == 1
+            assert np.allclose(bboxes_list[0], [160, 160, 80, 80])
+
+
+def reference_facemask(ref_image, bboxes, area, size):
+    """The former numpy construction at full resolution, then resized to `size`."""
+    h, w = ref_image.shape[-2:]
+    masks = []
+    for bbox in bboxes:
+        x1, y1, ww, hh = [float(v) for v in bbox]
+        x2, y2 = x1 + ww, y1 + hh
+        ww, hh = (x2-x1) * area, (y2-y1) * area
+        center = [(x2+x1)//2, (y2+y1)//2]
+        x1 = max(center[0] - ww//2, 0)
+        y1 = max(center[1] - hh//2, 0)
+        x2 = min(center[0] + ww//2, w)
+        y2 = min(center[1] + hh//2, h)
+        mask = np.zeros((h, w), dtype=np.float32)
+        mask[int(y1):int(y2), int(x1):int(x2)] = 1.0
+        masks.append(torch.from_numpy(mask))
+    masks = torch.stack(masks)[:, None]
+    return torch.nn.functional.interpolate(masks, size, mode="bilinear")[:, :, None]
+
+
+class TestFaceMask:
+    """Test suite for the face mask rasterized at latent resolution."""
+
+    @pytest.mark.parametrize("area", [1.25, 3.0])
+    def test_matches_resized_full_resolution_mask(self, area):
+        """Same values as building the mask at full resolution and resizing it bilinearly."""
+        detector = make_detector()
+        image = make_image(512, 384, 101, 133, 203, 287)
+        ref_image = torch.from_numpy(image[..., ::-1].copy()).permute(2, 0, 1)[None, None].float()
+        bboxes, _, _, _ = detector.detect_batch([image], maxface=True)
+        mask = get_facemask(ref_image, type("Align", (), {"facedet": detector})(), area=area, size=(64, 48))
+        assert mask.shape == (1, 1, 1, 64, 48)
+        assert torch.allclose(mask, reference_facemask(ref_image, bboxes, area, (64, 48)), atol=1e-6)
+
+    def test_no_face_covers_the_frame(self):
+        """Frames without a detection are masked entirely."""
+        detector = make_detector()
+        detector.model = lambda img, grids: torch.zeros(img.shape[0], 3, 16)
+        ref_image = torch.zeros(2, 1, 3, 128, 128, dtype=torch.float16)
+        mask = get_facemask(ref_image, type("Align", (), {"facedet": detector})(), size=(16, 16))
+        assert mask.dtype == torch.float16
+        assert torch.equal(mask, torch.ones_like(mask))
+
+
+class TinyDetector(torch.nn.Module):
+    """Scriptable detector with the inputs and output layout of detface.pt: two faces, the larger one second."""
+    def __init__(self):
+        super().__init__()
+        base = torch.zeros(1, 2, 16)
+        base[0, :, :4] = torch.tensor([[100., 100., 40., 40.], [250., 200., 120., 160.]])
+        base[0, :, 4] = 0.9
+        base[0, :, 5:15] = 200.
+        base[0, :, 15] = 1.
+        self.register_buffer("base", base)
+
+    def forward(self, x, grids: List[torch.Tensor]):
+        return self.base.expand(x.shape[0], -1, -1) + x.mean(dim=(1, 2, 3)).view(-1, 1, 1)
+
+
+@pytest.fixture
+def detector_path(temp_dir):
+    path = temp_dir / "detface.pt"
+    torch.jit.script(TinyDetector().eval()).save(str(path))
+    return str(path)
+
+
+class TestDetectorBackends:
+    """Test suite for the CPU face detector backends."""
+
+    def test_cpu_torchscript(self, detector_path):
+        """On the CPU the detector is frozen for inference and gives box-only outputs."""
+        align = AlignImage("cpu", det_path=detector_path)
+        assert align.facedet.test_device.type == "cpu"
+        bboxes, kpss, scores, image_index = align.facedet.detect_batch(torch.zeros(2, 3, 416, 416), maxface=True,
+                                                                       landmarks=False)
+        assert kpss is None
+        assert np.allclose(bboxes, [[190, 120, 120, 160]] * 2)
+        assert image_index.tolist() == [0, 1]
+
+    def test_missing_onnxruntime_falls_back(self, detector_path, monkeypatch):
+        """Without onnxruntime the ONNX backends run the TorchScript detector on the CPU."""
+        monkeypatch.setattr(detface, "onnxruntime", None)
+        detector = DetFace(detector_path, device="cuda", backend="onnx-int8")
+        assert detector.backend == "torchscript" and detector.test_device.type == "cpu"
+
+    def test_onnx_matches_torchscript(self, detector_path):
+        """The exported detector finds the boxes of the TorchScript one."""
+        pytest.importorskip("onnxruntime")
+        pytest.importorskip("onnx")
+        detector = DetFace(detector_path, device="cpu", backend="onnx")
+        assert detector.backend == "onnx"
+        images = torch.randint(0, 255, (2, 3, 416, 416)).float()
+        expected = DetFace(detector_path, device="cpu").detect_batch(images)
+        for a, b in zip(detector.detect_batch(images), expected):
+            assert np.allclose(a, b, atol=1e-3)
+
+    def test_interrupted_export_leaves_no_file(self, detector_path, monkeypatch):
+        """An export failing halfway leaves neither a partial model, that later runs would load, nor a temp file."""
+        def export(model, args, path, **kwargs):
+            Path(path).write_bytes(b"partial")
+            raise RuntimeError("export interrupted")
+
+        monkeypatch.setattr(torch.onnx, "export", export)
+        with pytest.raises(RuntimeError):
+            detface.export_onnx(torch.jit.load(detector_path), [], detector_path)
+        assert [path.name for path in Path(detector_path).parent.iterdir()] == ["detface.pt"]
+
+    def test_maxface_keeps_largest(self):
+        """`__call__` with maxface keeps the largest face, not the last one larger than the first."""
+        align = AlignImage.__new__(AlignImage)
+        bboxes = np.array([[0, 0, 10, 10], [0, 0, 50, 50], [0, 0, 20, 20]], dtype=np.float64)
+        align.facedet = type("Det", (), {"detect": lambda self, im: (bboxes, np.zeros((3, 5, 2)), np.ones(3))})()
+        _, _, bboxes_list = align(np.zeros((64, 64, 3), dtype=np.uint8), maxface=True)
+        assert np.allclose(bboxes_list[0], [0, 0, 50, 50])
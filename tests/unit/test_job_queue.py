@@ -0,0 +1,146 @@
+"""
+Unit tests for the server job queue.
+"""
+
+import pytest
+import threading
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+
+# Add project root to path
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+from hymm_gradio.job_queue import JobQueue, QueueFull, StepProgressCallback
+
+
+class BlockingRunner:
+    """run_fn that records the order of the jobs and holds each one until released."""
+    def __init__(self):
+        self.release = threading.Event()
+        self.started = threading.Event()
+        self.order = []
+
+    def __call__(self, job):
+        self.started.set()
+        self.release.wait(10)
+        if job.payload.get("fail"):
+            raise ValueError("bad input")
+        if job.payload.get("err_code"):
+            return {"errCode": job.payload["err_code"], "content": [{"buffer": None}], "info": "failed to preprocess"}
+        self.order.append(job.payload["name"])
+        job.set_progress(30, 30)
+        return {"errCode": 0, "name": job.payload["name"]}
+
+
+class TestJobQueue:
+    """Test suite for JobQueue."""
+
+    def test_jobs_run_in_order(self):
+        """Jobs wait their turn instead of being rejected, and keep their results."""
+        runner = BlockingRunner()
+        queue = JobQueue(runner, max_queued=4)
+        jobs = [queue.submit({"name": i}) for i in range(3)]
+        runner.started.wait(10)
+        assert queue.position(jobs[2]) == 1
+        runner.release.set()
+        for job in jobs:
+            assert queue.wait(job, timeout=10)
+        assert runner.order == [0, 1, 2]
+        assert queue.get(jobs[0].id).to_dict()["result"] == {"errCode": 0, "name": 0}
+        queue.close()
+
+    def test_priority(self):
+        """Higher priority jobs run first, equal priorities in submission order."""
+        runner = BlockingRunner()
+        queue = JobQueue(runner)
+        queue.submit({"name": "running"})
+        runner.started.wait(10)
+        jobs = [queue.submit({"name": "low"}), queue.submit({"name": "high"}, priority=1),
+                queue.submit({"name": "low2"})]
+        runner.release.set()
+        queue.close()
+        assert runner.order == ["running", "high", "low", "low2"]
+        assert all(job.status == "done" for job in jobs)
+
+    def test_bounded(self):
+        """Submitting beyond `max_queued` waiting jobs raises QueueFull."""
+        runner = BlockingRunner()
+        queue = JobQueue(runner, max_queued=1)
+        queue.submit({"name": "running"})
+        runner.started.wait(10)
+        queue.submit({"name": "waiting"})
+        with pytest.raises(QueueFull):
+            queue.submit({"name": "rejected"})
+        runner.release.set()
+        queue.close()
+
+    def test_cancel_and_failure(self):
+        """Queued jobs can be cancelled, failing jobs report their error."""
+        runner = BlockingRunner()
+        queue = JobQueue(runner)
+        failing = queue.submit({"fail": True})
+        runner.started.wait(10)
+        cancelled = queue.submit({"name": "cancelled"})
+        assert queue.cancel(cancelled.id)
+        assert not queue.cancel(failing.id)
+        runner.release.set()
+        queue.close()
+        assert cancelled.status == "cancelled" and runner.order == []
+        assert failing.to_dict()["error"] == "ValueError: bad input"
+
+    def test_error_result_fails_the_job(self):
+        """A stage error result ends the job as failed, not done, with the server's error info."""
+        runner = BlockingRunner()
+        runner.release.set()
+        queue = JobQueue(runner)
+        job = queue.submit({"err_code": -2})
+        queue.close()
+        info = job.to_dict()
+        assert info["status"] == "failed" and info["error"] == "errCode -2: failed to preprocess"
+        assert info["result"]["errCode"] == -2 and info["progress"] == 0.0
+
+    def test_cancel_running_job(self):
+        """A running job asked to stop ends cancelled, the flag belongs to that job only."""
+        runner = BlockingRunner()
+        queue = JobQueue(runner, num_workers=2)
+        cancelled = queue.submit({"err_code": -5})
+        other = queue.submit({"name": "other"})
+        runner.started.wait(10)
+        cancelled.cancel_requested.set()
+        runner.release.set()
+        queue.close()
+        assert cancelled.status == "cancelled" and not other.cancel_requested.is_set()
+        assert other.status == "done"
+
+    def test_history_is_bounded(self):
+        """Only the last `keep_finished` finished jobs are kept."""
+        runner = BlockingRunner()
+        runner.release.set()
+        queue = JobQueue(runner, keep_finished=2)
+        jobs = [queue.submit({"name": i}) for i in range(4)]
+        queue.close()
+        assert [queue.get(job.id) for job in jobs] == [None, None, jobs[2], jobs[3]]
+
+
+class TestStepProgressCallback:
+    """Test suite for the denoising progress of a job."""
+
+    def test_reports_progress_and_chains(self):
+        """Each step updates the job and then runs the inner callback."""
+        progress, inner_steps = [], []
+        inner = lambda pipeline, step, timestep, kwargs: inner_steps.append(step) or {}
+        inner.tensor_inputs = ["latents_all"]
+        callback = StepProgressCallback(lambda step, total: progress.append((step, total)), inner=inner)
+        pipeline = SimpleNamespace(num_timesteps=50, _interrupt=False)
+        callback(pipeline, 0, None, {})
+        callback(pipeline, 1, None, {})
+        assert progress == [(1, 50), (2, 50)] and inner_steps == [0, 1]
+        assert callback.tensor_inputs == ["latents_all"]
+
+    def test_abort(self):
+        """`should_abort` interrupts the pipeline."""
+        callback = StepProgressCallback(lambda step, total: None, should_abort=lambda: True)
+        pipeline = SimpleNamespace(num_timesteps=50, _interrupt=False)
+        callback(pipeline, 0, None, {})
+        assert pipeline._interrupt
@@ -0,0 +1,91 @@
+"""
+Unit tests for the latent preview decoder.
+"""
+
+import numpy as np
+import torch
+from unittest.mock import MagicMock
+import sys
+from pathlib import Path
+
+# Add project root to path
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+from hymm_sp.vae.preview import (
+    LatentPreviewer,
+    LatentPreviewCallback,
+    fit_linear_preview,
+    frames_to_grid,
+    preview_targets,
+)
+
+
+class TestLatentPreviewer:
+    """Test suite for LatentPreviewer."""
+
+    def test_default_frames_shape(self):
+        """Default previewer renders uint8 frames at latent resolution."""
+        latents = torch.randn(1, 16, 9, 12, 20, dtype=torch.bfloat16)
+        frames = LatentPreviewer.default().to_frames(latents, frame_stride=4)
+
+        assert frames.shape == (3, 12, 20, 3)
+        assert frames.dtype == np.uint8
+
+    def test_linear_fit_recovers_projection(self):
+        """Least squares recovers a known linear latent-to-RGB map."""
+        torch.manual_seed(0)
+        weight, bias = torch.randn(3, 16), torch.randn(3)
+        latents = torch.randn(1, 16, 4, 8, 8)
+        targets = torch.einsum("oc,bcthw->bothw", weight, latents) + bias[None, :, None, None, None]
+
+        previewer = fit_linear_preview(latents, targets)
+
+        assert torch.allclose(previewer(latents), targets, atol=1e-4)
+
+    def test_save_and_load(self, temp_dir):
+        """A distillable previewer survives a save / load round trip."""
+        previewer = LatentPreviewer(hidden_channels=8)
+        previewer.save_pretrained(temp_dir / "preview.pt")
+        loaded = LatentPreviewer.from_pretrained(temp_dir / "preview.pt")
+        latents = torch.randn(1, 16, 2, 4, 4)
+
+        assert torch.allclose(previewer(latents), loaded(latents))
+
+    def test_preview_targets_shape(self):
+        """Targets are pooled to the causal latent layout."""
+        video = torch.rand(1, 3, 33, 64, 64) * 2 - 1
+
+        assert preview_targets(video).shape == (1, 3, 9, 8, 8)
+
+
+class TestLatentPreviewCallback:
+    """Test suite for LatentPreviewCallback."""
+
+    def test_preview_every_n_steps_once(self):
+        """Previews are rendered once per selected step, not once per window."""
+        on_preview = MagicMock()
+        callback = LatentPreviewCallback(LatentPreviewer.default(), on_preview, every_n_steps=2)
+        pipeline = MagicMock()
+        kwargs = {"latents_all": torch.randn(1, 16, 5, 4, 4)}
+
+        for step in range(4):
+            for _ in range(3):
+                assert callback(pipeline, step, 0, kwargs) == {}
+
+        assert [c.args[0] for c in on_preview.call_args_list] == [0, 2]
+
+    def test_abort_interrupts_pipeline(self):
+        """should_abort interrupts the pipeline."""
+        callback = LatentPreviewCallback(LatentPreviewer.default(), MagicMock(), should_abort=lambda: True)
+        pipeline = MagicMock()
+        pipeline._interrupt = False
+
+        callback(pipeline, 1, 0, {"latents_all": torch.randn(1, 16, 1, 2, 2)})
+
+        assert pipeline._interrupt is True
+
+    def test_frames_to_grid(self):
+        """Frames are tiled row by row."""
+        frames = np.ones((5, 2, 3, 3), dtype=np.uint8)
+
+        assert frames_to_grid(frames, cols=4).shape == (4, 12, 3)
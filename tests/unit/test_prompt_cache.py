@@ -0,0 +1,132 @@
+"""
+Unit tests for the prompt-embedding cache of TextEncoder.
+"""
+
+import torch
+import sys
+from pathlib import Path
+from unittest.mock import MagicMock
+
+# Add project root to path
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+from hymm_sp.cache import FeatureCache
+from hymm_sp.text_encoder import TextEncoder, TextEncoderModelOutput
+
+
+def make_text_encoder(text_encoder_type="llava-llama-3-8b", skip_layer=2):
+    """TextEncoder with the model calls mocked out."""
+    encoder = TextEncoder.__new__(TextEncoder)
+    torch.nn.Module.__init__(encoder)
+    encoder.text_encoder_type = text_encoder_type
+    encoder.model_path = "ckpts/" + text_encoder_type
+    encoder.prompt_template_video = {"template": "{}", "crop_start": 0}
+    encoder.max_length = 8
+    encoder.hidden_state_skip_layer = skip_layer
+    encoder.apply_final_norm = False
+    encoder.dtype = torch.float16
+    encoder.device = torch.device("cpu")
+    encoder.prompt_cache = None
+    encoder.text2tokens = MagicMock(side_effect=lambda text, data_type, name: {
+        "input_ids": torch.ones(len(text) if isinstance(text, list) else 1, 8, dtype=torch.long),
+        "attention_mask": torch.ones(len(text) if isinstance(text, list) else 1, 8, dtype=torch.long)})
+    encoder.encode = MagicMock(side_effect=lambda inputs, data_type: TextEncoderModelOutput(
+        torch.randn(*inputs["attention_mask"].shape, 4), inputs["attention_mask"]))
+    return encoder
+
+
+class TestPromptCache:
+    """Test suite for TextEncoder.encode_prompt."""
+
+    def test_without_cache_always_encodes(self):
+        """No cache: every call runs the encoder."""
+        encoder = make_text_encoder()
+        encoder.encode_prompt("a person talking")
+        encoder.encode_prompt("a person talking")
+        assert encoder.encode.call_count == 2
+
+    def test_hit_skips_encoder(self):
+        """A repeated prompt is served from the cache without running the encoder."""
+        encoder = make_text_encoder()
+        encoder.enable_prompt_cache(FeatureCache("prompt_embeds"))
+        first = encoder.encode_prompt("a person talking")
+        second = encoder.encode_prompt("a person talking")
+        assert encoder.encode.call_count == 1
+        assert torch.equal(first[0], second[0])
+
+    def test_image_is_part_of_the_key(self):
+        """The LLaVA image hash separates entries, and extends the mask by the image tokens."""
+        encoder = make_text_encoder()
+        encoder.enable_prompt_cache(FeatureCache("prompt_embeds"))
+        image = torch.zeros(1, 3, 336, 336)
+        _, mask = encoder.encode_prompt("a person talking", image)
+        encoder.encode_prompt("a person talking", image + 1)
+        encoder.encode_prompt("a person talking", image.clone())
+        assert encoder.encode.call_count == 2
+        assert mask.shape[1] == 8 + 575
+
+    def test_settings_are_part_of_the_key(self):
+        """Encoders with a different skip layer do not share entries."""
+        cache = FeatureCache("prompt_embeds")
+        a, b = make_text_encoder(skip_layer=2), make_text_encoder(skip_layer=0)
+        a.enable_prompt_cache(cache)
+        b.enable_prompt_cache(cache)
+        a.encode_prompt("a person talking")
+        b.encode_prompt("a person talking")
+        assert a.encode.call_count == 1 and b.encode.call_count == 1
+
+
+class TestEncodePrompts:
+    """Test suite for the batched TextEncoder.encode_prompts."""
+
+    def test_one_forward_per_batch(self):
+        """Prompts are encoded in batches of `batch_size` and split back per prompt."""
+        encoder = make_text_encoder()
+        results = encoder.encode_prompts([f"prompt {i}" for i in range(5)], batch_size=2)
+        assert encoder.encode.call_count == 3
+        assert len(results) == 5
+        assert all(hidden.shape == (1, 8, 4) and mask.shape == (1, 8) for hidden, mask in results)
+
+    def test_rows_with_images_are_batched_separately(self):
+        """Rows with a LLaVA image get the image tokens in their mask, rows without do not."""
+        encoder = make_text_encoder()
+        image = torch.zeros(1, 3, 336, 336)
+        results = encoder.encode_prompts(["a", "b", "c"], [image, None, image.clone()])
+        assert encoder.encode.call_count == 2
+        assert [mask.shape[1] for _, mask in results] == [8 + 575, 8, 8 + 575]
+
+    def test_warms_the_prompt_cache(self):
+        """`encode_prompt` is served from the entries written by `encode_prompts`, also for single-item lists."""
+        encoder = make_text_encoder()
+        encoder.enable_prompt_cache(FeatureCache("prompt_embeds"))
+        image = torch.zeros(1, 3, 336, 336)
+        results = encoder.encode_prompts(["a person talking", "low quality"], [image, image])
+        assert encoder.encode.call_count == 1
+
+        hidden, _ = encoder.encode_prompt("a person talking", image.clone())
+        negative, _ = encoder.encode_prompt(["low quality"], image.clone())
+        encoder.encode_prompts(["a person talking"], [image])
+        assert encoder.encode.call_count == 1
+        assert torch.equal(hidden, results[0][0]) and torch.equal(negative, results[1][0])
+
+
+class TestNegativePromptEmbeds:
+    """Test suite for precomputed negative prompt embeddings in the pipeline."""
+
+    def test_precomputed_negative_skips_encoder(self):
+        """Passing negative embeddings and mask skips encoding the negative prompt and returns them."""
+        from hymm_sp.diffusion.pipelines.pipeline_hunyuan_video_audio import HunyuanVideoAudioPipeline
+
+        pipeline = HunyuanVideoAudioPipeline.__new__(HunyuanVideoAudioPipeline)
+        encoder = make_text_encoder("clipL", skip_layer=None)
+        negative_embeds, negative_mask = torch.randn(1, 8, 4), torch.ones(1, 8, dtype=torch.long)
+
+        _, neg, _, neg_mask = pipeline.encode_prompt_audio_text_base(
+            prompt="a person talking", uncond_prompt=None, pixel_value_llava=None, uncond_pixel_value_llava=None,
+            device="cpu", num_images_per_prompt=1, do_classifier_free_guidance=True,
+            negative_prompt="low quality", negative_prompt_embeds=negative_embeds,
+            negative_attention_mask=negative_mask, text_encoder=encoder)
+
+        assert encoder.encode.call_count == 1
+        assert torch.equal(neg.float(), negative_embeds.half().float())
+        assert neg_mask is negative_mask
@@ -0,0 +1,89 @@
+"""
+Unit tests for the rank 0 request fan-out of the server (gloo on CPU).
+"""
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import sys
+from pathlib import Path
+
+# Add project root to path
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+from hymm_gradio.request_channel import RequestChannel, pack_request, unpack_request
+
+
+def make_request():
+    return [
+        ["a portrait"],
+        "audio.wav",
+        None,
+        torch.tensor([25.]),
+        torch.arange(24, dtype=torch.float16).view(2, 3, 4),
+        [129],
+        {"exp": torch.tensor([1]), "head": torch.tensor([True, False])},
+        torch.arange(12).view(3, 4).t(),
+    ]
+
+
+def assert_same(a, b):
+    if isinstance(a, torch.Tensor):
+        assert a.dtype == b.dtype and torch.equal(a, b)
+    elif isinstance(a, (list, tuple)):
+        assert type(a) is type(b) and len(a) == len(b)
+        for x, y in zip(a, b):
+            assert_same(x, y)
+    elif isinstance(a, dict):
+        assert a.keys() == b.keys()
+        for key in a:
+            assert_same(a[key], b[key])
+    else:
+        assert a == b
+
+
+def _channel_worker(rank, world_size, init_file, out_file):
+    dist.init_process_group("gloo", init_method=f"file://{init_file}", rank=rank, world_size=world_size)
+    try:
+        channel = RequestChannel("cpu")
+        received = []
+        if rank == 0:
+            channel.send(make_request())
+            channel.send(("second", torch.ones(2)))
+            channel.close()
+        else:
+            while True:
+                request = channel.recv()
+                if request is None:
+                    break
+                received.append(request)
+            torch.save(received, f"{out_file}.{rank}")
+    finally:
+        dist.destroy_process_group()
+
+
+class TestPackRequest:
+    """Test suite for the request header."""
+
+    def test_roundtrip(self):
+        """The header holds no tensors, and unpacking restores the request."""
+        request = make_request()
+        (structure, specs), tensors = pack_request(request)
+        assert len(tensors) == len(specs) == 5
+        assert specs[1] == ((2, 3, 4), torch.float16, "cpu")
+        assert_same(unpack_request(structure, tensors), request)
+
+
+class TestRequestChannel:
+    """Test suite for RequestChannel."""
+
+    def test_fan_out(self, temp_dir):
+        """Every other rank receives the requests in order, then None once the channel is closed."""
+        world_size = 3
+        mp.spawn(_channel_worker, args=(world_size, str(temp_dir / "init"), str(temp_dir / "out")),
+                 nprocs=world_size, join=True)
+        for rank in range(1, world_size):
+            received = torch.load(f"{temp_dir / 'out'}.{rank}")
+            assert len(received) == 2
+            assert_same(received[0], make_request())
+            assert_same(received[1], ("second", torch.ones(2)))
@@ -0,0 +1,92 @@
+"""
+Unit tests for encoding the audio of concurrent server jobs in shared Whisper batches.
+"""
+
+import pytest
+import threading
+import torch
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+
+# Add project root to path
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+from hymm_gradio.staged_executor import Stage, StagedExecutor
+
+
+class FakeWhisper(torch.nn.Module):
+    """Whisper stand-in recording the batch size of each forward."""
+    config = SimpleNamespace(_name_or_path="fake-whisper")
+
+    def __init__(self):
+        super().__init__()
+        self.scale = torch.nn.Parameter(torch.ones(()))
+        self.encoder = self
+        self.batch_sizes = []
+
+    @property
+    def dtype(self):
+        return self.scale.dtype
+
+    def forward(self, mels, output_hidden_states=True):
+        self.batch_sizes.append(mels.shape[0])
+        pooled = mels.mean(dim=1).unflatten(-1, (-1, 2)).mean(-1).unsqueeze(-1) * self.scale
+        return SimpleNamespace(hidden_states=(pooled, pooled + 1))
+
+
+def fake_preprocess(args, image_path, audio_path, prompt, feature_extractor):
+    """`data_preprocess_server` without the image and audio decoding: 30 s of random log-mel features."""
+    return {
+        "text_prompt": [prompt],
+        "audio_path": ["<upload>"],
+        "image_path": ["<upload>"],
+        "fps": torch.tensor([25.]),
+        "audio_prompts": torch.randn(1, 80, 3000),
+        "audio_len": [129],
+        "motion_bucket_id_exps": torch.zeros(1, 4),
+        "motion_bucket_id_heads": torch.zeros(1, 4),
+        "pixel_value_ref": torch.zeros(1, 1, 3, 8, 8),
+        "pixel_value_ref_llava": torch.zeros(1, 1, 3, 8, 8),
+    }
+
+
+class TestPreprocessStage:
+    """Test suite for the Whisper encoding in the preprocess stage of the server."""
+
+    def test_concurrent_jobs_share_a_whisper_forward(self, monkeypatch):
+        """Two jobs preprocessed at the same time run Whisper once, each getting its own hidden states."""
+        pytest.importorskip("fastapi")
+        pytest.importorskip("uvicorn")
+        pytest.importorskip("transformers")
+        pytest.importorskip("flash_attn")
+        from hymm_gradio import fastapi_server as server
+        from hymm_sp.audio_video_inference import HunyuanVideoSampler
+
+        wav2vec = FakeWhisper()
+        # only the audio encoding of the sampler is used, without loading any model
+        sampler = HunyuanVideoSampler.__new__(HunyuanVideoSampler)
+        sampler.audio_batcher, sampler.whisper_lock = None, threading.Lock()
+        sampler.enable_audio_batcher(wav2vec, max_windows=8, max_wait=0.5)
+        monkeypatch.setattr(server, "data_preprocess_server", fake_preprocess)
+        monkeypatch.setattr(server, "hunyuan_sampler", sampler, raising=False)
+        monkeypatch.setattr(server, "wav2vec", wav2vec, raising=False)
+        monkeypatch.setattr(server, "feature_extractor", None, raising=False)
+        monkeypatch.setattr(server, "args", SimpleNamespace(), raising=False)
+
+        executor = StagedExecutor([Stage("preprocess", server.preprocess_job, num_workers=2)])
+        jobs = [SimpleNamespace(payload={"image_bytes": b"image", "audio_bytes": b"audio", "text": str(i)})
+                for i in range(2)]
+        try:
+            requests = [future.result(10) for future in [executor.submit(job) for job in jobs]]
+        finally:
+            executor.close()
+            sampler.disable_audio_batcher()
+
+        assert wav2vec.batch_sizes == [2]
+        for request in requests:
+            params = request["broadcast_params"]
+            audio_prompts, audio_hidden_states = params[4], params[5]
+            assert audio_hidden_states.shape == (1, 1500, 2, 1)
+            expected = audio_prompts[0].mean(dim=0).unflatten(-1, (-1, 2)).mean(-1)
+            assert torch.allclose(audio_hidden_states[0, :, 0, 0], expected, atol=1e-6)
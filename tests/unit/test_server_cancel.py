@@ -0,0 +1,73 @@
+"""
+Unit tests for cancelling a single server job.
+"""
+
+import pytest
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+
+# Add project root to path
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+from hymm_gradio.job_queue import Job
+
+
+@pytest.fixture
+def server(monkeypatch):
+    pytest.importorskip("fastapi")
+    pytest.importorskip("uvicorn")
+    pytest.importorskip("transformers")
+    pytest.importorskip("flash_attn")
+    from hymm_gradio import fastapi_server as server
+
+    interrupted = []
+
+    def predict(args, batch, wav2vec, feature_extractor, align_instance, callback_on_step_end=None, **kwargs):
+        # one denoising step, the pipeline stops where the callback interrupts it
+        pipeline = SimpleNamespace(num_timesteps=2, _interrupt=False)
+        callback_on_step_end(pipeline, 0, None, {})
+        interrupted.append(pipeline._interrupt)
+        return None if pipeline._interrupt else {"samples": batch["text_prompt"]}
+
+    for name, value in [("hunyuan_sampler", SimpleNamespace(predict=predict)), ("args", None), ("wav2vec", None),
+                        ("feature_extractor", None), ("align_instance", None), ("preview_callback", None),
+                        ("rank", 0), ("local_rank", 0), ("request_channel", None)]:
+        monkeypatch.setattr(server, name, value, raising=False)
+    server.interrupted = interrupted
+    return server
+
+
+def make_request(job):
+    return {"job": job, "broadcast_params": ["prompt"] + [None] * 10}
+
+
+class TestCancelJob:
+    """Test suite for the per-job cancellation of the generate stage."""
+
+    def test_cancelled_job_is_not_generated(self, server):
+        """A job cancelled while it waits for the generate stage never reaches the sampler."""
+        job = Job({})
+        job.cancel_requested.set()
+        assert server.generate_job(make_request(job)).result["errCode"] == -5
+        assert server.interrupted == []
+
+    def test_cancel_stops_only_its_own_job(self, server, monkeypatch):
+        """`DELETE /jobs/{id}` of a job waiting for the GPU does not interrupt the job denoising."""
+        running, waiting = Job({}), Job({})
+        waiting.status, waiting.stage = "running", "generate"
+        monkeypatch.setattr(server, "job_queue", SimpleNamespace(get=lambda job_id: waiting,
+                                                                 cancel=lambda job_id: False), raising=False)
+        monkeypatch.setattr(running, "set_progress", lambda step, total: server.cancel_job(waiting.id))
+        assert server.generate_job(make_request(running))["outputs"] == {"samples": "prompt"}
+        assert server.interrupted == [False] and waiting.cancel_requested.is_set()
+        assert server.generate_job(make_request(waiting)).result["errCode"] == -5
+
+    def test_cancel_interrupts_the_denoising_job(self, server, monkeypatch):
+        """A job cancelled during denoising stops at the next step."""
+        job = Job({})
+        set_progress = job.set_progress
+        monkeypatch.setattr(job, "set_progress", lambda step, total: job.cancel_requested.set() or
+                            set_progress(step, total))
+        assert server.generate_job(make_request(job)).result["errCode"] == -5
+        assert server.interrupted == [True]
@@ -0,0 +1,112 @@
+"""
+Unit tests for the stage-pipelined server executor.
+"""
+
+import pytest
+import threading
+import time
+import sys
+from pathlib import Path
+
+# Add project root to path
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+from hymm_gradio.staged_executor import Finished, Stage, StagedExecutor
+
+
+class TestStagedExecutor:
+    """Test suite for StagedExecutor."""
+
+    def test_stages_run_in_order(self):
+        """Each item goes through every stage, the output of one being the input of the next."""
+        executor = StagedExecutor([
+            Stage("double", lambda x: x * 2, num_workers=2),
+            Stage("inc", lambda x: x + 1),
+        ])
+        futures = [executor.submit(i) for i in range(5)]
+        assert [future.result(10) for future in futures] == [1, 3, 5, 7, 9]
+        executor.close()
+        metrics = executor.metrics()
+        assert metrics["double"]["processed"] == metrics["inc"]["processed"] == 5
+        assert metrics["inc"]["workers"] == 1 and metrics["inc"]["queued"] == 0
+
+    def test_preprocessing_overlaps_the_gpu_stage(self):
+        """The next item is preprocessed while the previous one holds the single-worker stage."""
+        gpu_busy, preprocessed = threading.Event(), threading.Event()
+        release = threading.Event()
+        events = []
+
+        def preprocess(x):
+            if x == 1:
+                assert gpu_busy.wait(10)
+                preprocessed.set()
+            return x
+
+        def generate(x):
+            events.append(("start", x))
+            if x == 0:
+                gpu_busy.set()
+                release.wait(10)
+            events.append(("end", x))
+            return x
+
+        executor = StagedExecutor([Stage("preprocess", preprocess, num_workers=2), Stage("generate", generate)])
+        futures = [executor.submit(0), executor.submit(1)]
+        assert preprocessed.wait(10)
+        assert executor.metrics()["generate"]["busy"] == 1
+        release.set()
+        assert [future.result(10) for future in futures] == [0, 1]
+        assert events == [("start", 0), ("end", 0), ("start", 1), ("end", 1)]
+        executor.close()
+
+    def test_finished_and_failures(self):
+        """`Finished` skips the remaining stages, an exception fails the item and is counted."""
+        def check(x):
+            if x < 0:
+                return Finished({"errCode": -3})
+            if x == 0:
+                raise ValueError("bad input")
+            return x
+
+        seen = []
+        executor = StagedExecutor([Stage("check", check), Stage("run", lambda x: seen.append(x) or x)])
+        stages = []
+        assert executor.submit(-1).result(10) == {"errCode": -3}
+        with pytest.raises(ValueError):
+            executor.submit(0).result(10)
+        assert executor.submit(2, on_stage=stages.append).result(10) == 2
+        executor.close()
+        assert seen == [2] and stages == ["check", "run"]
+        assert executor.metrics()["check"]["failed"] == 1
+
+    def test_stage_is_reported_at_hand_off(self):
+        """An item waiting for a busy stage already reports that stage, not the one it finished."""
+        release = threading.Event()
+        executor = StagedExecutor([Stage("generate", lambda x: x), Stage("output", lambda x: release.wait(10) and x)])
+        stages = {0: [], 1: []}
+        futures = [executor.submit(i, on_stage=stages[i].append) for i in range(2)]
+        for _ in range(100):
+            if stages[1] == ["generate", "output"]:
+                break
+            time.sleep(0.01)
+        assert executor.metrics()["output"]["busy"] == 1
+        assert stages == {0: ["generate", "output"], 1: ["generate", "output"]}
+        release.set()
+        assert [future.result(10) for future in futures] == [0, 1]
+        executor.close()
+
+    def test_bounded_queue(self):
+        """Submitting blocks once the first stage and its queue are full."""
+        release = threading.Event()
+        executor = StagedExecutor([Stage("slow", lambda x: release.wait(10) and x)], max_queued=1)
+        executor.submit(0)
+        time.sleep(0.1)
+        executor.submit(1)
+        blocked = threading.Thread(target=executor.submit, args=(2,))
+        blocked.start()
+        blocked.join(0.2)
+        assert blocked.is_alive()
+        release.set()
+        blocked.join(10)
+        executor.close()
+        assert executor.metrics()["slow"]["processed"] == 3
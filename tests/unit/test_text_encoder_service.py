@@ -0,0 +1,147 @@
+"""
+Unit tests for the out-of-process text encoder service.
+"""
+
+import os
+import pytest
+import stat
+import torch
+import sys
+from multiprocessing import AuthenticationError
+from pathlib import Path
+
+# Add project root to path
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+from hymm_sp.text_encoder import TextEncoder, TextEncoderModelOutput
+from hymm_sp.text_encoder.service import AUTHKEY_ENV, TextEncoderClient, TextEncoderService, authkey_path
+
+
+class TinyEncoder:
+    """Random-weight stand-in for a loaded TextEncoder: an embedding of the token ids."""
+    text_encoder_type = "tiny"
+    model_path = "ckpts/tiny"
+    max_length = 8
+    prompt_template_video = None
+    hidden_state_skip_layer = 2
+    apply_final_norm = False
+    use_attention_mask = True
+
+    def __init__(self):
+        torch.manual_seed(0)
+        self.embedding = torch.nn.Embedding(32, 4).to(torch.bfloat16)
+        self.dtype = torch.bfloat16
+        self.calls = []
+
+    def encode(self, batch_encoding, use_attention_mask=None, hidden_state_skip_layer=None, data_type='image'):
+        self.calls.append(data_type)
+        if data_type != 'video':
+            raise ValueError(f"Unsupported data type: {data_type}")
+        return TextEncoderModelOutput(self.embedding(batch_encoding["input_ids"]), batch_encoding["attention_mask"])
+
+
+@pytest.fixture
+def service(temp_dir, monkeypatch):
+    monkeypatch.delenv(AUTHKEY_ENV, raising=False)
+    service = TextEncoderService({"tiny": TinyEncoder()}, str(temp_dir / "text_encoder.sock")).start()
+    yield service
+    service.close()
+
+
+def make_client_encoder(address):
+    """TextEncoder in client mode, as built with `service_address`, without loading a tokenizer."""
+    encoder = TextEncoder.__new__(TextEncoder)
+    torch.nn.Module.__init__(encoder)
+    for key in ("text_encoder_type", "max_length", "prompt_template_video", "hidden_state_skip_layer",
+                "apply_final_norm", "use_attention_mask"):
+        setattr(encoder, key, getattr(TinyEncoder, key))
+    encoder.reproduce = False
+    encoder.device = torch.device("cpu")
+    encoder.client = TextEncoderClient(address, "tiny")
+    return encoder
+
+
+class TestTextEncoderService:
+    """Test suite for TextEncoderService and its clients."""
+
+    def test_encode_matches_local_model(self, service):
+        """The client receives the hidden states the encoder computes, with dtype and shape intact."""
+        encoder = make_client_encoder(service.address)
+        input_ids = torch.randint(0, 32, (2, 8))
+        outputs = encoder.encode({"input_ids": input_ids, "attention_mask": torch.ones(2, 8, dtype=torch.long)},
+                                 data_type='video')
+        expected = service.encoders["tiny"].embedding(input_ids)
+        assert outputs.hidden_state.dtype == torch.bfloat16
+        assert torch.equal(outputs.hidden_state, expected)
+        assert torch.equal(outputs.attention_mask, torch.ones(2, 8, dtype=torch.long))
+
+    def test_results_outlive_the_next_request(self, service):
+        """Results are copies, releasing the shared memory of a reply does not touch them."""
+        client = TextEncoderClient(service.address, "tiny")
+        first = client.encode({"input_ids": torch.zeros(1, 8, dtype=torch.long),
+                               "attention_mask": torch.ones(1, 8)}, "cpu", data_type='video')
+        expected = first.hidden_state.clone()
+        client.encode({"input_ids": torch.ones(1, 8, dtype=torch.long),
+                       "attention_mask": torch.ones(1, 8)}, "cpu", data_type='video')
+        assert torch.equal(first.hidden_state, expected)
+        client.close()
+
+    def test_clients_share_one_encoder(self, service):
+        """Several workers are served by the same encoder instance."""
+        clients = [TextEncoderClient(service.address, "tiny") for _ in range(3)]
+        for client in clients:
+            client.encode({"input_ids": torch.zeros(1, 8, dtype=torch.long), "attention_mask": torch.ones(1, 8)},
+                          "cpu", data_type='video')
+            client.close()
+        assert len(service.encoders["tiny"].calls) == 3
+
+    def test_errors_are_raised_in_the_client(self, service):
+        """A failing encode raises in the worker, and the connection keeps working."""
+        client = TextEncoderClient(service.address, "tiny")
+        with pytest.raises(RuntimeError, match="Unsupported data type"):
+            client.encode({"input_ids": torch.zeros(1, 8, dtype=torch.long)}, "cpu", data_type='image')
+        assert client.info()["dtype"] == torch.bfloat16
+        client.close()
+
+    def test_incompatible_settings_are_rejected(self, service):
+        """A worker tokenizing with other settings than the service's encoder is refused."""
+        encoder = make_client_encoder(service.address)
+        encoder.max_length = 16
+        with pytest.raises(ValueError, match="max_length"):
+            encoder.client.check_compatible(encoder)
+
+
+class TestServiceAccess:
+    """Test suite for who may connect to the service."""
+
+    def test_socket_and_key_are_owner_only(self, service):
+        """The generated key and the socket are only accessible to their owner, the key goes away with the service."""
+        key_file = authkey_path(service.address)
+        assert stat.S_IMODE(os.stat(key_file).st_mode) == 0o600
+        assert stat.S_IMODE(os.stat(service.address).st_mode) == 0o600
+        assert len(Path(key_file).read_bytes()) == 32
+        service.close()
+        assert not os.path.exists(key_file)
+
+    def test_wrong_key_is_refused(self, service):
+        """Clients without the key cannot send requests."""
+        with pytest.raises(AuthenticationError):
+            TextEncoderClient(service.address, "tiny", authkey=b"hymm-text-encoder")
+
+    def test_key_from_environment(self, temp_dir, monkeypatch):
+        """With the environment variable set, no key file is written."""
+        monkeypatch.setenv(AUTHKEY_ENV, "secret")
+        service = TextEncoderService({"tiny": TinyEncoder()}, str(temp_dir / "env.sock")).start()
+        try:
+            assert not os.path.exists(authkey_path(service.address))
+            client = TextEncoderClient(service.address, "tiny")
+            assert client.info()["text_encoder_type"] == "tiny"
+            client.close()
+        finally:
+            service.close()
+
+    def test_missing_key_is_an_error(self, temp_dir, monkeypatch):
+        """There is no default key to fall back to."""
+        monkeypatch.delenv(AUTHKEY_ENV, raising=False)
+        with pytest.raises(RuntimeError, match=AUTHKEY_ENV):
+            TextEncoderClient(str(temp_dir / "missing.sock"), "tiny")
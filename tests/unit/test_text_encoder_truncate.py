@@ -0,0 +1,82 @@
+"""
+Unit tests for running the LLaVA text encoder only up to the used hidden state.
+"""
+
+import pytest
+import torch
+import sys
+from pathlib import Path
+
+# Add project root to path
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+from hymm_sp.text_encoder import TextEncoder, get_llama_parts
+
+
+def make_tiny_llava_encoder(skip_layer=2, num_layers=4):
+    """TextEncoder around a randomly initialized tiny LLaVA."""
+    transformers = pytest.importorskip("transformers")
+    config = transformers.LlavaConfig(
+        vision_config=transformers.CLIPVisionConfig(hidden_size=16, intermediate_size=32, num_hidden_layers=2,
+                                                    num_attention_heads=2, image_size=28, patch_size=14),
+        text_config=transformers.LlamaConfig(hidden_size=16, intermediate_size=32, num_hidden_layers=num_layers,
+                                             num_attention_heads=2, num_key_value_heads=2, vocab_size=64),
+    )
+    torch.manual_seed(0)
+    model = transformers.LlavaForConditionalGeneration(config).eval()
+    model.final_layer_norm = get_llama_parts(model)[0].norm
+
+    encoder = TextEncoder.__new__(TextEncoder)
+    torch.nn.Module.__init__(encoder)
+    encoder.text_encoder_type = "llava-llama-3-8b"
+    encoder.model = model
+    encoder.hidden_state_skip_layer = skip_layer
+    encoder.apply_final_norm = False
+    encoder.truncate_mode = "none"
+    encoder.skipped_modules = None
+    encoder.logger = None
+    encoder.client = None
+    return encoder
+
+
+class TestTruncatedTextEncoder:
+    """Test suite for TextEncoder.truncate_to_skip_layer."""
+
+    @torch.no_grad()
+    def test_logits_match_skipped_hidden_state(self):
+        """The truncated model returns exactly the hidden state the full model exposes at the skip layer."""
+        encoder = make_tiny_llava_encoder(skip_layer=2)
+        input_ids = torch.randint(0, 32, (1, 6))
+        expected = encoder.model(input_ids=input_ids, output_hidden_states=True).hidden_states[-3]
+
+        encoder.truncate_to_skip_layer()
+        assert len(get_llama_parts(encoder.model)[0].layers) == 2
+        actual = encoder.model(input_ids=input_ids, use_cache=False).logits
+        assert torch.allclose(actual.float(), expected.float(), atol=1e-6)
+
+    @torch.no_grad()
+    def test_restore_full_model(self):
+        """Stop mode keeps the dropped modules, restoring gives back the full model."""
+        encoder = make_tiny_llava_encoder()
+        input_ids = torch.randint(0, 32, (1, 6))
+        expected = encoder.model(input_ids=input_ids).logits
+
+        encoder.truncate_to_skip_layer()
+        encoder.restore_full_model()
+        assert encoder.truncate_mode == "none"
+        assert torch.equal(encoder.model(input_ids=input_ids).logits, expected)
+
+    def test_unload_cannot_be_restored(self):
+        """Unload mode drops the modules for good."""
+        encoder = make_tiny_llava_encoder()
+        encoder.truncate_to_skip_layer(unload=True)
+        assert encoder.skipped_modules is None
+        with pytest.raises(RuntimeError):
+            encoder.restore_full_model()
+
+    def test_no_skip_layer_is_not_truncated(self):
+        """Without a skip layer the last hidden state is the full model output, nothing is dropped."""
+        encoder = make_tiny_llava_encoder(skip_layer=0)
+        encoder.truncate_to_skip_layer()
+        assert encoder.truncate_mode == "none"
+        assert len(get_llama_parts(encoder.model)[0].layers) == 4
@@ -0,0 +1,113 @@
+"""
+Unit tests for memory-budgeted VAE tile selection.
+"""
+
+import pytest
+import threading
+import torch
+import sys
+from pathlib import Path
+
+# Add project root to path
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+from hymm_sp.vae.auto_tiling import TileMemoryModel, TilingPlan, apply_tiling_plan, plan_tiling
+
+GiB = 1024 ** 3
+LATENT_SHAPE = (1, 16, 33, 88, 88)        # 129 frames at 704x704
+
+
+class TestPlanTiling:
+    """Test suite for plan_tiling."""
+
+    def test_no_tiling_when_clip_fits(self, tiny_vae):
+        """Tiling is skipped when the whole clip fits the budget."""
+        plan = plan_tiling(tiny_vae, LATENT_SHAPE, 1024 * GiB, memory_model=TileMemoryModel(1000))
+
+        assert not plan.use_spatial_tiling
+        assert not plan.use_temporal_tiling
+
+    @pytest.mark.parametrize("budget_gib", [4, 8, 16, 32])
+    def test_plan_respects_budget(self, tiny_vae, budget_gib):
+        """The chosen tiles fit into the budget."""
+        plan = plan_tiling(tiny_vae, LATENT_SHAPE, budget_gib * GiB, memory_model=TileMemoryModel(1000, 2))
+
+        assert plan.use_spatial_tiling or plan.use_temporal_tiling
+        assert plan.estimated_bytes <= budget_gib * GiB
+        assert plan.tile_batch_size >= 1
+
+    def test_larger_budget_gives_larger_tiles(self, tiny_vae):
+        """More memory never leads to smaller tiles."""
+        model = TileMemoryModel(1000, 2)
+        small = plan_tiling(tiny_vae, LATENT_SHAPE, 4 * GiB, memory_model=model)
+        large = plan_tiling(tiny_vae, LATENT_SHAPE, 32 * GiB, memory_model=model)
+
+        def volume(plan):
+            # an untiled dimension is covered by a single tile
+            size = plan.tile_latent_min_size if plan.use_spatial_tiling else LATENT_SHAPE[-1]
+            tsize = plan.tile_latent_min_tsize if plan.use_temporal_tiling else LATENT_SHAPE[2]
+            return size ** 2 * tsize
+        assert volume(large) >= volume(small)
+
+    def test_encode_shape_is_converted_to_latents(self, tiny_vae):
+        """Pixel shapes are planned in latent units."""
+        plan = plan_tiling(tiny_vae, (1, 3, 129, 704, 704), 4 * GiB, kind="encode",
+                           memory_model=TileMemoryModel(1000, 2))
+
+        assert plan.tile_latent_min_size <= 88
+        assert plan.estimated_bytes <= 4 * GiB
+
+
+class TestTileBatching:
+    """Test suite for decoding several tiles per batch."""
+
+    def test_batched_tiles_match_single_tiles(self, tiny_vae):
+        """Batching equally shaped tiles does not change the decoded video."""
+        z = torch.randn(1, 4, 3, 10, 10)
+        tiny_vae.enable_spatial_tiling()
+        reference = tiny_vae.decode(z).sample
+
+        plan = TilingPlan(use_spatial_tiling=True, use_temporal_tiling=False,
+                          tile_latent_min_size=tiny_vae.tile_latent_min_size,
+                          tile_latent_min_tsize=tiny_vae.tile_latent_min_tsize, tile_batch_size=4)
+        apply_tiling_plan(tiny_vae, plan)
+        batched = tiny_vae.decode(z).sample
+
+        assert torch.allclose(reference, batched, atol=1e-5)
+
+
+class TestThreadTiling:
+    """Test suite for per-thread tiling settings."""
+
+    def test_changes_stay_in_thread(self, tiny_vae):
+        """Tiling changed inside `thread_tiling` is neither seen by other threads nor kept after the block."""
+        changed, checked = threading.Event(), threading.Event()
+        seen = []
+
+        def decode_thread():
+            with tiny_vae.thread_tiling():
+                tiny_vae.enable_tiling()
+                tiny_vae.tile_batch_size = 4
+                changed.set()
+                checked.wait(timeout=10)
+                seen.append((tiny_vae.use_spatial_tiling, tiny_vae.tile_batch_size))
+
+        thread = threading.Thread(target=decode_thread)
+        thread.start()
+        assert changed.wait(timeout=10)
+        assert not tiny_vae.use_spatial_tiling and tiny_vae.tile_batch_size == 1
+        with tiny_vae.thread_tiling():
+            tiny_vae.enable_temporal_tiling()
+        checked.set()
+        thread.join(timeout=10)
+
+        assert seen == [(True, 4)]
+        assert not tiny_vae.use_spatial_tiling and not tiny_vae.use_temporal_tiling
+
+    def test_auto_tiling_plan_is_not_kept(self, tiny_vae):
+        """The plan picked for one decode does not change the settings of the instance."""
+        settings = (tiny_vae.use_spatial_tiling, tiny_vae.tile_latent_min_size, tiny_vae.tile_batch_size)
+        tiny_vae.enable_auto_tiling(1)
+        tiny_vae.decode(torch.randn(1, 4, 3, 10, 10))
+
+        assert (tiny_vae.use_spatial_tiling, tiny_vae.tile_latent_min_size, tiny_vae.tile_batch_size) == settings
@@ -0,0 +1,74 @@
+"""
+Unit tests for the CPU-optimized VAE decode path.
+"""
+
+import copy
+import torch
+import torch.nn as nn
+import sys
+from pathlib import Path
+
+# Add project root to path
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+from hymm_sp.vae.cpu_decode import fold_post_quant_conv, make_latents
+
+
+class TestFoldPostQuantConv:
+    """Test suite for folding post_quant_conv into the decoder."""
+
+    def test_fold_is_exact(self, tiny_vae):
+        """The folded decoder matches post_quant_conv followed by the decoder."""
+        z = torch.randn(1, 4, 3, 8, 8)
+        with torch.no_grad():
+            expected = tiny_vae.decoder(tiny_vae.post_quant_conv(z))
+            folded = copy.deepcopy(tiny_vae)
+            assert fold_post_quant_conv(folded)
+            actual = folded.decoder(folded.post_quant_conv(z))
+
+        assert isinstance(folded.post_quant_conv, nn.Identity)
+        assert torch.allclose(expected, actual, atol=1e-4)
+
+    def test_fold_twice_is_noop(self, tiny_vae):
+        """A second fold leaves the VAE untouched."""
+        assert fold_post_quant_conv(tiny_vae)
+        weight = tiny_vae.decoder.conv_in.conv.weight.clone()
+        assert not fold_post_quant_conv(tiny_vae)
+        assert torch.equal(weight, tiny_vae.decoder.conv_in.conv.weight)
+
+
+class TestCPUDecode:
+    """Test suite for AutoencoderKLCausal3D.enable_cpu_decode."""
+
+    def test_fp32_channels_last_matches_baseline(self, tiny_vae):
+        """Without reduced precision the optimized path reproduces the plain decode."""
+        z = make_latents(tiny_vae, 64, 64, 9)
+        optimized = copy.deepcopy(tiny_vae)
+        optimized.enable_cpu_decode(dtype=torch.float32)
+        with torch.no_grad():
+            expected = tiny_vae.decode(z, return_dict=False)[0]
+            actual = optimized.decode(z, return_dict=False)[0]
+
+        assert actual.shape == expected.shape
+        assert torch.allclose(expected, actual, atol=1e-4)
+
+    def test_bf16_close_to_baseline(self, tiny_vae):
+        """bf16 autocast stays close to the fp32 decode, with tiling enabled."""
+        z = make_latents(tiny_vae, 64, 64, 9)
+        tiny_vae.enable_tiling()
+        optimized = copy.deepcopy(tiny_vae)
+        optimized.enable_cpu_decode(dtype=torch.bfloat16)
+        with torch.no_grad():
+            expected = tiny_vae.decode(z, return_dict=False)[0]
+            actual = optimized.decode(z, return_dict=False)[0]
+
+        assert actual.shape == expected.shape
+        assert (expected - actual.float()).abs().max() < 0.1
+
+    def test_outer_autocast_untouched_when_disabled(self, tiny_vae):
+        """Without `enable_cpu_decode` the VAE keeps the caller's autocast state."""
+        seen = []
+        tiny_vae.decoder.register_forward_pre_hook(lambda m, a: seen.append(torch.is_autocast_cpu_enabled()))
+        with torch.no_grad(), torch.autocast(device_type="cpu", dtype=torch.bfloat16):
+            tiny_vae.decode(make_latents(tiny_vae, 16, 16, 1), return_dict=False)
+        assert seen == [True]
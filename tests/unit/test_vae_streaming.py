@@ -0,0 +1,140 @@
+"""
+Unit tests for streaming (causal cache) VAE decoding.
+"""
+
+import pytest
+import torch
+import sys
+from pathlib import Path
+
+# Add project root to path
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+from hymm_sp.vae.unet_causal_3d_blocks import CausalConv3d, UpsampleCausal3D, set_causal_cache
+
+
+class TestCausalCache:
+    """Test suite for the per-layer causal cache."""
+
+    @pytest.mark.parametrize("chunk", [1, 2, 3, 5])
+    def test_chunked_conv_matches_full_pass(self, chunk):
+        """Chunked causal conv output equals a single pass over the whole sequence."""
+        torch.manual_seed(0)
+        conv = CausalConv3d(4, 6, kernel_size=3)
+        x = torch.randn(1, 4, 11, 6, 6)
+
+        full = conv(x)
+        set_causal_cache(conv, True)
+        streamed = torch.cat([conv(c) for c in x.split(chunk, dim=2)], dim=2)
+        set_causal_cache(conv, False)
+
+        assert torch.allclose(full, streamed, atol=1e-5)
+        assert conv.cache is None
+
+    def test_upsample_keeps_only_first_frame_causal(self):
+        """Only the very first streamed frame skips temporal upsampling."""
+        up = UpsampleCausal3D(4, use_conv=False, upsample_factor=(2, 2, 2))
+        x = torch.randn(1, 4, 6, 4, 4)
+
+        full = up(x)
+        set_causal_cache(up, True)
+        streamed = torch.cat([up(c) for c in x.split(2, dim=2)], dim=2)
+        set_causal_cache(up, False)
+
+        assert streamed.shape == full.shape
+        assert torch.equal(full, streamed)
+
+
+class TestStreamDecode:
+    """Test suite for AutoencoderKLCausal3D.stream_decode."""
+
+    def test_frame_count_matches_decode(self, tiny_vae):
+        """Streamed chunks add up to the same number of frames as a full decode."""
+        z = torch.randn(1, 4, 9, 4, 4)
+        full = tiny_vae.decode(z).sample
+
+        chunks = list(tiny_vae.stream_decode(z, chunk_size=4))
+
+        assert [c.shape[2] for c in chunks] == [13, 16, 4]
+        assert torch.cat(chunks, dim=2).shape == full.shape
+
+    def test_single_chunk_is_exact(self, tiny_vae):
+        """A chunk covering the whole clip reproduces the regular decode."""
+        z = torch.randn(1, 4, 5, 4, 4)
+        full = tiny_vae.decode(z).sample
+
+        (streamed,) = list(tiny_vae.stream_decode(z, chunk_size=5))
+
+        assert torch.allclose(full, streamed, atol=1e-5)
+
+    @pytest.mark.parametrize("chunk_size", [2, 4])
+    def test_static_clip_is_exact(self, tiny_vae, chunk_size):
+        """Without change over time, per-chunk norm statistics and attention equal the full ones."""
+        z = torch.randn(1, 4, 1, 4, 4).expand(-1, -1, 9, -1, -1)
+        full = tiny_vae.decode(z).sample
+
+        streamed = torch.cat(list(tiny_vae.stream_decode(z, chunk_size=chunk_size)), dim=2)
+
+        assert torch.allclose(full, streamed, atol=1e-4)
+
+    @pytest.mark.parametrize("chunk_size", [2, 4])
+    def test_multi_chunk_error_is_bounded(self, tiny_vae, chunk_size, monkeypatch):
+        """Latents varying by 5% over time stay within 10% of `decode`, closer than `temporal_tiled_decode`."""
+        from hymm_sp.vae import autoencoder_kl_causal_3d
+        monkeypatch.setattr(autoencoder_kl_causal_3d, "DISABLE_SP", True)
+        torch.manual_seed(0)
+        z = torch.randn(1, 4, 1, 4, 4) + 0.05 * torch.randn(1, 4, 13, 4, 4)
+        with torch.no_grad():
+            full = tiny_vae.decode(z).sample
+            tiled = tiny_vae.temporal_tiled_decode(z, return_dict=False)[0]
+            streamed = torch.cat(list(tiny_vae.stream_decode(z, chunk_size=chunk_size)), dim=2)
+
+        error = (streamed - full).norm() / full.norm()
+        assert error < 0.1
+        assert error < (tiled - full).norm() / full.norm()
+
+    def test_cache_released_after_stream(self, tiny_vae):
+        """Streaming state is cleared once the generator is exhausted."""
+        z = torch.randn(1, 4, 6, 4, 4)
+        for _ in tiny_vae.stream_decode(z, chunk_size=2):
+            pass
+
+        convs = [m for m in tiny_vae.decoder.modules() if isinstance(m, CausalConv3d)]
+        assert all(not m.use_cache and m.cache is None for m in convs)
+
+    def test_spatial_tiles_single_chunk_is_exact(self, tiny_vae):
+        """With spatial tiling, a chunk covering the whole clip reproduces `spatial_tiled_decode`."""
+        tiny_vae.enable_spatial_tiling()
+        z = torch.randn(1, 4, 5, 10, 10)
+        full = tiny_vae.spatial_tiled_decode(z, return_dict=False)[0]
+
+        (streamed,) = list(tiny_vae.stream_decode(z, chunk_size=5))
+
+        assert streamed.shape == full.shape
+        assert torch.allclose(full, streamed, atol=1e-5)
+
+    def test_spatial_tiles_keep_their_own_state(self, tiny_vae):
+        """Streamed spatial tiles add up to the same video shape as a tiled decode."""
+        tiny_vae.enable_spatial_tiling()
+        z = torch.randn(1, 4, 6, 10, 10)
+        full = tiny_vae.spatial_tiled_decode(z, return_dict=False)[0]
+
+        chunks = list(tiny_vae.stream_decode(z, chunk_size=2))
+
+        assert [c.shape[2] for c in chunks] == [5, 8, 8]
+        assert torch.cat(chunks, dim=2).shape == full.shape
+
+    def test_concurrent_use_raises(self, tiny_vae):
+        """A running stream blocks other streams and full decodes until it is closed."""
+        z = torch.randn(1, 4, 6, 4, 4)
+        stream = tiny_vae.stream_decode(z, chunk_size=2)
+        next(stream)
+
+        with pytest.raises(RuntimeError):
+            next(tiny_vae.stream_decode(z, chunk_size=2))
+        with pytest.raises(RuntimeError):
+            tiny_vae.decode(z)
+
+        stream.close()
+        assert not tiny_vae.streaming
+        assert tiny_vae.decode(z).sample.shape[2] == 21
@@ -0,0 +1,89 @@
+"""
+Unit tests for the job video streamed while it is encoded.
+"""
+
+import io
+import pytest
+import threading
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+
+# Add project root to path
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+from hymm_gradio.video_stream import VideoStream
+
+
+class TestVideoStream:
+    """Test suite for VideoStream."""
+
+    def test_reader_gets_fragments_before_the_end(self):
+        """A reader started before the encoding gets each fragment as it is appended."""
+        stream = VideoStream()
+        reader = stream.iter_bytes(timeout=10)
+        stream.append(b"moov")
+        assert next(reader) == b"moov"
+        received = []
+        thread = threading.Thread(target=lambda: received.extend(reader))
+        thread.start()
+        stream.append(b"moof1")
+        stream.append(b"moof2")
+        stream.finish()
+        thread.join(10)
+        assert received == [b"moof1", b"moof2"]
+
+    def test_finished_video_is_read_again(self):
+        """Later downloads get the whole file."""
+        stream = VideoStream()
+        for data in (b"a", b"b", b"c"):
+            stream.append(data)
+        stream.finish()
+        assert stream.getvalue() == b"abc"
+        assert b"".join(stream.iter_bytes()) == b"abc"
+
+    def test_failed_encoding_ends_readers_with_an_error(self):
+        """Readers do not take a truncated file for a complete one."""
+        stream = VideoStream()
+        stream.append(b"moov")
+        stream.finish(error="RuntimeError: boom")
+        reader = stream.iter_bytes()
+        assert next(reader) == b"moov"
+        with pytest.raises(RuntimeError, match="boom"):
+            next(reader)
+
+    def test_timeout(self):
+        """A reader does not wait forever on a stalled encoding."""
+        with pytest.raises(TimeoutError):
+            next(VideoStream().iter_bytes(timeout=0.05))
+
+
+class TestOutputStage:
+    """Test suite for the video encoding in the output stage of the server."""
+
+    def test_fragments_are_published_while_encoding(self, monkeypatch):
+        """The job's stream is registered before the first chunk is encoded, and ends as a playable MP4."""
+        pytest.importorskip("fastapi")
+        pytest.importorskip("uvicorn")
+        pytest.importorskip("flash_attn")
+        torch = pytest.importorskip("torch")
+        av = pytest.importorskip("av")
+        from hymm_gradio import fastapi_server as server
+
+        monkeypatch.setattr(server, "args", SimpleNamespace(job_video_history=4, video_codec="libx264", video_crf=30,
+                                                            video_preset="ultrafast", video_threads=0),
+                            raising=False)
+        monkeypatch.setattr(server, "job_videos", type(server.job_videos)())
+        job = SimpleNamespace(id="job")
+        seen = []
+
+        def chunks():
+            seen.append(server.job_videos.get(job.id))
+            yield torch.rand(1, 3, 13, 32, 32)
+
+        request = {"job": job, "outputs": {"samples_stream": chunks()}, "audio_len": [13], "save_fps": 25,
+                   "audio": None}
+        assert server.output_job(request)["errCode"] == 0
+        assert isinstance(seen[0], VideoStream)
+        with av.open(io.BytesIO(server.job_videos[job.id].getvalue())) as container:
+            assert sum(1 for _ in container.decode(video=0)) == 13
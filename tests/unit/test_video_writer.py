@@ -0,0 +1,83 @@
+"""
+Unit tests for the in-process video writer.
+"""
+
+import io
+import pytest
+import sys
+from pathlib import Path
+
+# Add project root to path
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+np = pytest.importorskip("numpy")
+torch = pytest.importorskip("torch")
+av = pytest.importorskip("av")
+soundfile = pytest.importorskip("soundfile")
+
+from hymm_sp.data_kits.video_writer import VideoWriter, iter_video_bytes, video_frames, write_video
+
+
+def make_frames(num_frames=25, size=64):
+    return (np.random.default_rng(0).uniform(0, 255, (num_frames, size, size, 3))).astype(np.uint8)
+
+
+def stream_durations(source):
+    """Video frames, audio samples and audio rate of an MP4 path or bytes."""
+    # every pass gets its own buffer, a shared one would be at EOF for the second open
+    open_source = (lambda: io.BytesIO(source)) if isinstance(source, bytes) else (lambda: source)
+    with av.open(open_source()) as container:
+        video = container.streams.video[0]
+        frames = sum(1 for _ in container.decode(video))
+    with av.open(open_source()) as container:
+        audio = container.streams.audio
+        samples = sum(frame.samples for frame in container.decode(audio[0])) if audio else 0
+        rate = audio[0].codec_context.sample_rate if audio else None
+    return frames, samples, rate
+
+
+class TestVideoWriter:
+    """Test suite for VideoWriter."""
+
+    def test_silent_video(self, temp_dir):
+        """Frames written one by one or as a batch all end up in the file."""
+        frames = make_frames()
+        with VideoWriter(temp_dir / "a.mp4", fps=25) as writer:
+            writer.write(frames[:5])
+            for frame in frames[5:]:
+                writer.write(frame)
+        assert stream_durations(str(temp_dir / "a.mp4"))[:2] == (25, 0)
+
+    def test_audio_is_cut_to_the_video(self, temp_dir):
+        """A 3 s track on a 1 s video is muxed in the same pass and ends with the video."""
+        soundfile.write(temp_dir / "a.wav", np.zeros((16000 * 3, 2), dtype=np.float32), 16000)
+        write_video(str(temp_dir / "a.mp4"), make_frames(), 25, audio=str(temp_dir / "a.wav"))
+        frames, samples, rate = stream_durations(str(temp_dir / "a.mp4"))
+        assert frames == 25 and rate == 16000
+        # the AAC decoder adds its priming and padding samples
+        assert 16000 <= samples <= 16000 + 2 * 1024
+
+    def test_generator_and_in_memory_audio(self, temp_dir):
+        """Frames can come from a generator and the audio as bytes, the output can be a buffer."""
+        soundfile.write(temp_dir / "a.wav", np.zeros(16000 * 3, dtype=np.float32), 16000)
+        buffer = io.BytesIO()
+        write_video(buffer, (frame for frame in make_frames()), 25, audio=(temp_dir / "a.wav").read_bytes())
+        assert stream_durations(buffer.getvalue())[0] == 25
+
+    def test_fragmented_stream(self, temp_dir):
+        """The fragmented MP4 comes out in several pieces that form a playable file."""
+        soundfile.write(temp_dir / "a.wav", np.zeros(16000 * 3, dtype=np.float32), 16000)
+        chunks = list(iter_video_bytes(make_frames(50), 25, audio=str(temp_dir / "a.wav"), crf=30, preset="ultrafast"))
+        assert len(chunks) > 1
+        frames, samples, _ = stream_durations(b"".join(chunks))
+        assert frames == 50 and samples >= 32000
+
+    def test_frames_from_chunks(self, temp_dir):
+        """Decoded chunks in [0, 1] become uint8 frame batches, cut at `num_frames`, and encode in one pass."""
+        chunks = [torch.rand(1, 3, 5, 32, 32), torch.rand(1, 3, 4, 32, 32) * 2, torch.rand(1, 3, 4, 32, 32)]
+        batches = list(video_frames(iter(chunks), num_frames=7))
+        assert [batch.shape for batch in batches] == [(5, 32, 32, 3), (2, 32, 32, 3)]
+        assert batches[0].dtype == np.uint8 and batches[1].max() == 255
+        assert np.array_equal(batches[0][0], (chunks[0][0, :, 0].permute(1, 2, 0) * 255).byte().numpy())
+        write_video(str(temp_dir / "a.mp4"), video_frames(chunks), 25)
+        assert stream_durations(str(temp_dir / "a.mp4"))[0] == 13
@@ -0,0 +1,94 @@
+"""
+Unit tests for batching the Whisper encoding of concurrent requests.
+"""
+
+import pytest
+import threading
+import torch
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+
+# Add project root to path
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+from hymm_sp.data_kits.audio_preprocessor import encode_audio, encode_audio_hidden_states
+from hymm_sp.whisper_batcher import WhisperBatcher
+
+
+class FakeWhisper(torch.nn.Module):
+    """Whisper stand-in recording the batch size of each forward."""
+    def __init__(self):
+        super().__init__()
+        self.scale = torch.nn.Parameter(torch.ones(()))
+        self.encoder = self
+        self.batch_sizes = []
+
+    @property
+    def dtype(self):
+        return self.scale.dtype
+
+    def forward(self, mels, output_hidden_states=True):
+        self.batch_sizes.append(mels.shape[0])
+        pooled = mels.mean(dim=1).unflatten(-1, (-1, 2)).mean(-1).unsqueeze(-1) * self.scale
+        return SimpleNamespace(hidden_states=(pooled, pooled + 1))
+
+
+class TestWhisperBatcher:
+    """Test suite for WhisperBatcher."""
+
+    def test_matches_unbatched_encoding(self):
+        """Each request gets the hidden states it would get on its own."""
+        wav2vec = FakeWhisper()
+        batcher = WhisperBatcher(wav2vec, max_windows=8, max_wait=0.05)
+        mels = [torch.randn(80, 3000), torch.randn(80, 9000)]
+        futures = [batcher.submit(mel) for mel in mels]
+        for mel, future in zip(mels, futures):
+            assert torch.allclose(future.result(timeout=10), encode_audio_hidden_states(FakeWhisper(), mel))
+        batcher.close()
+
+    def test_concurrent_requests_share_a_forward(self):
+        """Requests arriving within `max_wait` run in one forward."""
+        wav2vec = FakeWhisper()
+        batcher = WhisperBatcher(wav2vec, max_windows=8, max_wait=0.5)
+        futures = [batcher.submit(torch.randn(80, 3000)) for _ in range(3)]
+        for future in futures:
+            future.result(timeout=10)
+        batcher.close()
+        assert wav2vec.batch_sizes == [3]
+
+    def test_forwards_are_bounded(self):
+        """No forward takes more than `max_windows` windows."""
+        wav2vec = FakeWhisper()
+        batcher = WhisperBatcher(wav2vec, max_windows=2, max_wait=0.5)
+        batcher.encode(torch.randn(80, 12000))
+        batcher.close()
+        assert max(wav2vec.batch_sizes) <= 2 and sum(wav2vec.batch_sizes) == 5
+
+    def test_lock_is_held_while_encoding(self):
+        """The shared Whisper lock is taken around each forward."""
+        lock = threading.Lock()
+        seen = []
+        wav2vec = FakeWhisper()
+        wav2vec.register_forward_pre_hook(lambda module, args: seen.append(lock.locked()))
+        batcher = WhisperBatcher(wav2vec, lock=lock)
+        batcher.encode(torch.randn(80, 3000))
+        batcher.close()
+        assert seen == [True]
+
+    def test_errors_are_set_on_futures(self):
+        """Too short features fail their request, the batcher keeps serving."""
+        batcher = WhisperBatcher(FakeWhisper())
+        with pytest.raises(ValueError):
+            batcher.encode(torch.randn(80, 100))
+        assert batcher.encode(torch.randn(80, 3000)).shape == (1, 1500, 2, 1)
+        batcher.close()
+
+    def test_encode_audio_uses_batcher(self):
+        """`encode_audio` goes through the batcher when given one."""
+        wav2vec = FakeWhisper()
+        batcher = WhisperBatcher(wav2vec)
+        audio_prompts = encode_audio(None, torch.randn(80, 3000), fps=25, num_frames=33, batcher=batcher)
+        batcher.close()
+        assert audio_prompts.shape == (1, 33, 10, 2, 1)
+        assert wav2vec.batch_sizes == [1]